@@ -0,0 +1,225 @@
+"""
+Local stand-in for the Responses API used by the benchmarks.
+
+Plays back scripted computer_call sequences (benchmarks/scripts/*.json) with
+configurable latency and serves the fixture pages from benchmarks/fixtures.
+Point the backend at it with AZURE_ENDPOINT=http://127.0.0.1:<port>/.
+
+A task picks its script with a `bench:<name>` marker in the task text;
+tasks without one use --script.
+"""
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.staticfiles import StaticFiles
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import time
+import uuid
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.join(BENCH_DIR, "scripts")
+FIXTURES_DIR = os.path.join(BENCH_DIR, "fixtures")
+
+# 可由命令列或環境變數調整
+FAKE_LATENCY_MS = float(os.getenv("FAKE_LATENCY_MS", "300"))  # 每次 responses.create 的延遲
+FAKE_JITTER_MS = float(os.getenv("FAKE_JITTER_MS", "0"))  # 延遲的隨機浮動 (±)
+FAKE_DEFAULT_SCRIPT = os.getenv("FAKE_DEFAULT_SCRIPT", "form")
+FAKE_TAIL_MS = float(os.getenv("FAKE_TAIL_MS", "0"))  # 串流時 computer_call 之後仍在產生的推理摘要時間
+
+SCRIPT_MARKER = re.compile(r"bench:([\w-]+)")
+
+
+def load_scripts() -> dict:
+    scripts = {}
+    for name in sorted(os.listdir(SCRIPTS_DIR)):
+        if name.endswith(".json"):
+            with open(os.path.join(SCRIPTS_DIR, name), encoding="utf-8") as f:
+                script = json.load(f)
+            scripts[script.get("name", name[:-5])] = script
+    return scripts
+
+
+scripts = load_scripts()
+responses: dict = {}  # response id -> {"script", "step", "body"}
+stats = {"create": 0, "retrieve": 0, "computer_calls": 0, "completed": 0, "errors": 0}
+
+app = FastAPI(title="Fake Responses API")
+app.mount("/fixtures", StaticFiles(directory=FIXTURES_DIR, html=True), name="fixtures")
+
+
+def request_text(body: dict) -> str:
+    """All input_text in the request, to find the script marker."""
+    texts = []
+    items = body.get("input")
+    if isinstance(items, str):
+        return items
+    for item in items or []:
+        content = item.get("content")
+        if isinstance(content, str):
+            texts.append(content)
+        elif isinstance(content, list):
+            texts.extend(part.get("text", "") for part in content if part.get("type") == "input_text")
+    return "\n".join(texts)
+
+
+def display_size(body: dict) -> tuple:
+    """Display size declared by the computer_use_preview tool."""
+    for tool in body.get("tools") or []:
+        if tool.get("type") == "computer_use_preview":
+            return tool.get("display_width"), tool.get("display_height")
+    return None, None
+
+
+def scale_action(action: dict, script: dict, body: dict) -> dict:
+    """Scale script coordinates (in the script's reference size) to the declared display."""
+    width, height = display_size(body)
+    ref_width, ref_height = script.get("reference_size", [1920, 1080])
+    action = dict(action)
+    if width and height:
+        for key, ref, size in (("x", ref_width, width), ("y", ref_height, height),
+                               ("scroll_x", ref_width, width), ("scroll_y", ref_height, height)):
+            if key in action:
+                action[key] = round(action[key] * size / ref)
+    return action
+
+
+def response_body(response_id: str, script: dict, step: int, body: dict) -> dict:
+    steps = script["steps"]
+    if step < len(steps):
+        stats["computer_calls"] += 1
+        output = [{
+            "type": "computer_call",
+            "id": f"cu_{uuid.uuid4().hex[:16]}",
+            "call_id": f"call_{uuid.uuid4().hex[:16]}",
+            "action": scale_action(steps[step], script, body),
+            "pending_safety_checks": [],
+            "status": "completed",
+        }]
+    else:
+        stats["completed"] += 1
+        output = [{
+            "type": "message",
+            "id": f"msg_{uuid.uuid4().hex[:16]}",
+            "role": "assistant",
+            "status": "completed",
+            "content": [{"type": "output_text", "text": script.get("final_message", "Done."), "annotations": []}],
+        }]
+    return {
+        "id": response_id,
+        "object": "response",
+        "created_at": int(time.time()),
+        "model": body.get("model", "computer-use-preview"),
+        "status": "completed",
+        "output": output,
+        "parallel_tool_calls": False,
+        "tool_choice": "auto",
+        "tools": body.get("tools", []),
+        "previous_response_id": body.get("previous_response_id"),
+        "truncation": body.get("truncation", "disabled"),
+        "usage": {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0},
+    }
+
+
+async def simulated_latency():
+    delay = FAKE_LATENCY_MS + random.uniform(-FAKE_JITTER_MS, FAKE_JITTER_MS)
+    if delay > 0:
+        await asyncio.sleep(delay / 1000)
+
+
+def sse(event: dict) -> str:
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+
+async def stream_events(payload: dict):
+    """The response as Responses API stream events; output items first, reasoning summary after."""
+    sequence = iter(range(1_000_000))
+    in_progress = {**payload, "status": "in_progress", "output": []}
+    yield sse({"type": "response.created", "sequence_number": next(sequence), "response": in_progress})
+    for index, item in enumerate(payload["output"]):
+        yield sse({"type": "response.output_item.done", "sequence_number": next(sequence),
+                   "output_index": index, "item": item})
+    if FAKE_TAIL_MS > 0:
+        await asyncio.sleep(FAKE_TAIL_MS / 1000)
+        yield sse({"type": "response.reasoning_summary_text.delta", "sequence_number": next(sequence),
+                   "item_id": f"rs_{uuid.uuid4().hex[:16]}", "output_index": len(payload["output"]),
+                   "summary_index": 0, "delta": "Checking the result."})
+    yield sse({"type": "response.completed", "sequence_number": next(sequence), "response": payload})
+
+
+def error(status: int, message: str) -> JSONResponse:
+    stats["errors"] += 1
+    return JSONResponse({"error": {"message": message, "type": "invalid_request_error"}}, status_code=status)
+
+
+@app.post("/responses")
+@app.post("/openai/v1/responses")
+async def create_response(request: Request):
+    body = await request.json()
+    stats["create"] += 1
+    await simulated_latency()
+
+    previous_id = body.get("previous_response_id")
+    if previous_id:
+        previous = responses.get(previous_id)
+        if not previous:
+            return error(404, f"Response {previous_id} not found")
+        script_name, step = previous["script"], previous["step"] + 1
+    else:
+        match = SCRIPT_MARKER.search(request_text(body))
+        script_name, step = (match.group(1) if match else FAKE_DEFAULT_SCRIPT), 0
+    script = scripts.get(script_name)
+    if not script:
+        return error(400, f"Unknown benchmark script: {script_name}")
+
+    response_id = f"resp_{uuid.uuid4().hex}"
+    payload = response_body(response_id, script, step, body)
+    responses[response_id] = {"script": script_name, "step": step, "body": payload}
+    if body.get("stream"):
+        return StreamingResponse(stream_events(payload), media_type="text/event-stream")
+    return payload
+
+
+@app.get("/responses/{response_id}")
+@app.get("/openai/v1/responses/{response_id}")
+async def retrieve_response(response_id: str):
+    stats["retrieve"] += 1
+    stored = responses.get(response_id)
+    if not stored:
+        return error(404, f"Response {response_id} not found")
+    return stored["body"]
+
+
+@app.get("/stats")
+async def get_stats():
+    """Request counters, so runners can check how many model calls were made."""
+    return {**stats, "responses": len(responses), "scripts": sorted(scripts)}
+
+
+@app.get("/scripts")
+async def get_scripts():
+    return scripts
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Fake Responses API for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency-ms", type=float, default=FAKE_LATENCY_MS)
+    parser.add_argument("--jitter-ms", type=float, default=FAKE_JITTER_MS)
+    parser.add_argument("--tail-ms", type=float, default=FAKE_TAIL_MS, help="Streamed generation time after the computer_call")
+    parser.add_argument("--script", default=FAKE_DEFAULT_SCRIPT, help="Script for tasks without a bench:<name> marker")
+    args = parser.parse_args()
+
+    FAKE_LATENCY_MS = args.latency_ms
+    FAKE_JITTER_MS = args.jitter_ms
+    FAKE_TAIL_MS = args.tail_ms
+    FAKE_DEFAULT_SCRIPT = args.script
+    print(f"🧪 Fake Responses API on http://{args.host}:{args.port} "
+          f"(latency {FAKE_LATENCY_MS}±{FAKE_JITTER_MS}ms, scripts: {', '.join(sorted(scripts))})")
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
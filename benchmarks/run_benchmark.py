@@ -0,0 +1,535 @@
+"""
+End-to-end benchmarks for the computer-use backend.
+
+Drives /ai/start, /ai/execute and the WebSocket stream against the fixture
+pages while the backend talks to the fake Responses API, and writes the
+results to a JSON file so runs can be compared between revisions.
+
+    # 啟動 fake API 與後端，跑完全部情境
+    python benchmarks/run_benchmark.py run --spawn
+
+    # 使用已在執行的服務（後端需設定 AZURE_ENDPOINT 指向 fake API）
+    python benchmarks/run_benchmark.py run --backend http://localhost:8000 \\
+        --fake-api http://127.0.0.1:9000 --backend-pid 1234
+
+    # 比較兩次結果
+    python benchmarks/run_benchmark.py compare results/a.json results/b.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import struct
+import subprocess
+import sys
+import time
+from typing import Dict, Optional
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+
+# 與 computer_use_backend.FRAME_HEADER 相同的 binary 幀 header
+FRAME_HEADER = struct.Struct("!BBIdHHBBB")
+FRAME_KIND_FULL = 1
+
+SCENARIOS = ("ai-start", "ai-execute", "websocket")
+
+
+def percentile(values: list, pct: float) -> Optional[float]:
+    """Nearest-rank percentile; None for an empty list."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+    return round(ordered[index], 1)
+
+
+def summarize(values: list) -> dict:
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "mean": round(sum(values) / len(values), 1) if values else None,
+    }
+
+
+def load_script(name: str) -> dict:
+    with open(os.path.join(BENCH_DIR, "scripts", f"{name}.json"), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def git_revision() -> dict:
+    def git(*args):
+        try:
+            return subprocess.run(["git", *args], cwd=REPO_DIR, capture_output=True, text=True,
+                                  timeout=10).stdout.strip()
+        except (OSError, subprocess.SubprocessError):
+            return ""
+    return {"commit": git("rev-parse", "--short", "HEAD") or None, "dirty": bool(git("status", "--porcelain"))}
+
+
+# ---------------------------------------------------------------------------
+# CPU / memory sampling
+# ---------------------------------------------------------------------------
+
+def process_tree_usage(root_pid: int) -> tuple:
+    """(cpu_ticks, rss_bytes) of a process and all its descendants, read from /proc."""
+    children: Dict[int, list] = {}
+    usage: Dict[int, tuple] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # comm 可能含空白，從最後一個 ')' 之後開始解析
+                fields = f.read().rsplit(")", 1)[1].split()
+            with open(f"/proc/{entry}/statm") as f:
+                rss_pages = int(f.read().split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(int(fields[1]), []).append(int(entry))
+        usage[int(entry)] = (int(fields[11]) + int(fields[12]), rss_pages)
+
+    ticks, pages, stack = 0, 0, [root_pid]
+    while stack:
+        pid = stack.pop()
+        cpu, rss = usage.get(pid, (0, 0))
+        ticks += cpu
+        pages += rss
+        stack.extend(children.get(pid, []))
+    return ticks, pages * os.sysconf("SC_PAGE_SIZE")
+
+
+class ResourceSampler:
+    """Samples CPU % and RSS of the backend process tree while a scenario runs."""
+
+    def __init__(self, pid: Optional[int], interval: float = 0.5):
+        self.pid = pid
+        self.interval = interval
+        self.cpu: list = []
+        self.rss_mb: list = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        hz = os.sysconf("SC_CLK_TCK")
+        ticks, _ = process_tree_usage(self.pid)
+        last = time.monotonic()
+        while True:
+            await asyncio.sleep(self.interval)
+            now_ticks, rss = process_tree_usage(self.pid)
+            now = time.monotonic()
+            self.cpu.append((now_ticks - ticks) / hz / (now - last) * 100)
+            self.rss_mb.append(rss / (1024 * 1024))
+            ticks, last = now_ticks, now
+
+    async def __aenter__(self):
+        if self.pid and os.path.isdir("/proc"):
+            self._task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, *exc):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def result(self) -> Optional[dict]:
+        if not self.cpu:
+            return None
+        return {
+            "cpu_percent_mean": round(sum(self.cpu) / len(self.cpu), 1),
+            "cpu_percent_max": round(max(self.cpu), 1),
+            "rss_mb_mean": round(sum(self.rss_mb) / len(self.rss_mb), 1),
+            "rss_mb_max": round(max(self.rss_mb), 1),
+        }
+
+
+# ---------------------------------------------------------------------------
+# Scenarios
+# ---------------------------------------------------------------------------
+
+async def fake_api_calls(client: httpx.AsyncClient, fake_api: str) -> dict:
+    response = await client.get(f"{fake_api}/stats")
+    return response.json()
+
+
+async def navigate(client: httpx.AsyncClient, args, fixture: str):
+    response = await client.post(f"{args.backend}/navigate", json={"url": f"{args.fake_api}/fixtures/{fixture}"})
+    result = response.json()
+    if result.get("status") == "error":
+        raise RuntimeError(f"navigate failed: {result.get('message')}")
+
+
+def script_task(script: dict) -> str:
+    return f"bench:{script['name']} {script['description']}"
+
+
+async def bench_ai_start(client: httpx.AsyncClient, args, script: dict) -> dict:
+    """Start a task with /ai/start and poll /state until it finishes."""
+    await navigate(client, args, script["fixture"])
+    started = time.perf_counter()
+    response = await client.post(f"{args.backend}/ai/start", json={
+        "task": script_task(script),
+        "max_iterations": len(script["steps"]) + 5,
+    })
+    result = response.json()
+    if result.get("status") != "started":
+        raise RuntimeError(f"/ai/start failed: {result.get('message')}")
+
+    deadline = started + args.timeout
+    while True:
+        state = (await client.get(f"{args.backend}/state")).json()
+        if not state["ai_running"]:
+            break
+        if time.perf_counter() > deadline:
+            await client.post(f"{args.backend}/ai/stop")
+            raise RuntimeError("task timed out")
+        await asyncio.sleep(0.05)
+    wall = time.perf_counter() - started
+
+    record = (await client.get(f"{args.backend}/ai/tasks/{state['task_id']}")).json()
+    iterations = record.get("iteration_count", 0)
+    return {
+        "status": record.get("status"),
+        "wall_s": round(wall, 3),
+        "iterations": iterations,
+        "iterations_per_sec": round(iterations / wall, 3) if wall else None,
+        "model_calls": record.get("model_calls"),
+        "phases": {
+            name: {"p50": s["p50_ms"], "p95": s["p95_ms"], "mean": s["mean_ms"]}
+            for name, s in record.get("timing_summary", {}).items()
+        },
+    }
+
+
+async def bench_ai_execute(client: httpx.AsyncClient, args, script: dict) -> dict:
+    """Run a task through the /ai/execute SSE stream."""
+    await navigate(client, args, script["fixture"])
+    started = time.perf_counter()
+    first_event = None
+    iterations, errors = 0, []
+    phases: Dict[str, list] = {}
+    totals: list = []
+    async with client.stream("POST", f"{args.backend}/ai/execute", json={
+        "task": script_task(script),
+        "max_iterations": len(script["steps"]) + 5,
+    }, timeout=args.timeout) as response:
+        async for line in response.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            if first_event is None:
+                first_event = time.perf_counter() - started
+            try:
+                event = json.loads(line[6:])
+            except ValueError:
+                continue
+            if event.get("type") == "iteration":
+                iterations = event["count"]
+            elif event.get("type") == "ai_timing":
+                totals.append(event["total_ms"])
+                for name, ms in event["phases"].items():
+                    phases.setdefault(name, []).append(ms)
+            elif event.get("type") == "error" or "error" in event:
+                errors.append(event.get("message") or event.get("error"))
+    wall = time.perf_counter() - started
+
+    return {
+        "status": "error" if errors else "completed",
+        "errors": errors,
+        "wall_s": round(wall, 3),
+        "first_event_ms": round(first_event * 1000, 1) if first_event is not None else None,
+        "iterations": iterations,
+        "iterations_per_sec": round(iterations / wall, 3) if wall else None,
+        "phases": {name: summarize(values) for name, values in {**phases, "total": totals}.items()},
+    }
+
+
+async def watch_stream(args, duration: float, stats: dict):
+    """Count binary frames received by one WebSocket viewer for `duration` seconds."""
+    import websockets
+
+    url = args.backend.replace("http", "ws", 1) + "/ws/screenshot?protocol=binary"
+    latencies = []
+    async with websockets.connect(url, max_size=None) as ws:
+        deadline = time.monotonic() + duration
+        while (remaining := deadline - time.monotonic()) > 0:
+            try:
+                message = await asyncio.wait_for(ws.recv(), remaining)
+            except asyncio.TimeoutError:
+                break
+            if isinstance(message, str):
+                stats["text_messages"] += 1
+                continue
+            _, kind, _, timestamp, _, _, _, _, _ = FRAME_HEADER.unpack_from(message)
+            stats["frames"] += 1
+            stats["bytes"] += len(message)
+            stats["keyframes" if kind == FRAME_KIND_FULL else "deltas"] += 1
+            latencies.append((time.time() - timestamp) * 1000)
+    stats["latencies"].extend(latencies)
+
+
+async def bench_websocket(client: httpx.AsyncClient, args, script: Optional[dict]) -> dict:
+    """Stream to several binary viewers, optionally while a scripted task runs."""
+    await navigate(client, args, "animation.html" if script is None else script["fixture"])
+    per_viewer = [{"frames": 0, "bytes": 0, "keyframes": 0, "deltas": 0, "text_messages": 0, "latencies": []}
+                  for _ in range(args.viewers)]
+    watchers = [asyncio.create_task(watch_stream(args, args.ws_seconds, stats)) for stats in per_viewer]
+    if script is not None:
+        await asyncio.sleep(0.5)
+        await client.post(f"{args.backend}/ai/start", json={"task": script_task(script)})
+    await asyncio.gather(*watchers)
+    if script is not None:
+        await client.post(f"{args.backend}/ai/stop")
+
+    frames = [s["frames"] for s in per_viewer]
+    latencies = [ms for s in per_viewer for ms in s["latencies"]]
+    return {
+        "viewers": args.viewers,
+        "seconds": args.ws_seconds,
+        "fps_per_viewer": round(sum(frames) / len(frames) / args.ws_seconds, 2),
+        "fps_min_viewer": round(min(frames) / args.ws_seconds, 2),
+        "bytes_per_sec": round(sum(s["bytes"] for s in per_viewer) / args.ws_seconds),
+        "keyframes": sum(s["keyframes"] for s in per_viewer),
+        "deltas": sum(s["deltas"] for s in per_viewer),
+        "frame_latency_ms": summarize(latencies),
+    }
+
+
+BENCHMARKS = {
+    "ai-start": bench_ai_start,
+    "ai-execute": bench_ai_execute,
+    "websocket": bench_websocket,
+}
+
+
+async def run_scenarios(args) -> list:
+    results = []
+    async with httpx.AsyncClient(timeout=30) as client:
+        for scenario in args.scenarios:
+            scripts = [None] if scenario == "websocket" and not args.ws_with_task else args.scripts
+            for name in scripts:
+                script = load_script(name) if name else None
+                for run in range(args.repeat):
+                    label = f"{scenario}/{name or 'animation'}#{run + 1}"
+                    print(f"▶ {label}")
+                    calls_before = await fake_api_calls(client, args.fake_api)
+                    entry = {"scenario": scenario, "script": name, "run": run + 1}
+                    async with ResourceSampler(args.backend_pid) as sampler:
+                        try:
+                            entry.update(await BENCHMARKS[scenario](client, args, script))
+                        except Exception as e:
+                            entry.update(status="error", error=str(e))
+                            print(f"  ❌ {e}")
+                    calls_after = await fake_api_calls(client, args.fake_api)
+                    entry["fake_api_calls"] = {
+                        key: calls_after[key] - calls_before[key] for key in ("create", "retrieve")
+                    }
+                    entry["resources"] = sampler.result()
+                    results.append(entry)
+                    print(f"  {format_entry(entry)}")
+                    # 等後端回到 idle 再跑下一個
+                    await asyncio.sleep(args.pause)
+    return results
+
+
+def format_entry(entry: dict) -> str:
+    parts = []
+    for key in ("status", "wall_s", "iterations_per_sec", "fps_per_viewer", "bytes_per_sec"):
+        if entry.get(key) is not None:
+            parts.append(f"{key}={entry[key]}")
+    if entry.get("resources"):
+        parts.append(f"cpu={entry['resources']['cpu_percent_mean']}% rss={entry['resources']['rss_mb_max']}MB")
+    return " ".join(parts)
+
+
+# ---------------------------------------------------------------------------
+# Spawning the services
+# ---------------------------------------------------------------------------
+
+def wait_until_ready(url: str, timeout: float, process: subprocess.Popen):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with code {process.returncode}")
+        try:
+            if httpx.get(url, timeout=2).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"{url} did not become ready within {timeout}s")
+
+
+def spawn_services(args) -> list:
+    """Start the fake API and the backend; returns the processes to stop afterwards."""
+    fake_port = int(args.fake_api.rsplit(":", 1)[1])
+    backend_port = int(args.backend.rsplit(":", 1)[1])
+    fake = subprocess.Popen([
+        sys.executable, os.path.join(BENCH_DIR, "fake_responses_api.py"),
+        "--port", str(fake_port),
+        "--latency-ms", str(args.latency_ms),
+        "--jitter-ms", str(args.jitter_ms),
+        "--tail-ms", str(args.tail_ms),
+    ])
+    env = dict(
+        os.environ,
+        AZURE_ENDPOINT=f"{args.fake_api}/",
+        AZURE_API_KEY="benchmark",
+        INITIAL_URL=f"{args.fake_api}/fixtures/",
+        POOL_START_URL=f"{args.fake_api}/fixtures/",
+        TRAJECTORY_DIR="",
+    )
+    backend = subprocess.Popen([
+        sys.executable, "-m", "uvicorn", "computer_use_backend:app",
+        "--host", "127.0.0.1", "--port", str(backend_port), "--log-level", "warning",
+    ], cwd=REPO_DIR, env=env)
+    processes = [fake, backend]
+    try:
+        wait_until_ready(f"{args.fake_api}/stats", 30, fake)
+        wait_until_ready(f"{args.backend}/api/status", 120, backend)
+    except Exception:
+        stop_services(processes)
+        raise
+    args.backend_pid = args.backend_pid or backend.pid
+    return processes
+
+
+def stop_services(processes: list):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+# ---------------------------------------------------------------------------
+# Commands
+# ---------------------------------------------------------------------------
+
+def command_run(args):
+    args.backend = args.backend.rstrip("/")
+    args.fake_api = args.fake_api.rstrip("/")
+    processes = spawn_services(args) if args.spawn else []
+    try:
+        status = httpx.get(f"{args.backend}/api/status", timeout=10).json()
+        started = time.time()
+        results = asyncio.run(run_scenarios(args))
+    finally:
+        stop_services(processes)
+
+    revision = git_revision()
+    report = {
+        "meta": {
+            "started_at": started,
+            "finished_at": time.time(),
+            "git": revision,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "backend_status": status,
+            "options": {key: value for key, value in vars(args).items() if key != "func"},
+        },
+        "results": results,
+    }
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(started))
+        output = os.path.join(RESULTS_DIR, f"{stamp}-{revision['commit'] or 'unknown'}.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"📄 結果已寫入 {output}")
+
+
+def flatten(value, prefix: str = "") -> dict:
+    """Numeric leaves of a nested result, keyed by dotted path."""
+    if isinstance(value, dict):
+        flat = {}
+        for key, item in value.items():
+            flat.update(flatten(item, f"{prefix}.{key}" if prefix else key))
+        return flat
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {prefix: value}
+    return {}
+
+
+def average_runs(results: list) -> dict:
+    """Mean of every numeric metric per (scenario, script) over repeated runs."""
+    grouped: Dict[tuple, list] = {}
+    for entry in results:
+        grouped.setdefault((entry["scenario"], entry["script"]), []).append(flatten(entry))
+    averaged = {}
+    for key, runs in grouped.items():
+        metrics: Dict[str, list] = {}
+        for run in runs:
+            for name, value in run.items():
+                if name != "run":
+                    metrics.setdefault(name, []).append(value)
+        averaged[key] = {name: sum(values) / len(values) for name, values in metrics.items()}
+    return averaged
+
+
+def command_compare(args):
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(args.candidate, encoding="utf-8") as f:
+        candidate = json.load(f)
+    print(f"baseline:  {args.baseline} ({baseline['meta']['git']['commit']})")
+    print(f"candidate: {args.candidate} ({candidate['meta']['git']['commit']})")
+
+    before, after = average_runs(baseline["results"]), average_runs(candidate["results"])
+    for key in sorted(set(before) & set(after), key=str):
+        print(f"\n== {key[0]} / {key[1] or 'animation'}")
+        for name in sorted(set(before[key]) & set(after[key])):
+            if args.filter and args.filter not in name:
+                continue
+            old, new = before[key][name], after[key][name]
+            change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+            print(f"  {name:<40} {old:>12.2f} -> {new:>12.2f}  {change}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Computer-use backend benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="Run benchmarks and write a JSON report")
+    run.add_argument("--backend", default="http://127.0.0.1:8000")
+    run.add_argument("--fake-api", default="http://127.0.0.1:9000")
+    run.add_argument("--spawn", action="store_true", help="Start the fake API and the backend")
+    run.add_argument("--backend-pid", type=int, help="Backend PID for CPU / memory sampling")
+    run.add_argument("--latency-ms", type=float, default=300, help="Fake model latency (with --spawn)")
+    run.add_argument("--jitter-ms", type=float, default=0)
+    run.add_argument("--tail-ms", type=float, default=0, help="Streamed generation time after the computer_call (with --spawn)")
+    run.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    run.add_argument("--scripts", nargs="+", default=["form", "scroll", "cookie"])
+    run.add_argument("--repeat", type=int, default=3)
+    run.add_argument("--viewers", type=int, default=3, help="WebSocket viewers in the websocket scenario")
+    run.add_argument("--ws-seconds", type=float, default=10)
+    run.add_argument("--ws-with-task", action="store_true",
+                     help="Stream while a scripted task runs instead of the animation fixture")
+    run.add_argument("--timeout", type=float, default=300, help="Per-task timeout (seconds)")
+    run.add_argument("--pause", type=float, default=1.0, help="Pause between runs (seconds)")
+    run.add_argument("--output", help="Report path (default: benchmarks/results/<time>-<commit>.json)")
+    run.set_defaults(func=command_run)
+
+    compare = commands.add_parser("compare", help="Compare two reports")
+    compare.add_argument("baseline")
+    compare.add_argument("candidate")
+    compare.add_argument("--filter", help="Only show metrics whose name contains this text")
+    compare.set_defaults(func=command_compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,132 +1,1097 @@
 
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, contextmanager
 import base64
 import asyncio
-from typing import Optional, Set
-from playwright.async_api import async_playwright, TimeoutError
-from openai import OpenAI
+import gzip
+import hashlib
+import io
+from collections import deque
+from typing import Deque, Dict, Optional, Set
+from playwright.async_api import async_playwright
+from openai import AsyncOpenAI
+import httpx
 import time
 import json
+import math
 import os
 import socket
+import sqlite3
+import struct
+import subprocess
+import sys
+import threading
+import uuid
+from collections import OrderedDict
+from types import SimpleNamespace
+from urllib.parse import urlsplit
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow 為選用依賴，沒有時停用 tile delta 編碼
+    Image = None
 
 # Azure AI Configuration
 AZURE_ENDPOINT = os.getenv("AZURE_ENDPOINT", "https://your-azure-endpoint.openai.azure.com/")
 AZURE_API_KEY = os.getenv("AZURE_API_KEY", "your-azure-api-key-here")
 MODEL_DEPLOYMENT = "computer-use-preview"
 
+# Model client settings - 共用連線池與逾時設定
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "120"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "10"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+OPENAI_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_KEEPALIVE_CONNECTIONS", "10"))
+
 # Browser Use Azure Configuration (可使用不同的 Azure 實例)
 BROWSER_USE_AZURE_ENDPOINT = os.getenv("BROWSER_USE_AZURE_ENDPOINT")
 BROWSER_USE_AZURE_API_KEY = os.getenv("BROWSER_USE_AZURE_API_KEY")
 BROWSER_USE_MODEL = os.getenv("BROWSER_USE_MODEL")
+BROWSER_USE_HEALTH_TIMEOUT = float(os.getenv("BROWSER_USE_HEALTH_TIMEOUT", "5"))  # CDP 健康檢查逾時（秒）
 
 # Display settings - 從環境變數讀取或使用預設值
 DISPLAY_WIDTH = int(os.getenv("SCREEN_WIDTH", "1920"))
 DISPLAY_HEIGHT = int(os.getenv("SCREEN_HEIGHT", "1080"))
 INITIAL_URL = os.getenv("INITIAL_URL", "about:blank")
+
+# Model observation - 送給模型的截圖尺寸與格式（座標會換算回螢幕尺寸）
+MODEL_OBSERVATION_WIDTH = int(os.getenv("MODEL_OBSERVATION_WIDTH", str(DISPLAY_WIDTH)))
+MODEL_OBSERVATION_HEIGHT = int(os.getenv(
+    "MODEL_OBSERVATION_HEIGHT",
+    str(round(DISPLAY_HEIGHT * MODEL_OBSERVATION_WIDTH / DISPLAY_WIDTH))
+))
+MODEL_OBSERVATION_FORMAT = os.getenv("MODEL_OBSERVATION_FORMAT", "png")  # png / jpeg / webp
+MODEL_OBSERVATION_QUALITY = int(os.getenv("MODEL_OBSERVATION_QUALITY", "80"))
 MAX_AI_ITERATIONS = 40
+MODEL_STREAMING = os.getenv("MODEL_STREAMING", "1") == "1"  # 串流模型回應，computer_call 一完成就開始執行
+
+# Sessions - 同一個 Chromium 上的多個隔離 browser context
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", "4"))
+DEFAULT_SESSION_ID = "default"
+
+# Context pool - 預先建立並載入好起始頁的 browser context，讓新 session 立即可用
+POOL_MIN_SIZE = int(os.getenv("POOL_MIN_SIZE", "1"))  # 平時保持幾個預熱的 context
+POOL_MAX_SIZE = int(os.getenv("POOL_MAX_SIZE", "2"))  # 需求高時最多預熱幾個
+POOL_START_URL = os.getenv("POOL_START_URL", INITIAL_URL)
+POOL_STORAGE_STATE = os.getenv("POOL_STORAGE_STATE") or None  # Playwright storage state JSON 路徑
+POOL_MEMORY_LIMIT_MB = int(os.getenv("POOL_MEMORY_LIMIT_MB", "0"))  # 瀏覽器總記憶體超過時不再預熱，0 = 不限制
+POOL_IDLE_SHRINK = float(os.getenv("POOL_IDLE_SHRINK", "300"))  # 多久沒有取用就縮回 POOL_MIN_SIZE（秒）
+
+# Task scheduler - 排隊執行 /tasks 提交的任務
+SCHEDULER_WORKERS = int(os.getenv("SCHEDULER_WORKERS", "0"))  # 預設 session 以外的 worker session 數
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", "100"))
+
+# Process sharding - WORKER_PROCESSES > 1 時由前端 router 分派到多個 worker process
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "1"))
+WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", "8100"))
+WORKER_DISPLAYS = [d for d in os.getenv("WORKER_DISPLAYS", "").split(",") if d]  # 每個 worker 的 X display，未設定時共用 DISPLAY
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "0"))
+TASK_RECORD_LIMIT = int(os.getenv("TASK_RECORD_LIMIT", "100"))  # 保留最近幾個任務的紀錄（含 timing）
+
+# Action history - 記憶體只保留最近的紀錄，其餘寫入 SQLite
+HISTORY_MEMORY_LIMIT = int(os.getenv("HISTORY_MEMORY_LIMIT", "1000"))  # 每個 session 在記憶體中的筆數
+HISTORY_SPILL_BATCH = int(os.getenv("HISTORY_SPILL_BATCH", "100"))  # 累積幾筆溢出紀錄才寫入磁碟
+HISTORY_DB = os.getenv("HISTORY_DB", "history.sqlite3")  # 空字串 = 不保存溢出的紀錄
+
+# Trajectories - 記錄 AI 任務的動作軌跡，之後可不呼叫模型直接重播
+TRAJECTORY_DIR = os.getenv("TRAJECTORY_DIR", "trajectories")  # 空字串 = 不記錄
+TRAJECTORY_FRAMES = os.getenv("TRAJECTORY_FRAMES", "0") == "1"  # 每一步另存一張縮圖
+TRAJECTORY_THUMBNAIL_WIDTH = int(os.getenv("TRAJECTORY_THUMBNAIL_WIDTH", "320"))
+TRAJECTORY_DIVERGENCE = float(os.getenv("TRAJECTORY_DIVERGENCE", "0.15"))  # 畫面 hash 差異超過此比例就交還給模型
+
+# Action cache - 相同任務在相同畫面上直接沿用模型上次選的動作（需要 Pillow）
+ACTION_CACHE = os.getenv("ACTION_CACHE", "0") == "1"
+ACTION_CACHE_SIZE = int(os.getenv("ACTION_CACHE_SIZE", "1000"))  # 最多幾筆，超過時淘汰最久沒用到的
+ACTION_CACHE_TTL = float(os.getenv("ACTION_CACHE_TTL", "3600"))  # 秒
+ACTION_CACHE_MAX_DISTANCE = float(os.getenv("ACTION_CACHE_MAX_DISTANCE", "0.03"))  # 畫面 hash 差異在此比例內才算命中
+ACTION_CACHE_MAX_CHAIN = int(os.getenv("ACTION_CACHE_MAX_CHAIN", "10"))  # 連續幾個快取動作後一定回頭問模型
+
+# AI "type" action - auto: 一般輸入框直接插入文字，其他逐字按鍵；insert / keys 強制使用其中一種
+TYPE_STRATEGY = os.getenv("TYPE_STRATEGY", "auto")
+TYPE_DELAY_MS = int(os.getenv("TYPE_DELAY_MS", "20"))  # 逐字按鍵的間隔，0 = 不等待
+
+# Page settle detection - 取代動作後的固定 sleep
+SETTLE_TIMEOUT = float(os.getenv("SETTLE_TIMEOUT", "5.0"))  # 最長等待秒數
+SETTLE_QUIET_MS = int(os.getenv("SETTLE_QUIET_MS", "150"))  # DOM / scroll 需靜止多久才算穩定
+SETTLE_GRACE_MS = int(os.getenv("SETTLE_GRACE_MS", "50"))  # 動作後先等一下讓導航或請求開始
+SETTLE_MAX_REQUEST_AGE = float(os.getenv("SETTLE_MAX_REQUEST_AGE", "2.0"))  # 超過此秒數的請求視為長連線，不等待
+
+# Streaming settings - screencast (CDP push) 或 poll (定時截圖)
+STREAM_MODE = os.getenv("STREAM_MODE", "screencast")
+STREAM_POLL_INTERVAL = float(os.getenv("STREAM_POLL_INTERVAL", "0.05"))
+# Agent 截圖時等待 screencast 推送新幀的時間，逾時才自行截圖 (ms)
+FRAME_REUSE_WAIT_MS = int(os.getenv("FRAME_REUSE_WAIT_MS", "100"))
+SCREENCAST_FORMAT = os.getenv("SCREENCAST_FORMAT", "jpeg")  # jpeg / png
+SCREENCAST_QUALITY = int(os.getenv("SCREENCAST_QUALITY", "80"))
+SCREENCAST_MAX_WIDTH = int(os.getenv("SCREENCAST_MAX_WIDTH", str(DISPLAY_WIDTH)))
+SCREENCAST_MAX_HEIGHT = int(os.getenv("SCREENCAST_MAX_HEIGHT", str(DISPLAY_HEIGHT)))
+SCREENCAST_EVERY_NTH_FRAME = int(os.getenv("SCREENCAST_EVERY_NTH_FRAME", "1"))
+STREAM_DELTA = os.getenv("STREAM_DELTA", "1") == "1"  # binary 客戶端只傳送變動的 tiles
+STREAM_TILE_SIZE = int(os.getenv("STREAM_TILE_SIZE", "128"))
+STREAM_KEYFRAME_INTERVAL = int(os.getenv("STREAM_KEYFRAME_INTERVAL", "120"))  # 每 N 幀強制送一次完整畫面
+STREAM_DELTA_MAX_RATIO = float(os.getenv("STREAM_DELTA_MAX_RATIO", "0.5"))  # 變動 tiles 超過此比例時改送完整畫面
+STREAM_CLIENT_FRAME_QUEUE = int(os.getenv("STREAM_CLIENT_FRAME_QUEUE", "2"))  # 每個客戶端最多積壓幾幀
+STREAM_CLIENT_CONTROL_LIMIT = int(os.getenv("STREAM_CLIENT_CONTROL_LIMIT", "1000"))
+# Adaptive per-client streaming (congestion control)
+STREAM_MIN_INTERVAL = float(os.getenv("STREAM_MIN_INTERVAL", "0"))  # 0 = 每一幀都送
+STREAM_MAX_INTERVAL = float(os.getenv("STREAM_MAX_INTERVAL", "1.0"))
+STREAM_IDLE_INTERVAL = float(os.getenv("STREAM_IDLE_INTERVAL", "0.5"))  # poll 模式下畫面未變化時的截圖間隔
+STREAM_QUALITY_FLOOR = int(os.getenv("STREAM_QUALITY_FLOOR", "30"))
+STREAM_QUALITY_CEILING = int(os.getenv("STREAM_QUALITY_CEILING", str(SCREENCAST_QUALITY)))
+STREAM_SCALE_FLOOR = float(os.getenv("STREAM_SCALE_FLOOR", "0.5"))
+STREAM_RTT_TARGET = float(os.getenv("STREAM_RTT_TARGET", "0.3"))  # 秒
+
+# Human input coalescing - 合併 WebSocket 上連續的按鍵與捲動，0 = 不合併
+INPUT_COALESCE_MS = int(os.getenv("INPUT_COALESCE_MS", "30"))
+WS_COMMAND_QUEUE = int(os.getenv("WS_COMMAND_QUEUE", "256"))  # 每個連線排隊中指令的上限
 
 # Global browser instances
 playwright = None
 browser = None
-context = None
-page = None
 openai_client = None
 cdp_port = None
 cdp_url = None
 browser_use_session = None
+browser_use_llm = None  # 整個 process 共用的 browser-use LLM client（含 HTTP 連線池）
+
+# ============================================================================
+# Metrics - Prometheus text exposition format (/metrics)
+# ============================================================================
+
+def format_labels(names: tuple, values: tuple, extra: tuple = ()) -> str:
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Counter:
+    """Monotonic counter, one value per label combination."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self.values: Dict[tuple, float] = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def forget(self, label: str, value: str):
+        """Drop every series whose `label` equals `value` (e.g. a closed session)."""
+        index = self.labelnames.index(label)
+        self.values = {key: v for key, v in self.values.items() if key[index] != str(value)}
+
+    def render(self) -> list:
+        return [f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}"
+                for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    """Point-in-time value, set by a collector just before each scrape."""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+    def clear(self):
+        self.values = {}
+
+
+class Histogram:
+    """Cumulative histogram with fixed bucket bounds."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: tuple, labelnames: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.values: Dict[tuple, list] = {}  # labels -> [bucket counts, sum, count]
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[0][index] += 1
+                break
+        entry[1] += value
+        entry[2] += 1
+
+    forget = Counter.forget
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> list:
+        lines = []
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = format_labels(self.labelnames, key, (("le", format_value(bound)),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Metric families of this process plus collectors that refresh gauges on scrape."""
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.metrics: list = []
+        self.collectors: list = []
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, labelnames: tuple = ()) -> Counter:
+        return self._register(Counter(self.prefix + name, help_text, labelnames))
+
+    def gauge(self, name: str, help_text: str, labelnames: tuple = ()) -> Gauge:
+        return self._register(Gauge(self.prefix + name, help_text, labelnames))
+
+    def histogram(self, name: str, help_text: str, buckets: tuple, labelnames: tuple = ()) -> Histogram:
+        return self._register(Histogram(self.prefix + name, help_text, buckets, labelnames))
+
+    def collector(self, func):
+        self.collectors.append(func)
+        return func
+
+    def forget(self, label: str, value: str):
+        """Drop all series labelled `label=value` across the registry."""
+        for metric in self.metrics:
+            if label in metric.labelnames:
+                metric.forget(label, value)
+
+    def render(self) -> str:
+        for collect in self.collectors:
+            try:
+                collect()
+            except Exception as e:
+                print(f"⚠️ Metrics collector {collect.__name__} failed: {e}")
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+MODEL_LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0, 64.0)
+ITERATION_BUCKETS = (1, 2, 5, 10, 20, 30, 40, 60, 100)
+
+metrics = MetricsRegistry("computer_use_")
+# Streaming
+FRAMES_CAPTURED = metrics.counter("frames_captured_total", "Frames captured or pushed by the screencast.", ("session", "source"))
+FRAMES_BROADCAST = metrics.counter("frames_broadcast_total", "Frames broadcast to viewers.", ("session", "kind"))
+FRAMES_SKIPPED = metrics.counter("frames_skipped_total", "Captured frames skipped because nothing changed.", ("session",))
+FRAMES_DROPPED = metrics.counter("frames_dropped_total", "Queued frames dropped for slow viewers.", ("session",))
+BYTES_SENT = metrics.counter("bytes_sent_total", "Bytes sent to WebSocket viewers.", ("session", "protocol"))
+CAPTURE_SECONDS = metrics.histogram("capture_seconds", "page.screenshot duration.", LATENCY_BUCKETS, ("session",))
+ENCODE_SECONDS = metrics.histogram("encode_seconds", "Frame encoding duration.", LATENCY_BUCKETS, ("stage",))
+# Viewers
+VIEWERS = metrics.gauge("viewers", "Connected WebSocket viewers.", ("session", "protocol"))
+VIEWER_QUEUE_DEPTH = metrics.gauge("viewer_queue_depth", "Messages waiting in viewers' send queues, summed per session.", ("session", "queue"))
+VIEWER_FRAME_LAG = metrics.gauge("viewer_frame_lag_seconds", "Longest time the last frame spent queued for any viewer of a session.", ("session",))
+# Agent
+MODEL_CALL_SECONDS = metrics.histogram("model_call_seconds", "Responses API call latency.", MODEL_LATENCY_BUCKETS, ("call",))
+MODEL_CALL_ERRORS = metrics.counter("model_call_errors_total", "Failed Responses API calls.", ("call",))
+AGENT_PHASE_SECONDS = metrics.histogram("agent_phase_seconds", "Time per phase of an agent iteration.", MODEL_LATENCY_BUCKETS, ("phase",))
+TASK_ITERATIONS = metrics.histogram("task_iterations", "Iterations per finished task.", ITERATION_BUCKETS, ("kind",))
+TASKS_FINISHED = metrics.counter("tasks_total", "Finished tasks by outcome.", ("kind", "status"))
+TEXT_ENTRY_SECONDS = metrics.histogram("text_entry_seconds", "AI type action duration by text entry path.", MODEL_LATENCY_BUCKETS, ("path",))
+INPUT_EVENTS = metrics.counter("input_events_total", "Human input events from viewers, executed or merged into another.", ("session", "result"))
+# Browser
+SESSIONS_OPEN = metrics.gauge("sessions", "Open sessions.")
+BROWSER_CONTEXTS = metrics.gauge("browser_contexts", "Browser contexts, including pre-warmed ones.")
+BROWSER_PAGES = metrics.gauge("browser_pages", "Open pages per session.", ("session",))
+POOL_READY = metrics.gauge("pool_ready_contexts", "Pre-warmed contexts ready for new sessions.")
+PROCESS_MEMORY = metrics.gauge("process_tree_resident_memory_bytes", "RSS of the backend, Playwright driver and Chromium.")
+
+# Per-session state for AI/Human arbitration
+def new_session_state() -> dict:
+    return {
+        "mode": "idle",       # idle / ai / human / browser-use
+        "last_human": 0,      # last human action timestamp
+        "task": None,         # current AI task
+        "ai_running": False,  # is AI currently executing
+        "browser_use_running": False,  # is browser-use currently executing
+        "current_response_id": None,  # current AI response ID
+        "iteration_count": 0,  # current iteration
+        "model_calls": {"create": 0, "retrieve": 0},  # model API calls for the current task
+        "task_id": None,      # id of the current / last task record
+    }
+
+# Recent task records (timings, outcome), oldest first
+task_records: "OrderedDict[str, dict]" = OrderedDict()
+
+# Binary frame protocol (/ws/screenshot?protocol=binary)
+# Header (big-endian): version, kind, seq, timestamp, width, height, mode, flags, format
+# 後面緊接原始 JPEG / PNG / WebP bytes；控制與 AI 訊息仍使用 JSON text frame
+FRAME_HEADER = struct.Struct("!BBIdHHBBB")
+FRAME_PROTOCOL_VERSION = 1
+FRAME_KIND_FULL = 1
+FRAME_KIND_DELTA = 2
+FRAME_FLAG_URL_CHANGED = 0x01
+FRAME_FORMATS = {"jpeg": 1, "png": 2, "webp": 3}
+FRAME_MODES = {"idle": 0, "ai": 1, "human": 2, "browser-use": 3}
+WS_PROTOCOLS = ("json", "binary")
+
+# Delta body (kind = 2): image width, image height, rect count,
+# 然後每個 rect 為 x, y, w, h, length + 該區塊的 JPEG bytes (座標為圖片像素)
+DELTA_BODY_HEADER = struct.Struct("!HHH")
+DELTA_RECT_HEADER = struct.Struct("!HHHHI")
+
+
+def encode_frame_packet(frame: dict, image: bytes, seq: int, url_changed: bool,
+                        kind: int = FRAME_KIND_FULL) -> bytes:
+    """Pack a screenshot frame (or delta body) into a binary WebSocket message."""
+    image_format = frame["format"] if kind == FRAME_KIND_FULL else "jpeg"
+    header = FRAME_HEADER.pack(
+        FRAME_PROTOCOL_VERSION,
+        kind,
+        seq & 0xFFFFFFFF,
+        float(frame["timestamp"]),
+        frame["width"],
+        frame["height"],
+        FRAME_MODES.get(frame["mode"], 0),
+        FRAME_FLAG_URL_CHANGED if url_changed else 0,
+        FRAME_FORMATS.get(image_format, 0),
+    )
+    return header + image
+
+
+class TileDeltaEncoder:
+    """Hash fixed-size tiles of each frame and encode only the changed regions.
+
+    encode() returns ("skip", None) for frames identical to the previous one,
+    ("key", None) when a full frame should be sent, or ("delta", body) with
+    the changed tiles packed as DELTA_BODY_HEADER + rects.
+    """
+
+    def __init__(self, tile_size: int = 128, keyframe_interval: int = 120,
+                 max_changed_ratio: float = 0.5, quality: int = 80):
+        self.tile_size = tile_size
+        self.keyframe_interval = keyframe_interval
+        self.max_changed_ratio = max_changed_ratio
+        self.quality = quality
+        self.reset()
+
+    def reset(self):
+        self.last_digest: Optional[bytes] = None
+        self.tile_hashes: Optional[list] = None
+        self.size = None
+        self.frames_since_keyframe = 0
+
+    def _hash_tiles(self, img) -> list:
+        width, height = img.size
+        ts = self.tile_size
+        return [
+            hashlib.blake2b(img.crop((x, y, min(x + ts, width), min(y + ts, height))).tobytes(),
+                            digest_size=8).digest()
+            for y in range(0, height, ts)
+            for x in range(0, width, ts)
+        ]
+
+    def encode(self, image: bytes):
+        digest = hashlib.blake2b(image, digest_size=16).digest()
+        if digest == self.last_digest:
+            return "skip", None
+        self.last_digest = digest
+
+        img = Image.open(io.BytesIO(image)).convert("RGB")
+        hashes = self._hash_tiles(img)
+        previous, self.tile_hashes = self.tile_hashes, hashes
+
+        if previous is None or img.size != self.size or self.frames_since_keyframe >= self.keyframe_interval:
+            self.size = img.size
+            self.frames_since_keyframe = 0
+            return "key", None
+
+        changed = [i for i, (old, new) in enumerate(zip(previous, hashes)) if old != new]
+        if not changed:
+            return "skip", None
+        if len(changed) > self.max_changed_ratio * len(hashes):
+            self.frames_since_keyframe = 0
+            return "key", None
+
+        self.frames_since_keyframe += 1
+        width, height = img.size
+        ts = self.tile_size
+        cols = (width + ts - 1) // ts
+
+        # 合併同一列相鄰的變動 tiles，減少 rect 數量
+        runs = []
+        for index in changed:
+            row, col = divmod(index, cols)
+            if runs and runs[-1][0] == row and runs[-1][2] == col - 1:
+                runs[-1][2] = col
+            else:
+                runs.append([row, col, col])
+
+        parts = [DELTA_BODY_HEADER.pack(width, height, len(runs))]
+        for row, first_col, last_col in runs:
+            x, y = first_col * ts, row * ts
+            w = min((last_col + 1) * ts, width) - x
+            h = min(y + ts, height) - y
+            buffer = io.BytesIO()
+            img.crop((x, y, x + w, y + h)).save(buffer, format="JPEG", quality=self.quality)
+            data = buffer.getvalue()
+            parts.append(DELTA_RECT_HEADER.pack(x, y, w, h, len(data)))
+            parts.append(data)
+        return "delta", b"".join(parts)
+
+
+class ScreencastEngine:
+    """Push-based frame source built on Chromium's Page.startScreencast.
+
+    Frames are only produced when the compositor paints, so an idle page
+    costs (almost) nothing. Each frame must be acked before Chromium sends
+    the next one.
+    """
+
+    def __init__(self, image_format: str = "jpeg", quality: int = 80,
+                 max_width: int = 0, max_height: int = 0, every_nth_frame: int = 1):
+        self.image_format = image_format
+        self.quality = quality
+        self.max_width = max_width
+        self.max_height = max_height
+        self.every_nth_frame = every_nth_frame
+        self.page = None
+        self.cdp = None
+        self.latest_frame: Optional[dict] = None
+        self.frame_event = asyncio.Event()
+
+    @property
+    def active(self) -> bool:
+        return self.cdp is not None and self.page is not None and not self.page.is_closed()
+
+    @property
+    def full_size(self) -> bool:
+        """Whether pushed frames are at display resolution (not capped by maxWidth/maxHeight)."""
+        return (not self.max_width or self.max_width >= DISPLAY_WIDTH) and \
+            (not self.max_height or self.max_height >= DISPLAY_HEIGHT)
+
+    async def start(self, target_page):
+        """Attach a CDP session to the page and start the screencast."""
+        await self.stop()
+
+        cdp = await target_page.context.new_cdp_session(target_page)
+        cdp.on("Page.screencastFrame", lambda params: self._on_frame(cdp, params))
+
+        params = {
+            "format": self.image_format,
+            "everyNthFrame": max(1, self.every_nth_frame),
+        }
+        if self.image_format == "jpeg":
+            params["quality"] = self.quality
+        if self.max_width:
+            params["maxWidth"] = self.max_width
+        if self.max_height:
+            params["maxHeight"] = self.max_height
+
+        await cdp.send("Page.startScreencast", params)
+        self.cdp = cdp
+        self.page = target_page
+        print(f"📺 Screencast 已啟動: {params}")
+
+    async def stop(self):
+        """Stop the screencast and detach the CDP session."""
+        cdp, self.cdp = self.cdp, None
+        self.page = None
+        self.latest_frame = None
+        self.frame_event.clear()
+        if not cdp:
+            return
+        try:
+            await cdp.send("Page.stopScreencast")
+        except Exception:
+            pass
+        try:
+            await cdp.detach()
+        except Exception:
+            pass
+
+    def _on_frame(self, cdp, params: dict):
+        # 先 ack，Chromium 收到 ack 後才會送下一幀
+        asyncio.create_task(self._ack(cdp, params.get("sessionId")))
+        if cdp is not self.cdp and self.cdp is not None:
+            return  # 舊 session 的殘留幀
+        self.latest_frame = params
+        self.frame_event.set()
+
+    async def _ack(self, cdp, session_id):
+        if not cdp or session_id is None:
+            return
+        try:
+            await cdp.send("Page.screencastFrameAck", {"sessionId": session_id})
+        except Exception:
+            pass  # session 已關閉
+
+    async def next_frame(self, timeout: float) -> Optional[dict]:
+        """Wait for the next pushed frame. Returns None if nothing was painted."""
+        try:
+            await asyncio.wait_for(self.frame_event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        self.frame_event.clear()
+        return self.latest_frame
+
+
+def encode_json_message(message: dict) -> str:
+    """Serialize a message once, the same way WebSocket.send_json would."""
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+
+
+def encode_scaled_frame(image: bytes, scale: float, quality: int) -> bytes:
+    """Re-encode a frame as JPEG at a reduced scale / quality."""
+    img = Image.open(io.BytesIO(image)).convert("RGB")
+    if scale < 1.0:
+        size = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+        img = img.resize(size, Image.BILINEAR)
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+class StreamController:
+    """Per-client congestion controller for the screenshot stream.
+
+    Looks at send completion time, ping/pong RTT and dropped frames, and
+    picks a frame interval, resolution scale and JPEG quality for the
+    client. Backs off multiplicatively when congested and recovers step by
+    step (interval first, then scale, then quality) when the link is clear.
+    """
+
+    ADJUST_PERIOD = 0.5  # 秒
+    INTERVAL_STEP = 0.1
+    SCALE_STEP = 0.25
+    QUALITY_STEP = 10
+
+    def __init__(self, min_interval: float = 0.0, max_interval: float = 1.0,
+                 quality_floor: int = 30, quality_ceiling: int = 80,
+                 scale_floor: float = 0.5, rtt_target: float = 0.3):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        # 沒有 Pillow 時無法重新編碼，只調整幀率
+        self.quality_floor = quality_floor if Image is not None else quality_ceiling
+        self.quality_ceiling = quality_ceiling
+        self.scale_floor = scale_floor if Image is not None else 1.0
+        self.rtt_target = rtt_target
+
+        self.interval = min_interval
+        self.scale = 1.0
+        self.quality = quality_ceiling
+        self.send_time = 0.0  # EWMA of frame send completion time
+        self.rtt: Optional[float] = None
+        self.congested = False
+        self.last_sent = 0.0
+        self.last_adjust = 0.0
+        self.last_dropped = 0
+
+    @property
+    def full_quality(self) -> bool:
+        return self.scale >= 1.0 and self.quality >= self.quality_ceiling
+
+    @property
+    def level(self) -> Optional[tuple]:
+        """(scale, quality) to re-encode at, or None for the original frame."""
+        if self.full_quality:
+            return None
+        return (self.scale, self.quality)
+
+    def record_send(self, duration: float):
+        self.send_time = duration if not self.send_time else self.send_time * 0.8 + duration * 0.2
+
+    def record_rtt(self, rtt: float):
+        self.rtt = rtt if self.rtt is None else self.rtt * 0.7 + rtt * 0.3
+
+    def should_send(self, now: float) -> bool:
+        return now - self.last_sent >= self.interval
+
+    def mark_sent(self, now: float):
+        self.last_sent = now
+
+    def adjust(self, now: float, frames_dropped: int):
+        if now - self.last_adjust < self.ADJUST_PERIOD:
+            return
+        self.last_adjust = now
+
+        dropped = frames_dropped > self.last_dropped
+        self.last_dropped = frames_dropped
+        budget = max(self.interval, self.INTERVAL_STEP)
+        self.congested = (
+            dropped
+            or self.send_time > budget * 0.5
+            or (self.rtt is not None and self.rtt > self.rtt_target)
+        )
+
+        if self.congested:
+            self.interval = min(max(self.interval * 1.5, self.INTERVAL_STEP), self.max_interval)
+            self.scale = max(self.scale - self.SCALE_STEP, self.scale_floor)
+            self.quality = max(self.quality - self.QUALITY_STEP, self.quality_floor)
+        elif self.interval > self.min_interval:
+            self.interval = self.interval * 0.75
+            if self.interval < self.INTERVAL_STEP:
+                self.interval = self.min_interval
+        elif self.scale < 1.0:
+            self.scale = min(self.scale + self.SCALE_STEP, 1.0)
+        elif self.quality < self.quality_ceiling:
+            self.quality = min(self.quality + self.QUALITY_STEP, self.quality_ceiling)
+
+    def snapshot(self) -> dict:
+        return {
+            "interval_ms": round(self.interval * 1000),
+            "scale": self.scale,
+            "quality": self.quality,
+            "congested": self.congested,
+            "send_time_ms": round(self.send_time * 1000, 1),
+            "rtt_ms": round(self.rtt * 1000, 1) if self.rtt is not None else None,
+        }
+
+
+class ClientChannel:
+    """Per-viewer send queue drained by its own writer task.
+
+    Control / AI messages are always delivered in order. Frames go into a
+    small bounded queue that drops the oldest frame when the viewer falls
+    behind, so one slow client never stalls the others.
+    """
+
+    def __init__(self, websocket: WebSocket, protocol: str, frame_queue_size: int,
+                 control_queue_limit: int, on_close, session_id: str = DEFAULT_SESSION_ID):
+        self.websocket = websocket
+        self.protocol = protocol
+        self.session_id = session_id
+        self.control: Deque = deque()
+        self.frames: Deque = deque(maxlen=max(1, frame_queue_size))
+        self.control_queue_limit = control_queue_limit
+        self.wakeup = asyncio.Event()
+        self.on_close = on_close
+        self.closed = False
+        self.connected_at = time.time()
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.messages_sent = 0
+        self.bytes_sent = 0
+        self.last_send_duration = 0.0
+        self.frame_lag = 0.0  # 最近一幀從進佇列到送出所花的時間
+        self.in_sync = False  # 是否收到了上一個廣播幀（delta 的基底）
+        self.controller = StreamController(
+            min_interval=STREAM_MIN_INTERVAL,
+            max_interval=STREAM_MAX_INTERVAL,
+            quality_floor=STREAM_QUALITY_FLOOR,
+            quality_ceiling=STREAM_QUALITY_CEILING,
+            scale_floor=STREAM_SCALE_FLOOR,
+            rtt_target=STREAM_RTT_TARGET,
+        )
+        self.task = asyncio.create_task(self.run())
+
+    def put_control(self, payload):
+        if self.closed:
+            return
+        if len(self.control) >= self.control_queue_limit:
+            # 控制訊息不能丟，積壓過多代表客戶端已失去回應
+            print(f"⚠️ WebSocket 客戶端 {id(self.websocket)} 積壓 {len(self.control)} 則訊息，中斷連線")
+            self.close()
+            asyncio.create_task(self._close_socket())
+            return
+        self.control.append(payload)
+        self.wakeup.set()
+
+    def put_frame(self, payload):
+        if self.closed:
+            return
+        if len(self.frames) == self.frames.maxlen:
+            self.frames_dropped += 1
+            FRAMES_DROPPED.inc(session=self.session_id)
+        self.frames.append((payload, time.monotonic()))
+        self.wakeup.set()
+
+    def replace_frames(self, payload):
+        """Discard any pending frames and queue this one (used for keyframes)."""
+        if self.closed:
+            return
+        if self.frames:
+            self.frames_dropped += len(self.frames)
+            FRAMES_DROPPED.inc(len(self.frames), session=self.session_id)
+        self.frames.clear()
+        self.put_frame(payload)
+
+    @property
+    def frames_full(self) -> bool:
+        return len(self.frames) == self.frames.maxlen
+
+    async def _send(self, payload):
+        start = time.monotonic()
+        if isinstance(payload, bytes):
+            await self.websocket.send_bytes(payload)
+        else:
+            await self.websocket.send_text(payload)
+        self.last_send_duration = time.monotonic() - start
+        self.bytes_sent += len(payload)
+        BYTES_SENT.inc(len(payload), session=self.session_id, protocol=self.protocol)
+
+    async def run(self):
+        try:
+            while not self.closed:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                while self.control or self.frames:
+                    if self.control:
+                        await self._send(self.control.popleft())
+                        self.messages_sent += 1
+                    else:
+                        payload, enqueued_at = self.frames.popleft()
+                        await self._send(payload)
+                        self.frames_sent += 1
+                        self.frame_lag = time.monotonic() - enqueued_at
+                        self.controller.record_send(self.last_send_duration)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            pass  # 連線已中斷
+        finally:
+            self.closed = True
+            self.on_close(self.websocket)
+
+    async def _close_socket(self):
+        try:
+            await self.websocket.close(code=1013)  # Try Again Later
+        except Exception:
+            pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.task and not self.task.done():
+            self.task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "client_id": id(self.websocket),
+            "protocol": self.protocol,
+            "connected_for": round(time.time() - self.connected_at, 1),
+            "pending_control": len(self.control),
+            "pending_frames": len(self.frames),
+            "frames_sent": self.frames_sent,
+            "frames_dropped": self.frames_dropped,
+            "messages_sent": self.messages_sent,
+            "bytes_sent": self.bytes_sent,
+            "frame_lag_ms": round(self.frame_lag * 1000, 1),
+            "last_send_ms": round(self.last_send_duration * 1000, 1),
+            "controller": self.controller.snapshot(),
+        }
 
-# Global state for AI/Human arbitration
-state = {
-    "mode": "idle",       # idle / ai / human / browser-use
-    "last_human": 0,      # last human action timestamp
-    "task": None,         # current AI task
-    "ai_running": False,  # is AI currently executing
-    "browser_use_running": False,  # is browser-use currently executing
-    "current_response_id": None,  # current AI response ID
-    "iteration_count": 0,  # current iteration
-    "last_screenshot": None,  # cache last successful screenshot
-    "history": [],  # action history
-}
 
 # WebSocket connection manager
 class ConnectionManager:
-    def __init__(self):
+    def __init__(self, session: "Session"):
+        self.session = session
         self.active_connections: Set[WebSocket] = set()
+        self.channels: Dict[WebSocket, ClientChannel] = {}
         self.streaming_task: Optional[asyncio.Task] = None
         self.streaming = False
+        self.stream_mode = STREAM_MODE
+        self.last_frame: Optional[dict] = None
+        self.frame_seq = 0
+        self.last_url: Optional[str] = None
+        self.frames_skipped = 0
+        self.unchanged_streak = 0
+        self.delta_encoder = None
+        if STREAM_DELTA and Image is not None:
+            self.delta_encoder = TileDeltaEncoder(
+                tile_size=STREAM_TILE_SIZE,
+                keyframe_interval=STREAM_KEYFRAME_INTERVAL,
+                max_changed_ratio=STREAM_DELTA_MAX_RATIO,
+                quality=SCREENCAST_QUALITY,
+            )
+        self.screencast = ScreencastEngine(
+            image_format=SCREENCAST_FORMAT,
+            quality=SCREENCAST_QUALITY,
+            max_width=SCREENCAST_MAX_WIDTH,
+            max_height=SCREENCAST_MAX_HEIGHT,
+            every_nth_frame=SCREENCAST_EVERY_NTH_FRAME,
+        )
 
-    async def connect(self, websocket: WebSocket):
+    async def connect(self, websocket: WebSocket, protocol: str = "json"):
         await websocket.accept()
+        if protocol not in WS_PROTOCOLS:
+            protocol = "json"
+        channel = ClientChannel(
+            websocket,
+            protocol,
+            frame_queue_size=STREAM_CLIENT_FRAME_QUEUE,
+            control_queue_limit=STREAM_CLIENT_CONTROL_LIMIT,
+            on_close=self.disconnect,
+            session_id=self.session.id,
+        )
         self.active_connections.add(websocket)
+        self.channels[websocket] = channel
+        channel.put_control(encode_json_message({
+            "type": "hello",
+            "protocol": protocol,
+            "frame_header": FRAME_HEADER.format,
+            "frame_version": FRAME_PROTOCOL_VERSION
+        }))
+        # Screencast 只在畫面變化時推送，新連線先送最後一幀
+        if self.last_frame:
+            self.enqueue_frame(channel, self.last_frame, url_changed=True)
         # Start streaming if not already started
         if not self.streaming and not self.streaming_task:
             self.streaming_task = asyncio.create_task(self.stream_screenshots())
 
     def disconnect(self, websocket: WebSocket):
         self.active_connections.discard(websocket)
+        channel = self.channels.pop(websocket, None)
+        if channel:
+            channel.close()
         # Stop streaming if no connections
         if not self.active_connections and self.streaming_task:
             self.streaming = False
 
-    async def broadcast(self, message: dict):
-        """Broadcast message to all connected clients."""
-        disconnected = set()
-        for connection in self.active_connections:
+    async def close_all(self, code: int = 1001):
+        """Close every viewer connection (e.g. when the session is deleted)."""
+        for websocket, channel in list(self.channels.items()):
+            channel.close()
             try:
-                await connection.send_json(message)
+                await websocket.close(code=code)
             except Exception:
-                disconnected.add(connection)
-        
-        # Clean up disconnected clients
-        for conn in disconnected:
-            self.active_connections.discard(conn)
+                pass
+            self.disconnect(websocket)
+        self.streaming = False
+        await self.screencast.stop()
+
+    async def broadcast(self, message: dict):
+        """Broadcast message to all connected clients (serialized once, never dropped)."""
+        payload = encode_json_message(message)
+        for channel in list(self.channels.values()):
+            channel.put_control(payload)
+
+    async def send(self, websocket: WebSocket, message: dict):
+        """Queue a control message for a single client."""
+        channel = self.channels.get(websocket)
+        if channel:
+            channel.put_control(encode_json_message(message))
+
+    def enqueue_frame(self, channel: ClientChannel, frame: dict, url_changed: bool = False):
+        """Queue a single frame for one client, e.g. the last frame for a new viewer."""
+        if channel.protocol == "binary":
+            if url_changed:
+                channel.put_control(encode_json_message({"type": "url", "url": frame["url"]}))
+            image = base64.b64decode(frame["image"])
+            channel.put_frame(encode_frame_packet(frame, image, self.frame_seq, url_changed))
+        else:
+            channel.put_frame(encode_json_message(frame))
+
+    async def broadcast_frame(self, frame: dict) -> bool:
+        """Broadcast a screenshot frame, encoding each wire format only once.
+
+        Binary clients receive only the changed tiles when a delta encoder is
+        available. Returns False if the frame was identical and skipped.
+        """
+        image = base64.b64decode(frame["image"])
+        kind, delta_body = "key", None
+        if self.delta_encoder:
+            try:
+                with ENCODE_SECONDS.time(stage="delta"):
+                    kind, delta_body = await asyncio.to_thread(self.delta_encoder.encode, image)
+            except Exception as e:
+                print(f"⚠️ Delta encoding failed, sending full frame: {e}")
+                self.delta_encoder.reset()
+        if kind == "skip":
+            self.frames_skipped += 1
+            FRAMES_SKIPPED.inc(session=self.session.id)
+            return False
+        FRAMES_BROADCAST.inc(session=self.session.id, kind=kind)
+
+        self.frame_seq += 1
+        url_changed = frame["url"] != self.last_url
+        self.last_url = frame["url"]
+
+        now = time.monotonic()
+        variants = {}  # level -> 重新編碼後的幀
+        json_payloads = {}  # level -> payload
+        binary_payloads = {}
+        delta_payload = None
+        url_payload = None
+        for channel in list(self.channels.values()):
+            controller = channel.controller
+            controller.adjust(now, channel.frames_dropped)
+
+            if channel.protocol == "binary" and url_changed:
+                if url_payload is None:
+                    url_payload = encode_json_message({"type": "url", "url": frame["url"]})
+                channel.put_control(url_payload)
+
+            if not controller.should_send(now):
+                channel.in_sync = False
+                continue
+            controller.mark_sent(now)
+            level = controller.level
+
+            if channel.protocol == "binary":
+                # Delta 需要前一幀作為基底，不同步或佇列滿了就改送 keyframe
+                if level is None and kind == "delta" and channel.in_sync and not channel.frames_full:
+                    if delta_payload is None:
+                        delta_payload = encode_frame_packet(frame, delta_body, self.frame_seq,
+                                                            url_changed, kind=FRAME_KIND_DELTA)
+                    channel.put_frame(delta_payload)
+                else:
+                    if level not in binary_payloads:
+                        variant, variant_image = await self.frame_variant(frame, image, level, variants)
+                        binary_payloads[level] = encode_frame_packet(variant, variant_image,
+                                                                     self.frame_seq, url_changed)
+                    channel.replace_frames(binary_payloads[level])
+                channel.in_sync = level is None
+            else:
+                if level not in json_payloads:
+                    variant, _ = await self.frame_variant(frame, image, level, variants)
+                    json_payloads[level] = encode_json_message(variant)
+                channel.put_frame(json_payloads[level])
+        return True
+
+    async def frame_variant(self, frame: dict, image: bytes, level: Optional[tuple], cache: dict):
+        """Frame re-encoded at a controller level (scale, quality); None returns the original."""
+        if level is None or Image is None:
+            return frame, image
+        if level not in cache:
+            with ENCODE_SECONDS.time(stage="scale"):
+                scaled = await asyncio.to_thread(encode_scaled_frame, image, *level)
+            cache[level] = ({**frame, "image": base64.b64encode(scaled).decode("utf-8"), "format": "jpeg"}, scaled)
+        return cache[level]
+
+    @property
+    def idle(self) -> bool:
+        """True when the last few captured frames had no visible change."""
+        return self.unchanged_streak >= 3
+
+    def client_stats(self) -> list:
+        """Per-client queue depth, drops and lag."""
+        return [channel.stats() for channel in self.channels.values()]
+
+    async def poll_frame(self) -> dict:
+        """Capture one frame, reusing any frame captured within the last poll interval."""
+        page = self.session.page
+        frame = await self.session.frame_store.get(after=time.monotonic() - STREAM_POLL_INTERVAL)
+        return {
+            "type": "screenshot",
+            "image": frame["image"],
+            "format": frame["format"],
+            "width": DISPLAY_WIDTH,
+            "height": DISPLAY_HEIGHT,
+            "url": page.url if page else None,
+            "mode": self.session.state["mode"],
+            "timestamp": time.time()
+        }
+
+    async def screencast_frame(self) -> Optional[dict]:
+        """Wait for the next screencast frame, (re)attaching to the current page if needed."""
+        page = self.session.page
+        if page and (self.screencast.page is not page or not self.screencast.active):
+            await self.screencast.start(page)
+
+        frame = await self.screencast.next_frame(timeout=1.0)
+        if not frame:
+            return None
+
+        metadata = frame.get("metadata", {})
+        self.session.frame_store.publish(frame["data"], self.screencast.image_format,
+                            full_size=self.screencast.full_size)
+        return {
+            "type": "screenshot",
+            "image": frame["data"],
+            "format": self.screencast.image_format,
+            # 座標空間維持頁面 CSS 尺寸，圖片可能被 maxWidth/maxHeight 縮小
+            "width": int(metadata.get("deviceWidth") or DISPLAY_WIDTH),
+            "height": int(metadata.get("deviceHeight") or DISPLAY_HEIGHT),
+            "url": page.url if page else None,
+            "mode": self.session.state["mode"],
+            "timestamp": metadata.get("timestamp") or time.time()
+        }
 
     async def stream_screenshots(self):
         """Background task to continuously stream screenshots."""
         self.streaming = True
-        print(f"🎬 WebSocket 串流已啟動（{len(self.active_connections)} 個連接）")
+        print(f"🎬 [{self.session.id}] WebSocket 串流已啟動（{len(self.active_connections)} 個連接，模式: {self.stream_mode}）")
         
         frame_count = 0
         while self.streaming and self.active_connections:
             try:
-                # Take screenshot
-                screenshot_b64 = await take_screenshot_safe()
+                if self.stream_mode == "screencast":
+                    try:
+                        message = await self.screencast_frame()
+                    except Exception as e:
+                        # CDP 不可用時退回輪詢模式
+                        print(f"⚠️ Screencast 無法使用，改用輪詢模式: {e}")
+                        await self.screencast.stop()
+                        self.stream_mode = "poll"
+                        continue
+                    if message is None:
+                        continue
+                else:
+                    message = await self.poll_frame()
                 
                 # Broadcast to all connected clients
-                await self.broadcast({
-                    "type": "screenshot",
-                    "image": screenshot_b64,
-                    "width": DISPLAY_WIDTH,
-                    "height": DISPLAY_HEIGHT,
-                    "url": page.url if page else None,
-                    "mode": state["mode"],
-                    "timestamp": time.time()
-                })
-                
-                frame_count += 1
+                if await self.broadcast_frame(message):
+                    self.unchanged_streak = 0
+                    self.last_frame = message
+                    frame_count += 1
+                    
+                    # 每 300 幀報告一次狀態
+                    if frame_count % 300 == 0:
+                        print(f"📊 串流狀態: {frame_count} 幀已發送，{self.frames_skipped} 幀未變化略過，{len(self.active_connections)} 個連接")
                 
-                # 每 300 幀（約 10 秒）報告一次狀態
-                if frame_count % 300 == 0:
-                    print(f"📊 串流狀態: {frame_count} 幀已發送，{len(self.active_connections)} 個連接")
+                else:
+                    self.unchanged_streak += 1
                 
-                # Adjust FPS (20 FPS = ~50ms delay) - 降低頻率避免干擾頁面載入
-                await asyncio.sleep(0.05)
+                if self.stream_mode == "poll":
+                    # Adjust FPS (20 FPS = ~50ms delay) - 降低頻率避免干擾頁面載入
+                    # 畫面連續未變化時降到 idle 頻率
+                    await asyncio.sleep(STREAM_IDLE_INTERVAL if self.idle else STREAM_POLL_INTERVAL)
                 
             except Exception as e:
                 print(f"❌ Screenshot streaming error: {e}")
                 await asyncio.sleep(0.1)
         
+        await self.screencast.stop()
         self.streaming = False
         self.streaming_task = None
-        print(f"⏹ WebSocket 串流已停止（共發送 {frame_count} 幀）")
-
-manager = ConnectionManager()
+        print(f"⏹ [{self.session.id}] WebSocket 串流已停止（共發送 {frame_count} 幀）")
 
 
 
@@ -178,6 +1143,7 @@ KEY_MAPPING = {
 class AITaskRequest(BaseModel):
     task: str
     max_iterations: Optional[int] = MAX_AI_ITERATIONS
+    resume_response_id: Optional[str] = None  # 從既有的 response 繼續執行
 
 
 class BrowserUseTaskRequest(BaseModel):
@@ -189,16 +1155,40 @@ class NavigateRequest(BaseModel):
     url: str
 
 
+class ReplayRequest(BaseModel):
+    trajectory_id: str
+    fallback: Optional[bool] = True  # 畫面與紀錄不符時改由模型接手
+    max_iterations: Optional[int] = MAX_AI_ITERATIONS
+
+
+class TaskSubmitRequest(BaseModel):
+    task: str
+    kind: Optional[str] = "computer-use"  # computer-use / browser-use
+    priority: Optional[int] = 0  # 越大越優先
+    tenant: Optional[str] = "default"
+    max_iterations: Optional[int] = MAX_AI_ITERATIONS
+    resume_response_id: Optional[str] = None
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Lifespan context manager for startup and shutdown events."""
-    global playwright, browser, context, page, openai_client, cdp_port, cdp_url, browser_use_session
+    global playwright, browser, openai_client, cdp_port, cdp_url, browser_use_session
     
     # Startup
-    # Initialize OpenAI client
-    openai_client = OpenAI(
+    # Initialize async OpenAI client with a shared, pooled HTTP connection
+    # 模型呼叫不會阻塞 event loop，串流與人類輸入在 AI 思考時仍可運作
+    openai_client = AsyncOpenAI(
         base_url=AZURE_ENDPOINT,
-        api_key=AZURE_API_KEY
+        api_key=AZURE_API_KEY,
+        max_retries=OPENAI_MAX_RETRIES,
+        http_client=httpx.AsyncClient(
+            timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_KEEPALIVE_CONNECTIONS
+            )
+        )
     )
     print("OpenAI client initialized")
 
@@ -221,54 +1211,51 @@ async def lifespan(app: FastAPI):
             "--disable-infobars",
             "--no-default-browser-check",
             "--disable-popup-blocking",
+            # 其他 session 的視窗被遮住時仍要持續繪製與執行
+            "--disable-backgrounding-occluded-windows",
+            "--disable-renderer-backgrounding",
+            "--disable-background-timer-throttling",
             f"--remote-debugging-port={cdp_port}"
         ]
     )
 
-    context = await browser.new_context(
-        viewport={"width": DISPLAY_WIDTH, "height": DISPLAY_HEIGHT},
-        accept_downloads=True,
-        no_viewport=True,  # 不限制 viewport，使用全螢幕
-        # 啟用 cookie 和 storage
-        storage_state=None,  # 允許保存 cookies 和 localStorage
-        # 設定真實的 User-Agent，避免被識別為 bot
-        user_agent="Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36",
-        # 允許 JavaScript
-        java_script_enabled=True,
-        # 接受所有 cookies
-        bypass_csp=False,
-        # 忽略 HTTPS 錯誤
-        ignore_https_errors=True,
-        # 設定合理的 timeout
-        extra_http_headers={
-            "Accept-Language": "en-US,en;q=0.9,zh-TW;q=0.8,zh;q=0.7"
-        }
-    )
-
-    page = await context.new_page()
-    await page.goto(INITIAL_URL)
+    default_session = await sessions.create(DEFAULT_SESSION_ID)
+    sessions.pool.start()
+    scheduler.start()
     
     # Initialize browser-use session
     try:
-        from browser_use import BrowserSession
-        browser_use_session = BrowserSession(cdp_url=cdp_url)
+        browser_use_session = new_browser_use_session()
         print(f"✅ Browser-use session initialized with CDP: {cdp_url}")
+        if BROWSER_USE_MODEL:
+            get_browser_use_llm()
     except Exception as e:
         print(f"⚠️ Browser-use initialization failed: {e}")
         browser_use_session = None
-        
-    # Make browser_use_session available globally
-    globals()['browser_use_session'] = browser_use_session
     
-    print(f"✅ Browser initialized at {page.url}")
+    print(f"✅ Browser initialized at {default_session.page.url} (max sessions: {MAX_SESSIONS})")
     print(f"🖼  Screen size: {DISPLAY_WIDTH}x{DISPLAY_HEIGHT}")
+    if model_observation_enabled():
+        print(f"🧠 Model observation: {MODEL_OBSERVATION_WIDTH}x{MODEL_OBSERVATION_HEIGHT} {MODEL_OBSERVATION_FORMAT}")
+    elif (MODEL_OBSERVATION_WIDTH, MODEL_OBSERVATION_HEIGHT, MODEL_OBSERVATION_FORMAT) != (DISPLAY_WIDTH, DISPLAY_HEIGHT, "png"):
+        print("⚠️ MODEL_OBSERVATION_* 需要 Pillow，改用原始 PNG 截圖")
     print(f"🔗 CDP URL: {cdp_url}")
     
     yield
     
     # Shutdown
-    if context:
-        await context.close()
+    await scheduler.stop()
+    if browser_use_session:
+        try:
+            await browser_use_session.kill()
+        except Exception:
+            pass
+    await sessions.pool.stop()
+    await sessions.close_all()
+    if history_log:
+        history_log.close()
+    if openai_client:
+        await openai_client.close()
     if browser:
         await browser.close()
     if playwright:
@@ -308,85 +1295,1690 @@ async def serve_frontend():
         return HTMLResponse(content="<h1>Frontend not found. Please create static/index.html</h1>", status_code=404)
 
 
-def validate_coordinates(x: int, y: int) -> tuple:
-    """Ensure coordinates are within display bounds."""
+def model_observation_enabled() -> bool:
+    """Whether screenshots are resized / re-encoded before being sent to the model."""
+    if (MODEL_OBSERVATION_WIDTH, MODEL_OBSERVATION_HEIGHT) == (DISPLAY_WIDTH, DISPLAY_HEIGHT) \
+            and MODEL_OBSERVATION_FORMAT == "png":
+        return False
+    return Image is not None
+
+
+def observation_size() -> tuple:
+    """Display size advertised to the model."""
+    if model_observation_enabled():
+        return MODEL_OBSERVATION_WIDTH, MODEL_OBSERVATION_HEIGHT
+    return DISPLAY_WIDTH, DISPLAY_HEIGHT
+
+
+def computer_use_tool() -> dict:
+    """computer_use_preview tool definition sized to the model observation."""
+    width, height = observation_size()
+    return {
+        "type": "computer_use_preview",
+        "display_width": width,
+        "display_height": height,
+        "environment": "browser"
+    }
+
+
+def encode_model_observation(screenshot_b64: str, source_format: str = "png") -> tuple:
+    """Resize and re-encode a screenshot for the model.
+
+    Returns (data_url, payload_bytes).
+    """
+    if not model_observation_enabled():
+        return f"data:image/{source_format};base64,{screenshot_b64}", len(screenshot_b64)
+
+    img = Image.open(io.BytesIO(base64.b64decode(screenshot_b64)))
+    if img.size != (MODEL_OBSERVATION_WIDTH, MODEL_OBSERVATION_HEIGHT):
+        img = img.resize((MODEL_OBSERVATION_WIDTH, MODEL_OBSERVATION_HEIGHT), Image.LANCZOS)
+
+    image_format = MODEL_OBSERVATION_FORMAT.lower()
+    buffer = io.BytesIO()
+    if image_format == "png":
+        img.save(buffer, format="PNG", optimize=True)
+    else:
+        img.convert("RGB").save(buffer, format=image_format.upper(), quality=MODEL_OBSERVATION_QUALITY)
+    data = base64.b64encode(buffer.getvalue()).decode("utf-8")
+    return f"data:image/{image_format};base64,{data}", len(data)
+
+
+def scale_model_offset(dx: int, dy: int) -> tuple:
+    """Scale a distance (e.g. scroll offset) from observation to display pixels."""
+    width, height = observation_size()
+    return round(dx * DISPLAY_WIDTH / width), round(dy * DISPLAY_HEIGHT / height)
+
+
+def validate_coordinates(x: int, y: int, from_model: bool = False) -> tuple:
+    """Ensure coordinates are within display bounds.
+
+    With from_model=True the coordinates are first scaled from the model
+    observation size back to the display size.
+    """
+    if from_model:
+        width, height = observation_size()
+        x = round(x * DISPLAY_WIDTH / width)
+        y = round(y * DISPLAY_HEIGHT / height)
     return max(0, min(x, DISPLAY_WIDTH)), max(0, min(y, DISPLAY_HEIGHT))
 
 
-async def take_screenshot_safe():
-    """Take a screenshot with caching for failures."""
-    global state, page
-    
-    try:
-        # 檢查頁面是否正在導航或關閉
-        if not page or page.is_closed():
-            if state["last_screenshot"]:
-                return state["last_screenshot"]
-            raise Exception("Page is closed")
-        
-        # 直接截圖，不做複雜檢查
-        png = await page.screenshot(type="png", full_page=False, timeout=5000)
-        state["last_screenshot"] = base64.b64encode(png).decode("utf-8")
-        return state["last_screenshot"]
-    except Exception as e:
-        # 截圖失敗時使用緩存
-        if state["last_screenshot"]:
-            # 只在第一次失敗時 log
-            if not hasattr(take_screenshot_safe, '_last_error_logged'):
-                print(f"⚠️ Screenshot failed, using cache: {e}")
-                take_screenshot_safe._last_error_logged = True
-            return state["last_screenshot"]
-        # 沒有緩存時才拋出錯誤
-        print(f"❌ Screenshot failed and no cache: {e}")
-        raise
+# Injected into every document: tracks the last DOM mutation and scroll time
+SETTLE_INIT_SCRIPT = """
+(() => {
+    if (window.__cuSettle) return;
+    const s = { lastMutation: performance.now(), lastScroll: 0 };
+    new MutationObserver(() => { s.lastMutation = performance.now(); })
+        .observe(document, { subtree: true, childList: true, attributes: true, characterData: true });
+    const onScroll = () => { s.lastScroll = performance.now(); };
+    window.addEventListener('scroll', onScroll, { capture: true, passive: true });
+    window.addEventListener('scrollend', onScroll, { capture: true, passive: true });
+    window.__cuSettle = s;
+})();
+"""
 
+# Resolves once DOM mutations and scrolling have been quiet for quietMs
+# across two consecutive animation frames, or after maxMs
+SETTLE_WAIT_SCRIPT = """
+async ({ quietMs, maxMs }) => {
+    %s
+    const s = window.__cuSettle;
+    const start = performance.now();
+    const frame = () => new Promise((resolve) => {
+        const timer = setTimeout(() => resolve(performance.now()), 100);
+        requestAnimationFrame(() => { clearTimeout(timer); resolve(performance.now()); });
+    });
+    let stableFrames = 0;
+    while (performance.now() - start < maxMs) {
+        const now = await frame();
+        const quiet = now - Math.max(s.lastMutation, s.lastScroll) >= quietMs;
+        stableFrames = quiet ? stableFrames + 1 : 0;
+        if (stableFrames >= 2) return true;
+    }
+    return false;
+}
+""" % SETTLE_INIT_SCRIPT
 
-async def run_ai_task_background(task: str):
-    """Run AI task in background and broadcast progress via WebSocket."""
-    global page
-    
-    try:
-        # Take initial screenshot
-        screenshot_b64 = await take_screenshot_safe()
+
+class PageActivityTracker:
+    """Counts in-flight requests and main-frame navigations for one page."""
+
+    IGNORED_RESOURCE_TYPES = ("websocket", "eventsource", "media")
+
+    def __init__(self, target_page):
+        self.page = target_page
+        self.inflight: Dict[object, float] = {}
+        self.navigating = False
+        self.idle = asyncio.Event()
+        self.idle.set()
+        target_page.on("request", self._on_request)
+        target_page.on("requestfinished", self._on_request_done)
+        target_page.on("requestfailed", self._on_request_done)
+        target_page.on("domcontentloaded", self._on_domcontentloaded)
+
+    def _on_request(self, request):
+        if request.resource_type in self.IGNORED_RESOURCE_TYPES:
+            return
+        if request.is_navigation_request() and request.frame == self.page.main_frame:
+            self.navigating = True
+        self.inflight[request] = time.monotonic()
+        self.idle.clear()
+
+    def _on_request_done(self, request):
+        self.inflight.pop(request, None)
+        if request.is_navigation_request() and request.frame == self.page.main_frame and request.failure:
+            self.navigating = False
+        if not self.pending():
+            self.idle.set()
+
+    def _on_domcontentloaded(self, _):
+        self.navigating = False
+
+    def pending(self) -> int:
+        """In-flight requests, ignoring long-lived ones (polling, streaming)."""
+        cutoff = time.monotonic() - SETTLE_MAX_REQUEST_AGE
+        return sum(1 for started in self.inflight.values() if started >= cutoff)
+
+    async def wait_idle(self, timeout: float):
+        """Wait until no (recent) requests are in flight."""
+        deadline = time.monotonic() + timeout
+        while self.pending() and time.monotonic() < deadline:
+            self.idle.clear()
+            try:
+                # 重新檢查以排除變成長連線的請求
+                await asyncio.wait_for(self.idle.wait(), min(0.25, max(0.0, deadline - time.monotonic())))
+            except asyncio.TimeoutError:
+                pass
+
+
+activity_trackers: Dict[object, PageActivityTracker] = {}
+
+
+def page_activity(target_page) -> PageActivityTracker:
+    """Get (or attach) the activity tracker for a page."""
+    tracker = activity_trackers.get(target_page)
+    if tracker is None:
+        tracker = PageActivityTracker(target_page)
+        activity_trackers[target_page] = tracker
+        target_page.on("close", lambda _: activity_trackers.pop(target_page, None))
+    return tracker
+
+
+async def wait_for_page_settle(target_page, timeout: float = SETTLE_TIMEOUT,
+                               quiet_ms: int = SETTLE_QUIET_MS) -> dict:
+    """Wait until the page is visually stable, bounded by timeout.
+
+    Uses in-page signals instead of fixed sleeps: main-frame navigation,
+    in-flight request count, DOM mutation quiescence, the end of scrolling
+    and requestAnimationFrame stability.
+    """
+    started = time.monotonic()
+    deadline = started + timeout
+    tracker = page_activity(target_page)
+    settled = False
+    
+    # 讓點擊觸發的導航或請求有機會開始
+    await asyncio.sleep(SETTLE_GRACE_MS / 1000)
+    
+    while not settled:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or target_page.is_closed():
+            break
+        try:
+            if tracker.navigating:
+                await target_page.wait_for_load_state("domcontentloaded", timeout=remaining * 1000)
+                tracker.navigating = False
+            if tracker.pending():
+                await tracker.wait_idle(deadline - time.monotonic())
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            quiet = await target_page.evaluate(SETTLE_WAIT_SCRIPT, {"quietMs": quiet_ms, "maxMs": remaining * 1000})
+            # DOM 靜止期間又有導航或請求開始時再等一輪
+            settled = quiet and not tracker.navigating and not tracker.pending()
+        except Exception:
+            # Execution context 因導航被銷毀，等下一輪
+            await asyncio.sleep(0.05)
+    
+    return {"settled": settled, "waited_ms": round((time.monotonic() - started) * 1000, 1)}
+
+
+class FrameStore:
+    """Latest page frame shared by streaming, REST and the agent loops.
+
+    Every frame gets a monotonically increasing version and the monotonic
+    time its capture started. Concurrent requests for a fresh frame share a
+    single in-flight page.screenshot, and frames pushed by the screencast
+    are published here so the agent can reuse them instead of capturing
+    again.
+    """
+
+    def __init__(self, session: "Session"):
+        self.session = session
+        self.version = 0
+        self.latest: Optional[dict] = None
+        self.updated = asyncio.Event()
+        self._inflight: Optional[asyncio.Future] = None
+        self._inflight_started = 0.0
+        self.captures = 0
+        self.published = 0
+        self.reused = 0
+        self.coalesced = 0
+        self._error_logged = False
+
+    def _store(self, image: str, image_format: str, captured_at: float, source: str,
+               full_size: bool = True) -> dict:
+        self.version += 1
+        self.latest = {
+            "version": self.version,
+            "image": image,
+            "format": image_format,
+            "captured_at": captured_at,
+            "timestamp": time.time(),
+            "source": source,
+            "full_size": full_size,
+        }
+        # 喚醒等待新幀的呼叫者後換一個新的 Event
+        self.updated.set()
+        self.updated = asyncio.Event()
+        return self.latest
+
+    def publish(self, image: str, image_format: str, full_size: bool = True) -> dict:
+        """Record a frame produced elsewhere (e.g. a screencast push)."""
+        self.published += 1
+        FRAMES_CAPTURED.inc(session=self.session.id, source="screencast")
+        return self._store(image, image_format, time.monotonic(), "screencast", full_size)
+
+    def fresh(self, after: Optional[float] = None, min_version: int = 0,
+              full_size: bool = False, lossless: bool = False) -> Optional[dict]:
+        """Latest frame if it satisfies the version / capture-time / format constraints."""
+        frame = self.latest
+        if not frame or frame["version"] <= min_version:
+            return None
+        if after is not None and frame["captured_at"] < after:
+            return None
+        if full_size and not frame["full_size"]:
+            return None
+        if lossless and frame["format"] != "png":
+            return None
+        return frame
+
+    async def _capture(self, started: float) -> dict:
+        page = self.session.page
+        if not page or page.is_closed():
+            raise Exception("Page is closed")
+        with CAPTURE_SECONDS.time(session=self.session.id):
+            png = await page.screenshot(type="png", full_page=False, timeout=5000)
+        self.captures += 1
+        FRAMES_CAPTURED.inc(session=self.session.id, source="screenshot")
+        return self._store(base64.b64encode(png).decode("utf-8"), "png", started, "screenshot")
+
+    async def capture(self, after: Optional[float] = None) -> dict:
+        """Capture a frame, joining an in-flight capture that started after `after`."""
+        inflight = self._inflight
+        if inflight and not inflight.done():
+            if after is None or self._inflight_started >= after:
+                self.coalesced += 1
+                return await asyncio.shield(inflight)
+            # 進行中的截圖太舊，等它結束再自己截一張
+            try:
+                await asyncio.shield(inflight)
+            except Exception:
+                pass
+            return await self.capture(after)
+
+        started = time.monotonic()
+        self._inflight_started = started
+        self._inflight = asyncio.ensure_future(self._capture(started))
+        return await asyncio.shield(self._inflight)
+
+    async def get(self, after: Optional[float] = None, min_version: int = 0,
+                  wait: float = 0.0, full_size: bool = False, lossless: bool = False) -> dict:
+        """Return a frame newer than `min_version` whose capture started at or after `after`.
+
+        Reuses the latest frame when it qualifies, otherwise waits up to
+        `wait` seconds for one to be published before capturing. Falls back
+        to the last frame if the capture fails.
+        """
+        frame = self.fresh(after, min_version, full_size, lossless)
+        if frame:
+            self.reused += 1
+            return frame
+
+        deadline = time.monotonic() + wait
+        while wait > 0 and (remaining := deadline - time.monotonic()) > 0:
+            try:
+                await asyncio.wait_for(self.updated.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+            frame = self.fresh(after, min_version, full_size, lossless)
+            if frame:
+                self.reused += 1
+                return frame
+
+        try:
+            frame = await self.capture(after)
+            self._error_logged = False
+            return frame
+        except Exception as e:
+            # 截圖失敗時使用緩存
+            if self.latest:
+                # 只在第一次失敗時 log
+                if not self._error_logged:
+                    print(f"⚠️ Screenshot failed, using cache: {e}")
+                    self._error_logged = True
+                return self.latest
+            # 沒有緩存時才拋出錯誤
+            print(f"❌ Screenshot failed and no cache: {e}")
+            raise
+
+    def stats(self) -> dict:
+        frame = self.latest
+        return {
+            "version": self.version,
+            "age_ms": round((time.monotonic() - frame["captured_at"]) * 1000, 1) if frame else None,
+            "source": frame["source"] if frame else None,
+            "captures": self.captures,
+            "published": self.published,
+            "reused": self.reused,
+            "coalesced": self.coalesced,
+        }
+
+
+async def new_browser_context(storage_state: Optional[str] = None):
+    """Create a browser context on the shared Chromium instance."""
+    context = await browser.new_context(
+        viewport={"width": DISPLAY_WIDTH, "height": DISPLAY_HEIGHT},
+        accept_downloads=True,
+        no_viewport=True,  # 不限制 viewport，使用全螢幕
+        # 啟用 cookie 和 storage
+        storage_state=storage_state,  # 允許保存 cookies 和 localStorage
+        # 設定真實的 User-Agent，避免被識別為 bot
+        user_agent="Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36",
+        # 允許 JavaScript
+        java_script_enabled=True,
+        # 接受所有 cookies
+        bypass_csp=False,
+        # 忽略 HTTPS 錯誤
+        ignore_https_errors=True,
+        # 設定合理的 timeout
+        extra_http_headers={
+            "Accept-Language": "en-US,en;q=0.9,zh-TW;q=0.8,zh;q=0.7"
+        }
+    )
+    # 每個 document 都注入 settle 追蹤腳本
+    await context.add_init_script(SETTLE_INIT_SCRIPT)
+    return context
+
+
+def process_tree_rss_mb() -> float:
+    """Resident memory of this process and all descendants (Playwright driver, Chromium), in MB."""
+    children: Dict[int, list] = {}
+    rss_pages: Dict[int, int] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # comm 可能含空白，從最後一個 ')' 之後開始解析
+                fields = f.read().rsplit(")", 1)[1].split()
+            with open(f"/proc/{entry}/statm") as f:
+                rss_pages[int(entry)] = int(f.read().split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(int(fields[1]), []).append(int(entry))
+
+    total, stack = 0, [os.getpid()]
+    while stack:
+        pid = stack.pop()
+        total += rss_pages.get(pid, 0)
+        stack.extend(children.get(pid, []))
+    return total * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+class ContextPool:
+    """Pre-created browser contexts with a page already on the start URL.
+
+    A background task keeps `target` contexts ready. A miss (nothing ready
+    when a session is created) raises the target towards max_size; after
+    idle_shrink seconds without demand it drops back to min_size. No new
+    context is warmed while the browser's memory is above memory_limit_mb.
+    """
+
+    def __init__(self, min_size: int, max_size: int, start_url: str, storage_state: Optional[str] = None,
+                 memory_limit_mb: int = 0, idle_shrink: float = 300.0):
+        self.min_size = min_size
+        self.max_size = max(min_size, max_size)
+        self.start_url = start_url
+        self.storage_state = storage_state
+        self.memory_limit_mb = memory_limit_mb
+        self.idle_shrink = idle_shrink
+        self.target = min_size
+        self.ready: Deque[tuple] = deque()
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.last_acquire = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+        self.memory_blocked = 0
+
+    def start(self):
+        if self.max_size > 0:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        while self.ready:
+            context, _ = self.ready.popleft()
+            await self._discard(context)
+
+    async def _discard(self, context):
+        try:
+            await context.close()
+        except Exception:
+            pass
+
+    async def _create(self, url: str) -> tuple:
+        context = await new_browser_context(self.storage_state)
+        try:
+            page = await context.new_page()
+            await page.goto(url)
+        except Exception:
+            await self._discard(context)
+            raise
+        return context, page
+
+    async def acquire(self, url: str) -> tuple:
+        """Hand out a (context, page, warm) triple, navigating to url if it differs from the start URL."""
+        self.last_acquire = time.monotonic()
+        while self.ready:
+            context, page = self.ready.popleft()
+            self.wakeup.set()  # 背景補充
+            if page.is_closed():
+                await self._discard(context)
+                continue
+            self.hits += 1
+            if url != self.start_url:
+                try:
+                    await page.goto(url)
+                except Exception:
+                    await self._discard(context)
+                    raise
+            return context, page, True
+
+        if self.task:
+            self.misses += 1
+            self.target = min(self.max_size, self.target + 1)
+            self.wakeup.set()
+        context, page = await self._create(url)
+        return context, page, False
+
+    def memory_ok(self) -> bool:
+        if not self.memory_limit_mb:
+            return True
+        try:
+            return process_tree_rss_mb() < self.memory_limit_mb
+        except OSError:
+            return True  # 非 Linux，無法量測
+
+    async def run(self):
+        while True:
+            if self.target > self.min_size and time.monotonic() - self.last_acquire > self.idle_shrink:
+                self.target = self.min_size
+            while len(self.ready) > self.target:
+                context, _ = self.ready.pop()
+                await self._discard(context)
+
+            while len(self.ready) < self.target:
+                if not self.memory_ok():
+                    self.memory_blocked += 1
+                    break
+                try:
+                    self.ready.append(await self._create(self.start_url))
+                except Exception as e:
+                    print(f"⚠️ Context pool warm-up failed: {e}")
+                    await asyncio.sleep(5)
+                    break
+
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), min(self.idle_shrink, 30.0))
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            "ready": len(self.ready),
+            "target": self.target,
+            "min_size": self.min_size,
+            "max_size": self.max_size,
+            "start_url": self.start_url,
+            "hits": self.hits,
+            "misses": self.misses,
+            "memory_blocked": self.memory_blocked,
+        }
+
+
+class HistoryRecord:
+    """One action history entry."""
+
+    __slots__ = ("seq", "timestamp", "task_id", "action", "mode", "detail")
+
+    def __init__(self, seq: int, timestamp: float, task_id: Optional[str], action: str, mode: str,
+                 detail: Optional[dict] = None):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.task_id = task_id
+        self.action = action
+        self.mode = mode
+        self.detail = detail
+
+    def to_dict(self) -> dict:
+        return {
+            "seq": self.seq,
+            "timestamp": self.timestamp,
+            "task_id": self.task_id,
+            "action": self.action,
+            "mode": self.mode,
+            **(self.detail or {}),
+        }
+
+
+class HistoryLog:
+    """Append-only SQLite log that history records overflow into, shared by all sessions."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn: Optional[sqlite3.Connection] = None
+        self.lock = threading.Lock()
+
+    def _db(self) -> sqlite3.Connection:
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS history ("
+                "session_id TEXT NOT NULL, seq INTEGER NOT NULL, timestamp REAL NOT NULL, "
+                "task_id TEXT, action TEXT NOT NULL, mode TEXT, detail TEXT, "
+                "PRIMARY KEY (session_id, seq))"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS history_task ON history (session_id, task_id, seq)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS history_action ON history (session_id, action, seq)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS history_time ON history (session_id, timestamp)")
+        return self.conn
+
+    @staticmethod
+    def _where(session_id: str, filters: dict) -> tuple:
+        clauses, params = ["session_id = ?"], [session_id]
+        for column, op in (("before", "seq <"), ("task_id", "task_id ="), ("action", "action ="),
+                           ("since", "timestamp >="), ("until", "timestamp <")):
+            if filters.get(column) is not None:
+                clauses.append(f"{op} ?")
+                params.append(filters[column])
+        return " AND ".join(clauses), params
+
+    def append(self, session_id: str, records: list):
+        with self.lock:
+            db = self._db()
+            db.executemany(
+                "INSERT INTO history VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(session_id, r.seq, r.timestamp, r.task_id, r.action, r.mode,
+                  json.dumps(r.detail, ensure_ascii=False) if r.detail else None) for r in records]
+            )
+            db.commit()
+
+    def max_seq(self, session_id: str) -> int:
+        with self.lock:
+            row = self._db().execute("SELECT MAX(seq) FROM history WHERE session_id = ?", (session_id,)).fetchone()
+        return row[0] or 0
+
+    def query(self, session_id: str, limit: int, **filters) -> list:
+        """Matching records, newest first."""
+        where, params = self._where(session_id, filters)
+        with self.lock:
+            rows = self._db().execute(
+                f"SELECT seq, timestamp, task_id, action, mode, detail FROM history WHERE {where} "
+                "ORDER BY seq DESC LIMIT ?", params + [limit]
+            ).fetchall()
+        return [HistoryRecord(seq, ts, task_id, action, mode, json.loads(detail) if detail else None)
+                for seq, ts, task_id, action, mode, detail in rows]
+
+    def count(self, session_id: str, **filters) -> int:
+        where, params = self._where(session_id, filters)
+        with self.lock:
+            return self._db().execute(f"SELECT COUNT(*) FROM history WHERE {where}", params).fetchone()[0]
+
+    def clear(self, session_id: str) -> int:
+        with self.lock:
+            db = self._db()
+            removed = db.execute("DELETE FROM history WHERE session_id = ?", (session_id,)).rowcount
+            db.commit()
+        return removed
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+
+class HistoryStore:
+    """Per-session action history: a fixed-size ring buffer in memory.
+
+    Records pushed out of the ring are spilled in batches to the shared
+    HistoryLog, so memory stays bounded while the full history remains
+    queryable by task id, action type and time with cursor pagination.
+    """
+
+    def __init__(self, session_id: str, log: Optional[HistoryLog], capacity: int = HISTORY_MEMORY_LIMIT):
+        self.session_id = session_id
+        self.log = log
+        self.ring: Deque[HistoryRecord] = deque(maxlen=max(1, capacity))
+        self.spill: list = []
+        self.dropped = 0  # 沒有磁碟 log 時被淘汰的筆數
+        self.spilled = 0  # 已寫入磁碟 log 的筆數
+        self.seq = 0
+        if log:
+            try:
+                self.seq = log.max_seq(session_id)
+                self.spilled = log.count(session_id)
+            except sqlite3.Error as e:
+                print(f"⚠️ History log unavailable: {e}")
+                self.log = None
+
+    def append(self, action: str, mode: str, task_id: Optional[str] = None, **detail) -> HistoryRecord:
+        self.seq += 1
+        record = HistoryRecord(self.seq, time.time(), task_id, action, mode, detail or None)
+        if len(self.ring) == self.ring.maxlen:
+            self.spill.append(self.ring[0])
+        self.ring.append(record)
+        if len(self.spill) >= HISTORY_SPILL_BATCH:
+            self.flush()
+        return record
+
+    def flush(self):
+        """Write spilled records to the on-disk log (or drop them if there is none)."""
+        if not self.spill:
+            return
+        if self.log:
+            try:
+                self.log.append(self.session_id, self.spill)
+                self.spilled += len(self.spill)
+            except sqlite3.Error as e:
+                print(f"⚠️ History spill failed: {e}")
+                self.dropped += len(self.spill)
+        else:
+            self.dropped += len(self.spill)
+        self.spill = []
+
+    def persist(self):
+        """Move everything, including the in-memory ring, to the on-disk log (on session close)."""
+        if self.log:
+            self.spill.extend(self.ring)
+            self.ring.clear()
+        self.flush()
+
+    @staticmethod
+    def _matches(record: HistoryRecord, filters: dict) -> bool:
+        return ((filters.get("before") is None or record.seq < filters["before"])
+                and (filters.get("task_id") is None or record.task_id == filters["task_id"])
+                and (filters.get("action") is None or record.action == filters["action"])
+                and (filters.get("since") is None or record.timestamp >= filters["since"])
+                and (filters.get("until") is None or record.timestamp < filters["until"]))
+
+    @property
+    def length(self) -> int:
+        """Records kept in memory or on disk, without touching SQLite."""
+        return len(self.ring) + len(self.spill) + self.spilled
+
+    def _log_before(self, ring: list, filters: dict) -> Optional[int]:
+        """`before` cursor for the disk log: everything on disk is older than the ring."""
+        before = filters.get("before")
+        if ring:
+            before = ring[0].seq if before is None else min(before, ring[0].seq)
+        return before
+
+    # query / count / clear 在 event loop 上取 ring 的快照，只有 SQLite 查詢交給 thread
+    async def query(self, limit: int = 50, **filters) -> tuple:
+        """Return (records oldest-first, next_cursor) for the newest `limit` matches.
+
+        Pass next_cursor back as `before` to page towards older records.
+        """
+        self.flush()
+        ring = list(self.ring)
+        found = []
+        for record in reversed(ring):
+            if self._matches(record, filters):
+                found.append(record)
+                if len(found) > limit:
+                    break
+        if len(found) <= limit and self.log:
+            found.extend(await asyncio.to_thread(
+                self.log.query, self.session_id, limit + 1 - len(found),
+                **{**filters, "before": self._log_before(ring, filters)}
+            ))
+        page = found[:limit]
+        next_cursor = page[-1].seq if len(found) > limit else None
+        return [record.to_dict() for record in reversed(page)], next_cursor
+
+    async def count(self, **filters) -> int:
+        self.flush()
+        ring = list(self.ring)
+        total = sum(1 for record in ring if self._matches(record, filters))
+        if self.log:
+            total += await asyncio.to_thread(
+                self.log.count, self.session_id, **{**filters, "before": self._log_before(ring, filters)}
+            )
+        return total
+
+    async def clear(self) -> int:
+        removed = self.length
+        self.ring.clear()
+        self.spill = []
+        self.spilled = 0
+        if self.log:
+            await asyncio.to_thread(self.log.clear, self.session_id)
+        return removed
+
+
+def history_db_path() -> str:
+    """Each worker process gets its own history file, so workers never share sequence numbers."""
+    if WORKER_INDEX == 0:
+        return HISTORY_DB
+    root, ext = os.path.splitext(HISTORY_DB)
+    return f"{root}.worker{WORKER_INDEX}{ext}"
+
+
+history_log = HistoryLog(history_db_path()) if HISTORY_DB else None
+
+
+class Session:
+    """An isolated browser context with its own page, task state, history and viewers."""
+
+    def __init__(self, session_id: str, context, page):
+        self.id = session_id
+        self.context = context
+        self.page = page
+        self.state = new_session_state()
+        self.manager = ConnectionManager(self)
+        self.frame_store = FrameStore(self)
+        self.history = HistoryStore(session_id, history_log)
+        self.created_at = time.time()
+        self.warm = False  # 是否取自預熱的 context pool
+        self.startup_ms: Optional[float] = None
+        self.freed = asyncio.Event()  # 每次任務結束時觸發，之後換成新的 Event
+        # 在第一個動作之前就開始追蹤請求與導航，新分頁建立時也立即追蹤
+        for existing in context.pages:
+            page_activity(existing)
+        context.on("page", page_activity)
+
+    @property
+    def busy(self) -> bool:
+        return self.state["ai_running"] or self.state["browser_use_running"]
+
+    def task_finished(self, *_):
+        """Wake anyone waiting for the session to become free (also usable as a task done callback)."""
+        self.freed.set()
+        self.freed = asyncio.Event()
+
+    async def wait_free(self):
+        while self.busy:
+            await self.freed.wait()
+
+    def info(self) -> dict:
+        return {
+            "session_id": self.id,
+            "created_at": self.created_at,
+            "mode": self.state["mode"],
+            "ai_running": self.state["ai_running"],
+            "browser_use_running": self.state["browser_use_running"],
+            "task": self.state["task"],
+            "current_url": self.page.url if self.page and not self.page.is_closed() else None,
+            "connections": len(self.manager.active_connections),
+            "warm": self.warm,
+            "startup_ms": self.startup_ms,
+        }
+
+    async def close(self):
+        # 讓執行中的 AI 任務在下一輪迴圈結束
+        self.state["ai_running"] = False
+        self.state["browser_use_running"] = False
+        self.task_finished()
+        self.history.persist()
+        metrics.forget("session", self.id)
+        await self.manager.close_all()
+        try:
+            await self.context.close()
+        except Exception:
+            pass
+
+
+class SessionManager:
+    """Creates and tracks isolated sessions on the shared browser."""
+
+    def __init__(self, max_sessions: int, pool: ContextPool):
+        self.max_sessions = max_sessions
+        self.pool = pool
+        self.sessions: Dict[str, Session] = {}
+        self.reserved: Set[str] = set()  # 正在建立中的 session
+
+    def get(self, session_id: str) -> Optional[Session]:
+        return self.sessions.get(session_id)
+
+    async def create(self, session_id: Optional[str] = None, url: str = INITIAL_URL) -> Session:
+        """Open a session, preferably on a pre-warmed context. Raises ValueError when the limit is reached."""
+        session_id = session_id or uuid.uuid4().hex[:12]
+        if session_id in self.sessions or session_id in self.reserved:
+            raise ValueError(f"Session {session_id} already exists")
+        if len(self.sessions) + len(self.reserved) >= self.max_sessions:
+            raise ValueError(f"Session limit reached ({self.max_sessions})")
         
-        # Initial request to AI model
-        response = openai_client.responses.create(
-            model=MODEL_DEPLOYMENT,
-            tools=[{
-                "type": "computer_use_preview",
-                "display_width": DISPLAY_WIDTH,
-                "display_height": DISPLAY_HEIGHT,
-                "environment": "browser"
-            }],
-            instructions="You are an AI agent with the ability to control a browser. You can control the keyboard and mouse. You take a screenshot after each action to check if your action was successful. Once you have completed the requested task you should stop running and pass back control to your human operator.",
-            input=[{
-                "role": "user",
-                "content": [{
-                    "type": "input_text",
-                    "text": task
-                }, {
-                    "type": "input_image",
-                    "image_url": f"data:image/png;base64,{screenshot_b64}"
-                }]
-            }],
-            reasoning={"generate_summary": "concise"},
-            truncation="auto"
-        )
+        # 先保留名額，建立 context 時不阻擋其他 session
+        self.reserved.add(session_id)
+        started = time.perf_counter()
+        try:
+            context, page, warm = await self.pool.acquire(url)
+        finally:
+            self.reserved.discard(session_id)
+        session = Session(session_id, context, page)
+        session.warm = warm
+        session.startup_ms = round((time.perf_counter() - started) * 1000, 1)
+        self.sessions[session_id] = session
+        print(f"🆕 Session {session_id} 已建立（{len(self.sessions)}/{self.max_sessions}，"
+              f"{'預熱' if warm else '新建'} {session.startup_ms}ms）")
+        return session
+
+    async def close(self, session_id: str) -> bool:
+        session = self.sessions.pop(session_id, None)
+        if not session:
+            return False
+        await session.close()
+        print(f"🗑 Session {session_id} 已關閉")
+        return True
+
+    async def close_all(self):
+        for session_id in list(self.sessions):
+            await self.close(session_id)
+
+
+sessions = SessionManager(
+    MAX_SESSIONS,
+    ContextPool(
+        POOL_MIN_SIZE,
+        POOL_MAX_SIZE,
+        POOL_START_URL,
+        storage_state=POOL_STORAGE_STATE,
+        memory_limit_mb=POOL_MEMORY_LIMIT_MB,
+        idle_shrink=POOL_IDLE_SHRINK,
+    )
+)
+
+
+class IterationTimer:
+    """Accumulates wall-clock time per phase of one agent iteration."""
+
+    PHASES = ("model", "action", "settle", "screenshot", "encode")
+
+    def __init__(self, iteration: int):
+        self.iteration = iteration
+        self.started = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        self.observation_bytes: Optional[int] = None
+
+    def add(self, phase: str, seconds: float):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def as_dict(self) -> dict:
+        return {
+            "iteration": self.iteration,
+            "phases": {name: round(seconds * 1000, 1) for name, seconds in self.phases.items()},
+            "total_ms": round((time.perf_counter() - self.started) * 1000, 1),
+            "observation_bytes": self.observation_bytes,
+        }
+
+
+def percentile(values: list, pct: float) -> float:
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize_timings(iterations: list) -> dict:
+    """p50 / p95 / mean / total per phase over a task's iteration timings."""
+    samples: Dict[str, list] = {}
+    for entry in iterations:
+        for name, ms in entry["phases"].items():
+            samples.setdefault(name, []).append(ms)
+        samples.setdefault("total", []).append(entry["total_ms"])
+
+    return {
+        name: {
+            "count": len(values),
+            "p50_ms": percentile(values, 50),
+            "p95_ms": percentile(values, 95),
+            "mean_ms": round(sum(values) / len(values), 1),
+            "total_ms": round(sum(values), 1),
+        }
+        for name, values in samples.items()
+    }
+
+
+def start_task_record(session: Session, task: str, kind: str = "computer-use",
+                      task_id: Optional[str] = None) -> dict:
+    """Create a record for a new task and make it the session's current one."""
+    state = session.state
+    record = {
+        "task_id": task_id or uuid.uuid4().hex[:12],
+        "session_id": session.id,
+        "kind": kind,
+        "task": task,
+        "status": "running",
+        "started_at": time.time(),
+        "ended_at": None,
+        "iteration_count": 0,
+        "iterations": [],  # 每個計時過的回合（含第 0 回合的初始請求）
+        "messages": [],
+        "model_calls": state["model_calls"],
+    }
+    task_records[record["task_id"]] = record
+    while len(task_records) > TASK_RECORD_LIMIT:
+        task_records.popitem(last=False)
+    state["task_id"] = record["task_id"]
+    return record
+
+
+def finish_task_record(session: Session, record: dict, status: str):
+    record["status"] = status
+    record["ended_at"] = time.time()
+    record["model_calls"] = dict(session.state["model_calls"])
+    record["iteration_count"] = session.state["iteration_count"]
+    TASKS_FINISHED.inc(kind=record["kind"], status=status)
+    TASK_ITERATIONS.observe(record["iteration_count"], kind=record["kind"])
+
+
+def task_iteration_count(record: dict) -> int:
+    """Iterations of a task; read live from its session while it is still running."""
+    if record["status"] == "running":
+        session = sessions.get(record["session_id"])
+        if session and session.state["task_id"] == record["task_id"]:
+            return session.state["iteration_count"]
+    return record["iteration_count"]
+
+
+def record_iteration_timing(record: dict, timer: IterationTimer) -> dict:
+    """Store one iteration's timing on the task record and return the ai_timing event."""
+    timing = timer.as_dict()
+    record["iterations"].append(timing)
+    for phase, seconds in timer.phases.items():
+        AGENT_PHASE_SECONDS.observe(seconds, phase=phase)
+    return {"type": "ai_timing", "task_id": record["task_id"], **timing}
+
+
+async def capture_model_observation(session: Session, timer: IterationTimer,
+                                    after: Optional[float] = None) -> str:
+    """Frame of the page captured at or after `after`, encoded for the model. Returns a data URL.
+
+    While a screencast is streaming, a frame it pushes shortly after the
+    action is reused instead of taking a separate screenshot. Without
+    `after`, any frame from the last poll interval is accepted. Lossy
+    (JPEG) frames are only reused when the observation is re-encoded to a
+    lossy format anyway, so a PNG observation never carries JPEG artifacts.
+    """
+    if after is None:
+        after = time.monotonic() - STREAM_POLL_INTERVAL
+    lossless = not (model_observation_enabled() and MODEL_OBSERVATION_FORMAT.lower() != "png")
+    reusable = session.manager.screencast.active and (not lossless or SCREENCAST_FORMAT == "png")
+    wait = FRAME_REUSE_WAIT_MS / 1000 if reusable else 0.0
+    with timer.phase("screenshot"):
+        frame = await session.frame_store.get(after=after, wait=wait, full_size=True, lossless=lossless)
+    with timer.phase("encode"), ENCODE_SECONDS.time(stage="model_observation"):
+        if model_observation_enabled():
+            image_url, size = await asyncio.to_thread(encode_model_observation, frame["image"], frame["format"])
+        else:
+            image_url, size = encode_model_observation(frame["image"], frame["format"])
+    timer.observation_bytes = size
+    return image_url
+
+
+async def perform_action(session: Session, action, timer: IterationTimer, replay: bool = False) -> tuple:
+    """Run one action against the page and wait for it to settle.
+
+    When replaying, recorded waits are replaced by the settle logic.
+    Returns (settled_at, new_tab_url).
+    """
+    page = session.page
+    new_tab_url = None
+    
+    # Execute the action
+    with timer.phase("action"):
+        await page.bring_to_front()
+        if replay and action.type == "wait":
+            session.history.append("wait", "replay", task_id=session.state["task_id"])
+        else:
+            await handle_ai_action(session, action)
+    
+    # Handle new tabs/pages and wait for the page to settle
+    with timer.phase("settle"):
+        if action.type != "wait" or replay:
+            await wait_for_page_settle(page)
         
-        state["current_response_id"] = response.id
+        if action.type in ["click"]:
+            # 檢查是否有新分頁
+            all_pages = page.context.pages
+            if len(all_pages) > 1:
+                newest_page = all_pages[-1]
+                if newest_page != page and newest_page.url not in ["about:blank", ""]:
+                    page = newest_page
+                    session.page = newest_page
+                    new_tab_url = newest_page.url
+                    print(f"📄 切換到新分頁: {newest_page.url}")
+                    await wait_for_page_settle(page)
+        settled_at = time.monotonic()
+    
+    return settled_at, new_tab_url
+
+
+async def execute_computer_call(session: Session, computer_call, timer: IterationTimer):
+    """Run one computer_call against the page: action, settle, screenshot.
+
+    Returns the input items for the next model request and the URL of a
+    newly opened tab if the action switched to one.
+    """
+    settled_at, new_tab_url = await perform_action(session, computer_call.action, timer)
+    
+    # Screenshot after the page settled (a streamed frame captured since then is reused)
+    image_url = await capture_model_observation(session, timer, after=settled_at)
+    
+    # Prepare input for next request
+    input_content = [{
+        "type": "computer_call_output",
+        "call_id": computer_call.call_id,
+        "output": {
+            "type": "input_image",
+            "image_url": image_url
+        }
+    }]
+    
+    # Acknowledge safety checks
+    if hasattr(computer_call, 'pending_safety_checks') and computer_call.pending_safety_checks:
+        input_content[0]["acknowledged_safety_checks"] = [
+            {"id": c.id, "code": c.code, "message": c.message}
+            for c in computer_call.pending_safety_checks
+        ]
+    
+    return input_content, new_tab_url
+
+
+# 重播時需要的動作欄位（座標皆為模型 observation 座標）
+TRAJECTORY_ACTION_FIELDS = ("type", "x", "y", "button", "keys", "text", "scroll_x", "scroll_y", "ms")
+FRAME_HASH_SIZE = 16  # 16x16 difference hash = 256 bits
+
+
+def action_to_dict(action) -> dict:
+    """Serializable copy of a computer_call action."""
+    data = {}
+    for field in TRAJECTORY_ACTION_FIELDS:
+        value = getattr(action, field, None)
+        if value is not None:
+            data[field] = list(value) if field == "keys" else value
+    return data
+
+
+def frame_fingerprint(image_b64: str, thumbnail: bool = False) -> tuple:
+    """Perceptual difference hash of a frame and an optional JPEG thumbnail.
+
+    Returns (hash_hex, thumbnail_b64); both are None without Pillow.
+    """
+    if Image is None:
+        return None, None
+    img = Image.open(io.BytesIO(base64.b64decode(image_b64)))
+    gray = img.convert("L").resize((FRAME_HASH_SIZE + 1, FRAME_HASH_SIZE), Image.BILINEAR)
+    pixels = list(gray.getdata())
+    bits = 0
+    for row in range(FRAME_HASH_SIZE):
+        offset = row * (FRAME_HASH_SIZE + 1)
+        for col in range(FRAME_HASH_SIZE):
+            bits = (bits << 1) | (pixels[offset + col] < pixels[offset + col + 1])
+    frame_hash = f"{bits:0{FRAME_HASH_SIZE * FRAME_HASH_SIZE // 4}x}"
+
+    thumb = None
+    if thumbnail:
+        img = img.convert("RGB")
+        img.thumbnail((TRAJECTORY_THUMBNAIL_WIDTH, TRAJECTORY_THUMBNAIL_WIDTH))
+        buffer = io.BytesIO()
+        img.save(buffer, format="JPEG", quality=60)
+        thumb = base64.b64encode(buffer.getvalue()).decode("utf-8")
+    return frame_hash, thumb
+
+
+def frame_distance(a: str, b: str) -> float:
+    """Fraction of differing bits between two frame hashes."""
+    return bin(int(a, 16) ^ int(b, 16)).count("1") / (len(a) * 4)
+
+
+def same_page(a: Optional[str], b: Optional[str]) -> bool:
+    """Whether two URLs point at the same page, ignoring query and fragment."""
+    a, b = urlsplit(a or ""), urlsplit(b or "")
+    return (a.scheme, a.netloc, a.path.rstrip("/")) == (b.scheme, b.netloc, b.path.rstrip("/"))
+
+
+def trajectory_path(trajectory_id: str) -> Optional[str]:
+    if not TRAJECTORY_DIR or not trajectory_id or not all(c.isalnum() or c in "-_" for c in trajectory_id):
+        return None
+    return os.path.join(TRAJECTORY_DIR, f"{trajectory_id}.jsonl.gz")
+
+
+def write_trajectory(header: dict, steps: list) -> str:
+    """Write a trajectory as gzip JSON lines: the header, then one line per step."""
+    os.makedirs(TRAJECTORY_DIR, exist_ok=True)
+    path = trajectory_path(header["task_id"])
+    tmp_path = f"{path}.tmp"
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+        f.write(json.dumps(header, ensure_ascii=False) + "\n")
+        for step in steps:
+            f.write(json.dumps(step, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_trajectory(trajectory_id: str, header_only: bool = False) -> Optional[dict]:
+    """Read a saved trajectory; returns its header with a "steps" list, or None."""
+    path = trajectory_path(trajectory_id)
+    if not path or not os.path.exists(path):
+        return None
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        trajectory = json.loads(f.readline())
+        if not header_only:
+            trajectory["steps"] = [json.loads(line) for line in f if line.strip()]
+    return trajectory
+
+
+def list_trajectories(limit: int) -> list:
+    """Headers of the most recently saved trajectories, newest first."""
+    if not TRAJECTORY_DIR or not os.path.isdir(TRAJECTORY_DIR):
+        return []
+    names = [n for n in os.listdir(TRAJECTORY_DIR) if n.endswith(".jsonl.gz")]
+    names.sort(key=lambda n: os.path.getmtime(os.path.join(TRAJECTORY_DIR, n)), reverse=True)
+    headers = []
+    for name in names[:limit]:
+        try:
+            headers.append(load_trajectory(name[:-len(".jsonl.gz")], header_only=True))
+        except (OSError, ValueError) as e:
+            print(f"⚠️ 無法讀取軌跡 {name}: {e}")
+    return [h for h in headers if h]
+
+
+class TrajectoryRecorder:
+    """Collects the actions of one AI task and saves them when the task ends.
+
+    Each step keeps the action, the URL before and after it, a perceptual
+    hash of the settled frame (used by replay to detect divergence) and,
+    with TRAJECTORY_FRAMES, a thumbnail. A recorder created with `base`
+    continues a replay that diverged: the steps replayed so far are kept,
+    so the saved trajectory replays from the start next time.
+    """
+
+    def __init__(self, session: Session, record: dict, base: Optional[dict] = None, base_steps: int = 0):
+        self.session = session
+        self.record = record
+        width, height = observation_size()
+        self.header = {
+            "version": 1,
+            "task_id": record["task_id"],
+            "task": record["task"],
+            "session_id": session.id,
+            "started_at": record["started_at"],
+            "observation": [width, height],
+            "initial_url": None,
+            "initial_hash": None,
+        }
+        self.steps = []
+        if base:
+            self.header["initial_url"] = base["initial_url"]
+            self.header["initial_hash"] = base["initial_hash"]
+            self.header["continues"] = base["task_id"]
+            self.steps = [dict(step, replayed=True) for step in base["steps"][:base_steps]]
+
+    async def _observe(self) -> tuple:
+        """URL and fingerprint of the latest settled frame."""
+        frame = self.session.frame_store.latest
+        frame_hash, thumb = None, None
+        if frame:
+            frame_hash, thumb = await asyncio.to_thread(frame_fingerprint, frame["image"], TRAJECTORY_FRAMES)
+        return self.session.page.url, frame_hash, thumb
+
+    async def start(self):
+        if self.header["initial_url"] is None:
+            self.header["initial_url"], self.header["initial_hash"], _ = await self._observe()
+
+    async def add_step(self, action, timer: IterationTimer, url_before: str):
+        url, frame_hash, thumb = await self._observe()
+        step = {
+            "iteration": timer.iteration,
+            "action": action_to_dict(action),
+            "url_before": url_before,
+            "url": url,
+            "hash": frame_hash,
+        }
+        if thumb:
+            step["frame"] = thumb
+        self.steps.append(step)
+
+    async def save(self, status: str) -> Optional[str]:
+        """Write the trajectory to TRAJECTORY_DIR. Returns the file path."""
+        timings = {t["iteration"]: t for t in self.record["iterations"]}
+        for step in self.steps:
+            if not step.get("replayed") and step["iteration"] in timings:
+                step["timing"] = timings[step["iteration"]]
+        self.header.update(status=status, ended_at=time.time(), steps=len(self.steps))
+        try:
+            path = await asyncio.to_thread(write_trajectory, self.header, self.steps)
+        except OSError as e:
+            print(f"⚠️ 軌跡寫入失敗: {e}")
+            return None
+        self.record["trajectory"] = path
+        return path
+
+
+async def check_replay_divergence(session: Session, step: dict, expected_hash: Optional[str],
+                                  after: float) -> Optional[str]:
+    """Compare the current screen with the recording. Returns why it diverged, or None."""
+    url = session.page.url
+    if not same_page(url, step.get("url_before")):
+        return f"URL {url} != {step.get('url_before')}"
+    if not expected_hash or Image is None:
+        return None
+    wait = FRAME_REUSE_WAIT_MS / 1000 if session.manager.screencast.active else 0.0
+    frame = await session.frame_store.get(after=after, wait=wait)
+    frame_hash, _ = await asyncio.to_thread(frame_fingerprint, frame["image"])
+    distance = frame_distance(frame_hash, expected_hash)
+    if distance > TRAJECTORY_DIVERGENCE:
+        return f"畫面差異 {distance:.0%}"
+    return None
+
+
+class ActionCache:
+    """LRU + TTL cache of model actions keyed on (task, page, frame hash).
+
+    A lookup matches the closest stored frame of the same task and page
+    whose hash differs by at most `max_distance` of its bits. Shared by
+    all sessions of this process.
+    """
+
+    def __init__(self, enabled: bool, max_entries: int, ttl: float, max_distance: float):
+        self.enabled = enabled and Image is not None
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.entries: "OrderedDict[tuple, dict]" = OrderedDict()  # (task, page, hash) -> entry
+        self.buckets: Dict[tuple, Set[str]] = {}  # (task, page) -> hashes
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def task_fingerprint(task: str) -> str:
+        return hashlib.sha1(" ".join(task.lower().split()).encode("utf-8")).hexdigest()[:16]
+
+    @staticmethod
+    def page_key(url: str) -> str:
+        """Page identity used in keys: scheme, host and path."""
+        parts = urlsplit(url or "")
+        return f"{parts.scheme}://{parts.netloc}{parts.path.rstrip('/')}"
+
+    def key(self, task: str, url: str, frame_hash: str) -> tuple:
+        return self.task_fingerprint(task), self.page_key(url), frame_hash
+
+    def _remove(self, key: tuple):
+        self.entries.pop(key, None)
+        bucket = self.buckets.get(key[:2])
+        if bucket is not None:
+            bucket.discard(key[2])
+            if not bucket:
+                del self.buckets[key[:2]]
+
+    def lookup(self, key: tuple) -> Optional[dict]:
+        """Closest cached action for the key, or None."""
+        now = time.time()
+        best = None
+        for frame_hash in list(self.buckets.get(key[:2], ())):
+            stored_key = key[:2] + (frame_hash,)
+            if now - self.entries[stored_key]["stored_at"] > self.ttl:
+                self._remove(stored_key)
+                self.expirations += 1
+                continue
+            distance = frame_distance(frame_hash, key[2])
+            if distance <= self.max_distance and (best is None or distance < best[0]):
+                best = (distance, stored_key)
+
+        if best is None:
+            self.misses += 1
+            return None
+        distance, stored_key = best
+        entry = self.entries[stored_key]
+        self.entries.move_to_end(stored_key)
+        entry["hits"] += 1
+        self.hits += 1
+        return {"key": stored_key, "action": entry["action"], "distance": distance}
+
+    def store(self, key: tuple, action: dict):
+        self._remove(key)
+        self.entries[key] = {"action": action, "stored_at": time.time(), "hits": 0}
+        self.buckets.setdefault(key[:2], set()).add(key[2])
+        self.stores += 1
+        while len(self.entries) > self.max_entries:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def invalidate(self, task: Optional[str] = None, url: Optional[str] = None,
+                   key: Optional[tuple] = None) -> int:
+        """Drop one entry, or every entry matching the task and/or URL. Returns how many."""
+        if key is not None:
+            keys = [key] if key in self.entries else []
+        else:
+            task_fp = self.task_fingerprint(task) if task else None
+            page = self.page_key(url) if url else None
+            keys = [k for k in self.entries
+                    if (task_fp is None or k[0] == task_fp) and (page is None or k[1] == page)]
+        for k in keys:
+            self._remove(k)
+        self.invalidations += len(keys)
+        return len(keys)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "max_distance": self.max_distance,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
+
+
+action_cache = ActionCache(ACTION_CACHE, ACTION_CACHE_SIZE, ACTION_CACHE_TTL, ACTION_CACHE_MAX_DISTANCE)
+
+
+def describe_action(action: dict) -> str:
+    """Short human-readable form of a serialized action."""
+    details = {k: v for k, v in action.items() if k != "type"}
+    return f"{action['type']} {json.dumps(details, ensure_ascii=False)}" if details else action["type"]
+
+
+def cached_actions_note(actions: list) -> str:
+    """Tell the model which cached actions ran since its last turn."""
+    steps = "; ".join(describe_action(a) for a in actions)
+    return (f"The following actions were already performed since your last turn: {steps}. "
+            "The screenshot shows the current state of the browser.")
+
+
+async def apply_cached_actions(session: Session, task: str, image_url: str, timer: IterationTimer,
+                               recorder: Optional[TrajectoryRecorder] = None) -> tuple:
+    """Execute cached actions for the current screen until the cache misses.
+
+    Returns (image_url, cache_key, actions): the observation to send to the
+    model, the key its next action is stored under (None when caching is
+    off) and the cached actions that were executed.
+    """
+    if not action_cache.enabled or not session.frame_store.latest:
+        return image_url, None, []
+    state, manager = session.state, session.manager
+    actions, seen, previous = [], set(), None
+    while True:
+        frame_hash, _ = await asyncio.to_thread(frame_fingerprint, session.frame_store.latest["image"])
+        key = action_cache.key(task, session.page.url, frame_hash)
+        if previous and key[:2] == previous[:2] and frame_distance(key[2], previous[2]) <= action_cache.max_distance:
+            # 快取的動作沒有改變畫面，不再沿用
+            action_cache.invalidate(key=previous)
+            return image_url, key, actions
+        if len(actions) >= ACTION_CACHE_MAX_CHAIN or key in seen or not state["ai_running"]:
+            # 使用者或排程器停止任務時不再執行快取的動作
+            return image_url, key, actions
+        hit = action_cache.lookup(key)
+        if not hit:
+            return image_url, key, actions
+        
+        seen.add(hit["key"])
+        previous = hit["key"]
+        action = SimpleNamespace(**hit["action"])
+        await manager.broadcast({
+            "type": "ai_action",
+            "action": action.type,
+            "iteration": state["iteration_count"],
+            "cached": True
+        })
+        url_before = session.page.url
+        settled_at, _ = await perform_action(session, action, timer)
+        image_url = await capture_model_observation(session, timer, after=settled_at)
+        if recorder:
+            await recorder.add_step(action, timer, url_before)
+        state["model_calls"]["cached"] = state["model_calls"].get("cached", 0) + 1
+        actions.append(hit["action"])
+
+
+async def create_model_response(session: Session, **kwargs):
+    """Call responses.create and count it against the session's current task."""
+    session.state["model_calls"]["create"] += 1
+    try:
+        with MODEL_CALL_SECONDS.time(call="create"):
+            return await openai_client.responses.create(**kwargs)
+    except Exception:
+        MODEL_CALL_ERRORS.inc(call="create")
+        raise
+
+
+async def retrieve_model_response(session: Session, response_id: str):
+    """Fetch an existing response by id (only needed when resuming a task)."""
+    session.state["model_calls"]["retrieve"] += 1
+    try:
+        with MODEL_CALL_SECONDS.time(call="retrieve"):
+            return await openai_client.responses.retrieve(response_id=response_id)
+    except Exception:
+        MODEL_CALL_ERRORS.inc(call="retrieve")
+        raise
+
+
+def response_messages(response) -> list:
+    """Assistant text in a response's output."""
+    texts = []
+    for item in getattr(response, "output", None) or []:
+        item_type = getattr(item, "type", None)
+        if item_type == "text":
+            texts.append(item.text)
+        elif item_type == "message":
+            texts.extend(part.text for part in item.content if getattr(part, "type", None) == "output_text")
+    return texts
+
+
+def first_computer_call(response):
+    for item in getattr(response, "output", None) or []:
+        if getattr(item, "type", None) == "computer_call":
+            return item
+    return None
+
+
+# 轉送給觀看者的串流事件
+MODEL_DELTA_EVENTS = {
+    "response.output_text.delta": "text",
+    "response.reasoning_summary_text.delta": "reasoning",
+}
+
+
+class ModelTurn:
+    """One model response, consumed as a stream when MODEL_STREAMING is on.
+
+    computer_call() resolves as soon as the first computer_call item is
+    complete, so the action can run while the rest of the response (e.g.
+    the reasoning summary) is still being generated; response() resolves
+    with the final response. Text and reasoning deltas are passed to
+    `on_event` as they arrive.
+    """
+
+    def __init__(self, on_event=None):
+        loop = asyncio.get_running_loop()
+        self.first_call: asyncio.Future = loop.create_future()
+        self.final: asyncio.Future = loop.create_future()
+        self.response_id: Optional[str] = None
+        self.on_event = on_event
+        self.task: Optional[asyncio.Task] = None
+        for future in (self.first_call, self.final):
+            # 例外由 computer_call() / response() 的呼叫者處理，避免未讀取的警告
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+    @classmethod
+    def completed(cls, response) -> "ModelTurn":
+        """A turn for a response that is already complete (non-streaming)."""
+        turn = cls()
+        turn._finish(response)
+        return turn
+
+    def _finish(self, response):
+        self.response_id = response.id
+        if not self.first_call.done():
+            self.first_call.set_result(first_computer_call(response))
+        if not self.final.done():
+            self.final.set_result(response)
+
+    def _fail(self, error: BaseException):
+        for future in (self.first_call, self.final):
+            if not future.done():
+                future.set_exception(error)
+
+    async def consume(self, stream):
+        started = time.perf_counter()
+        response = None
+        try:
+            async for event in stream:
+                event_type = getattr(event, "type", "")
+                if event_type == "response.created":
+                    self.response_id = event.response.id
+                elif event_type == "response.output_item.done":
+                    if getattr(event.item, "type", None) == "computer_call" and not self.first_call.done():
+                        MODEL_CALL_SECONDS.observe(time.perf_counter() - started, call="first_computer_call")
+                        self.first_call.set_result(event.item)
+                elif event_type in MODEL_DELTA_EVENTS:
+                    if self.on_event:
+                        await self.on_event({
+                            "type": "ai_delta",
+                            "kind": MODEL_DELTA_EVENTS[event_type],
+                            "delta": event.delta,
+                            "response_id": self.response_id
+                        })
+                elif event_type in ("response.completed", "response.incomplete"):
+                    response = event.response
+                elif event_type == "response.failed":
+                    error = getattr(event.response, "error", None)
+                    raise Exception(getattr(error, "message", None) or "Model response failed")
+                elif event_type == "error":
+                    raise Exception(getattr(event, "message", None) or "Model stream error")
+            if response is None:
+                raise Exception("Model stream ended before the response completed")
+            MODEL_CALL_SECONDS.observe(time.perf_counter() - started, call="create")
+            self._finish(response)
+        except asyncio.CancelledError:
+            self._fail(Exception("Model stream cancelled"))
+            raise
+        except Exception as e:
+            MODEL_CALL_ERRORS.inc(call="create")
+            self._fail(e)
+        finally:
+            try:
+                await stream.close()
+            except Exception:
+                pass
+
+    async def computer_call(self):
+        """The first computer_call of the response, or None if it has none."""
+        return await asyncio.shield(self.first_call)
+
+    async def response(self):
+        return await asyncio.shield(self.final)
+
+    def cancel(self):
+        if self.task and not self.task.done():
+            self.task.cancel()
+
+
+async def start_model_turn(session: Session, on_event=None, **kwargs) -> ModelTurn:
+    """Send a responses.create request and return its turn without waiting for the output."""
+    if not MODEL_STREAMING:
+        return ModelTurn.completed(await create_model_response(session, **kwargs))
+    session.state["model_calls"]["create"] += 1
+    turn = ModelTurn(on_event)
+    try:
+        stream = await openai_client.responses.create(stream=True, **kwargs)
+    except Exception:
+        MODEL_CALL_ERRORS.inc(call="create")
+        raise
+    turn.task = asyncio.create_task(turn.consume(stream))
+    return turn
+
+
+async def relay_model_events(events: asyncio.Queue, until: asyncio.Future):
+    """Yield events queued by a streaming turn until `until` resolves (used by the SSE endpoint)."""
+    while not until.done():
+        getter = asyncio.ensure_future(events.get())
+        await asyncio.wait({getter, until}, return_when=asyncio.FIRST_COMPLETED)
+        if getter.done():
+            yield getter.result()
+        else:
+            getter.cancel()
+    while not events.empty():
+        yield events.get_nowait()
+
+
+async def run_ai_task_background(session: Session, task: str, resume_response_id: Optional[str] = None,
+                                 max_iterations: int = MAX_AI_ITERATIONS, task_id: Optional[str] = None,
+                                 continues: Optional[tuple] = None) -> dict:
+    """Run AI task in background and broadcast progress to the session's viewers.
+
+    `continues` is (trajectory, replayed_steps) when the task takes over a
+    replay that diverged. Returns the finished task record.
+    """
+    state, manager = session.state, session.manager
+    
+    state["model_calls"] = {"create": 0, "retrieve": 0}
+    record = start_task_record(session, task, task_id=task_id)
+    recorder = TrajectoryRecorder(session, record, *(continues or ())) if TRAJECTORY_DIR else None
+    status = "stopped"
+    cache_key = None
+    turn = None
+    try:
+        timer = IterationTimer(0)
+        if resume_response_id:
+            # Resume from an existing response
+            with timer.phase("model"):
+                turn = ModelTurn.completed(await retrieve_model_response(session, resume_response_id))
+        else:
+            # Take initial screenshot
+            image_url = await capture_model_observation(session, timer)
+            if recorder:
+                await recorder.start()
+            image_url, cache_key, cached = await apply_cached_actions(session, task, image_url, timer, recorder)
+            content = [{"type": "input_text", "text": task}, {"type": "input_image", "image_url": image_url}]
+            if cached:
+                content.insert(1, {"type": "input_text", "text": cached_actions_note(cached)})
+            
+            # Initial request to AI model (streamed; returns once the first action is ready)
+            with timer.phase("model"):
+                turn = await start_model_turn(
+                    session,
+                    manager.broadcast,
+                    model=MODEL_DEPLOYMENT,
+                    tools=[computer_use_tool()],
+                    instructions="You are an AI agent with the ability to control a browser. You can control the keyboard and mouse. You take a screenshot after each action to check if your action was successful. Once you have completed the requested task you should stop running and pass back control to your human operator.",
+                    input=[{
+                        "role": "user",
+                        "content": content
+                    }],
+                    reasoning={"generate_summary": "concise"},
+                    truncation="auto"
+                )
+                await turn.computer_call()
+        
+        state["current_response_id"] = turn.response_id
+        await manager.broadcast(record_iteration_timing(record, timer))
         
         # Execute AI task loop
-        for iteration in range(MAX_AI_ITERATIONS):
+        for iteration in range(max_iterations):
             if not state["ai_running"]:
                 break
                 
             state["iteration_count"] = iteration + 1
             
-            # Get current response
-            response = openai_client.responses.retrieve(response_id=state["current_response_id"])
-            
-            # Check if there's output
-            if not hasattr(response, 'output') or not response.output:
+            computer_call = await turn.computer_call()
+            if computer_call is None:
+                response = await turn.response()
+                text_messages = response_messages(response)
+                if text_messages:
+                    record["messages"].extend(text_messages)
+                    await manager.broadcast({
+                        "type": "ai_message",
+                        "message": "\n".join(text_messages),
+                        "iteration": state["iteration_count"]
+                    })
+                status = "completed"
                 await manager.broadcast({
                     "type": "ai_message",
                     "message": "✅ AI 任務完成",
@@ -394,38 +2986,19 @@ async def run_ai_task_background(task: str):
                 })
                 break
             
-            # Extract text and reasoning
-            text_messages = []
-            for item in response.output:
-                if hasattr(item, 'type') and item.type == "text":
-                    text_messages.append(item.text)
-            
-            # Broadcast AI messages
-            if text_messages:
-                await manager.broadcast({
-                    "type": "ai_message",
-                    "message": "\n".join(text_messages),
-                    "iteration": state["iteration_count"]
-                })
-            
-            # Extract computer calls
-            computer_calls = [item for item in response.output 
-                             if hasattr(item, 'type') and item.type == "computer_call"]
-            
-            if not computer_calls:
+            if not hasattr(computer_call, 'call_id') or not hasattr(computer_call, 'action'):
+                status = "completed"
                 await manager.broadcast({
                     "type": "ai_message",
-                    "message": "✅ AI 任務完成",
+                    "message": "✅ AI 任務完成（無效的動作）",
                     "status": "completed"
                 })
                 break
             
-            computer_call = computer_calls[0]
-            if not hasattr(computer_call, 'call_id') or not hasattr(computer_call, 'action'):
-                break
-            
-            call_id = computer_call.call_id
             action = computer_call.action
+            timer = IterationTimer(iteration + 1)
+            if cache_key and not getattr(computer_call, "pending_safety_checks", None):
+                action_cache.store(cache_key, action_to_dict(action))
             
             # Broadcast action info
             await manager.broadcast({
@@ -434,76 +3007,58 @@ async def run_ai_task_background(task: str):
                 "iteration": state["iteration_count"]
             })
             
-            # Execute the action
-            await page.bring_to_front()
-            await handle_ai_action(action)
+            # Execute the action, wait for the page and take a screenshot
+            url_before = session.page.url
+            input_content, _ = await execute_computer_call(session, computer_call, timer)
+            if recorder:
+                await recorder.add_step(action, timer, url_before)
             
-            # Handle new tabs/pages and wait for navigation
-            if action.type in ["click"]:
-                await asyncio.sleep(0.8)  # 給頁面時間開始導航
-                
-                # 檢查是否有新分頁
-                all_pages = page.context.pages
-                if len(all_pages) > 1:
-                    newest_page = all_pages[-1]
-                    if newest_page != page and newest_page.url not in ["about:blank", ""]:
-                        # 正確更新全域變數
-                        page = newest_page
-                        globals()['page'] = newest_page
-                        print(f"📄 切換到新分頁: {newest_page.url}")
-                
-                # 等待當前頁面完成導航（如果有的話）
-                try:
-                    await page.wait_for_load_state("networkidle", timeout=3000)
-                except Exception:
-                    try:
-                        await page.wait_for_load_state("domcontentloaded", timeout=2000)
-                    except Exception:
-                        pass  # 如果沒有導航就繼續
-            elif action.type != "wait":
-                await asyncio.sleep(0.3)
-            
-            # Take screenshot after action
-            screenshot_b64 = await take_screenshot_safe()
-            
-            # Check for safety checks
-            acknowledged_checks = []
-            if hasattr(computer_call, 'pending_safety_checks') and computer_call.pending_safety_checks:
-                acknowledged_checks = computer_call.pending_safety_checks
+            # Continue with cached actions while the screen matches an earlier run
+            output = input_content[0]["output"]
+            output["image_url"], cache_key, cached = await apply_cached_actions(
+                session, task, output["image_url"], timer, recorder)
+            if cached:
+                input_content.append({"role": "user", "content": [{"type": "input_text", "text": cached_actions_note(cached)}]})
             
-            # Prepare input for next request
-            input_content = [{
-                "type": "computer_call_output",
-                "call_id": call_id,
-                "output": {
-                    "type": "input_image",
-                    "image_url": f"data:image/png;base64,{screenshot_b64}"
-                }
-            }]
-            
-            if acknowledged_checks:
-                input_content[0]["acknowledged_safety_checks"] = [
-                    {"id": c.id, "code": c.code, "message": c.message}
-                    for c in acknowledged_checks
-                ]
+            # The rest of the response was generated while the action ran
+            with timer.phase("model"):
+                response = await turn.response()
+            text_messages = response_messages(response)
+            if text_messages:
+                record["messages"].extend(text_messages)
+                await manager.broadcast({
+                    "type": "ai_message",
+                    "message": "\n".join(text_messages),
+                    "iteration": state["iteration_count"]
+                })
             
             # Send screenshot back for next step
-            next_response = openai_client.responses.create(
-                model=MODEL_DEPLOYMENT,
-                previous_response_id=response.id,
-                tools=[{
-                    "type": "computer_use_preview",
-                    "display_width": DISPLAY_WIDTH,
-                    "display_height": DISPLAY_HEIGHT,
-                    "environment": "browser"
-                }],
-                input=input_content,
-                truncation="auto"
-            )
+            with timer.phase("model"):
+                turn = await start_model_turn(
+                    session,
+                    manager.broadcast,
+                    model=MODEL_DEPLOYMENT,
+                    previous_response_id=response.id,
+                    tools=[computer_use_tool()],
+                    input=input_content,
+                    truncation="auto"
+                )
+                await turn.computer_call()
             
-            state["current_response_id"] = next_response.id
+            state["current_response_id"] = turn.response_id
+            await manager.broadcast(record_iteration_timing(record, timer))
+        else:
+            # 迭代次數用完（不是使用者停止）
+            if state["ai_running"]:
+                status = "max_iterations"
+                await manager.broadcast({
+                    "type": "ai_message",
+                    "message": f"⏹ 已達迭代上限 ({max_iterations})",
+                    "status": "max_iterations"
+                })
             
     except Exception as e:
+        status = "error"
         print(f"❌ AI task error: {e}")
         await manager.broadcast({
             "type": "ai_message",
@@ -511,18 +3066,34 @@ async def run_ai_task_background(task: str):
             "status": "error"
         })
     finally:
+        if turn:
+            turn.cancel()
         state["ai_running"] = False
         state["mode"] = "idle"
+        finish_task_record(session, record, status)
+        # 接續 response 的任務沒有完整的起點，不保存軌跡
+        if recorder and not resume_response_id and recorder.steps:
+            await recorder.save(status)
+        print(f"📈 AI 任務結束: {state['iteration_count']} 次迭代，模型呼叫 {state['model_calls']}")
         await manager.broadcast({
             "type": "ai_status",
-            "status": "stopped"
+            "status": "stopped",
+            "task_id": record["task_id"],
+            "response_id": state["current_response_id"],
+            "model_calls": state["model_calls"]
         })
+    
+    return record
 
 
-async def run_browser_use_task_background(task: str):
-    """Run browser-use task in background and broadcast progress via WebSocket."""
-    global browser_use_session
+async def run_browser_use_task_background(session: Session, task: str) -> dict:
+    """Run browser-use task in background and broadcast progress to the session's viewers.
+
+    Returns {"status": ..., "result": ...}.
+    """
+    state, manager = session.state, session.manager
     
+    outcome = {"status": "error", "result": None}
     try:
         if not browser_use_session:
             await manager.broadcast({
@@ -530,36 +3101,16 @@ async def run_browser_use_task_background(task: str):
                 "message": "❌ Browser-use 未初始化",
                 "status": "error"
             })
-            return
+            outcome["result"] = "Browser-use session not available"
+            return outcome
             
         # Import browser-use components
-        from browser_use import Agent, ChatAzureOpenAI
+        from browser_use import Agent
         
-        # Initialize LLM with Browser Use Azure OpenAI configuration
-        llm = ChatAzureOpenAI(
-            model='gpt-5.1',
-            azure_deployment=BROWSER_USE_MODEL,  # Azure 部署名稱
-            azure_endpoint=BROWSER_USE_AZURE_ENDPOINT,
-            api_key=BROWSER_USE_AZURE_API_KEY,
-            api_version="2024-12-01-preview",
-            temperature=0.1,
-            dont_force_structured_output=True,
-        )
-        
-        # Wrap the client to fix Markdown JSON issues (especially for Linux environments)
-        try:
-            # Force initialization of the client
-            original_client = llm.get_client()
-            # Replace with our wrapper
-            llm.client = AsyncAzureOpenAIWrapper(original_client)
-            print("✅ Applied Markdown JSON fix wrapper to Azure client")
-        except Exception as e:
-            print(f"⚠️ Failed to apply fix wrapper: {e}")
-        
-        # Create agent with our existing browser session
+        # Create agent with the cached LLM client and our existing browser session
         agent = Agent(
             task=task,
-            llm=llm,
+            llm=get_browser_use_llm(),
             browser_session=browser_use_session
         )
         
@@ -571,6 +3122,7 @@ async def run_browser_use_task_background(task: str):
         
         # Execute the task
         result = await agent.run()
+        outcome = {"status": "completed", "result": str(result)}
         
         await manager.broadcast({
             "type": "browser_use_message",
@@ -580,6 +3132,7 @@ async def run_browser_use_task_background(task: str):
         
     except Exception as e:
         print(f"❌ Browser-use task error: {e}")
+        outcome["result"] = str(e)
         await manager.broadcast({
             "type": "browser_use_message",
             "message": f"❌ 錯誤: {str(e)}",
@@ -589,28 +3142,91 @@ async def run_browser_use_task_background(task: str):
         state["browser_use_running"] = False
         state["mode"] = "idle"
         
-        # Reset browser session for next use
+        # Soft-reset the browser session for next use (reconnects only if unhealthy)
         await reset_browser_use_session()
         
         await manager.broadcast({
             "type": "browser_use_status",
             "status": "stopped"
         })
+    
+    return outcome
+
+
+def get_browser_use_llm():
+    """Build the browser-use LLM client once and reuse it (and its connection pool) for every task."""
+    global browser_use_llm
+    
+    if browser_use_llm is not None:
+        return browser_use_llm
+    
+    from browser_use import ChatAzureOpenAI
+    
+    # Initialize LLM with Browser Use Azure OpenAI configuration
+    llm = ChatAzureOpenAI(
+        model='gpt-5.1',
+        azure_deployment=BROWSER_USE_MODEL,  # Azure 部署名稱
+        azure_endpoint=BROWSER_USE_AZURE_ENDPOINT,
+        api_key=BROWSER_USE_AZURE_API_KEY,
+        api_version="2024-12-01-preview",
+        temperature=0.1,
+        dont_force_structured_output=True,
+    )
+    
+    # Wrap the client to fix Markdown JSON issues (especially for Linux environments)
+    try:
+        # Force initialization of the client
+        original_client = llm.get_client()
+        # Replace with our wrapper
+        llm.client = AsyncAzureOpenAIWrapper(original_client)
+        print("✅ Applied Markdown JSON fix wrapper to Azure client")
+    except Exception as e:
+        print(f"⚠️ Failed to apply fix wrapper: {e}")
+    
+    browser_use_llm = llm
+    return llm
 
 
-async def reset_browser_use_session():
-    """Reset the browser-use session."""
+def new_browser_use_session():
+    """Browser-use session on our Chromium that stays connected across agent runs."""
+    from browser_use import BrowserSession
+    # keep_alive: Agent 結束時不關閉 CDP 連線，下一個任務直接沿用
+    return BrowserSession(cdp_url=cdp_url, keep_alive=True)
+
+
+async def browser_use_session_healthy() -> bool:
+    """Cheap liveness probe of the browser-use CDP connection."""
+    if not browser_use_session:
+        return False
+    if getattr(browser_use_session, "cdp_client", None) is None:
+        return True  # 尚未連線，下一個 Agent 會自行連線
+    try:
+        await asyncio.wait_for(browser_use_session.get_current_page_url(), BROWSER_USE_HEALTH_TIMEOUT)
+        return True
+    except Exception as e:
+        print(f"⚠️ Browser-use health check failed: {e}")
+        return False
+
+
+async def reset_browser_use_session(force: bool = False):
+    """Soft-reset the browser-use session between tasks.
+
+    The CDP connection is kept when the health check passes; otherwise (or
+    with force=True) the session is stopped and recreated.
+    """
     global browser_use_session
     
+    if not force and await browser_use_session_healthy():
+        return
+    
     try:
         if browser_use_session:
             # Stop existing session
-            await browser_use_session.stop()
+            await browser_use_session.kill()
             print("✅ Browser-use session stopped")
         
         # Recreate session
-        from browser_use import BrowserSession
-        browser_use_session = BrowserSession(cdp_url=cdp_url)
+        browser_use_session = new_browser_use_session()
         print("✅ Browser-use session reset complete")
         
     except Exception as e:
@@ -618,9 +3234,482 @@ async def reset_browser_use_session():
         browser_use_session = None
 
 
-async def handle_ai_action(action):
+async def start_ai_task(session: Session, task: str, resume_response_id: Optional[str] = None,
+                        max_iterations: int = MAX_AI_ITERATIONS, task_id: Optional[str] = None) -> asyncio.Task:
+    """Mark the session as running an AI task and launch it in the background."""
+    state = session.state
+    state["mode"] = "ai"
+    state["task"] = task
+    state["ai_running"] = True
+    state["iteration_count"] = 0
+    
+    # Broadcast AI status to WebSocket clients
+    await session.manager.broadcast({
+        "type": "ai_status",
+        "status": "starting",
+        "task": task
+    })
+    
+    runner = asyncio.create_task(run_ai_task_background(session, task, resume_response_id, max_iterations, task_id))
+    runner.add_done_callback(session.task_finished)
+    return runner
+
+
+async def run_replay_background(session: Session, trajectory: dict, fallback: bool = True,
+                                max_iterations: int = MAX_AI_ITERATIONS) -> dict:
+    """Replay a recorded trajectory without model calls.
+
+    Before each step the current URL and screen are compared with the
+    recording; on divergence the live model takes over from there when
+    `fallback` is set. Returns the replay's task record.
+    """
+    state, manager = session.state, session.manager
+    
+    state["model_calls"] = {"create": 0, "retrieve": 0}
+    record = start_task_record(session, trajectory["task"], kind="replay")
+    record["replay_of"] = trajectory["task_id"]
+    status = "stopped"
+    diverged_at, reason = None, None
+    try:
+        if trajectory["observation"] != list(observation_size()):
+            diverged_at, reason = 0, "observation size changed"
+        elif urlsplit(trajectory["initial_url"] or "").scheme in ("http", "https") \
+                and not same_page(session.page.url, trajectory["initial_url"]):
+            # 從紀錄的起始頁開始重播
+            await session.page.goto(trajectory["initial_url"], wait_until="domcontentloaded")
+            await wait_for_page_settle(session.page)
+        
+        expected_hash = trajectory["initial_hash"]
+        after = time.monotonic() - STREAM_POLL_INTERVAL
+        for index, step in enumerate(trajectory["steps"]):
+            if diverged_at is not None or not state["ai_running"]:
+                break
+            
+            reason = await check_replay_divergence(session, step, expected_hash, after)
+            if reason:
+                diverged_at = index
+                break
+            
+            state["iteration_count"] = index + 1
+            action = SimpleNamespace(**step["action"])
+            timer = IterationTimer(index + 1)
+            await manager.broadcast({
+                "type": "ai_action",
+                "action": action.type,
+                "iteration": state["iteration_count"],
+                "replay": True
+            })
+            
+            after, _ = await perform_action(session, action, timer, replay=True)
+            expected_hash = step.get("hash")
+            await manager.broadcast(record_iteration_timing(record, timer))
+        else:
+            if diverged_at is None:
+                status = "completed"
+                await manager.broadcast({
+                    "type": "ai_message",
+                    "message": f"✅ 重播完成（{len(trajectory['steps'])} 步）",
+                    "status": "completed"
+                })
+    except Exception as e:
+        status = "error"
+        print(f"❌ Replay error: {e}")
+        await manager.broadcast({
+            "type": "ai_message",
+            "message": f"❌ 重播錯誤: {str(e)}",
+            "status": "error"
+        })
+    
+    take_over = diverged_at is not None and fallback and state["ai_running"]
+    if diverged_at is not None:
+        status = "diverged"
+        record["diverged_at"] = diverged_at
+        print(f"🔀 重播在第 {diverged_at + 1} 步偏離紀錄: {reason}")
+        await manager.broadcast({
+            "type": "ai_message",
+            "message": f"🔀 重播在第 {diverged_at + 1} 步偏離紀錄（{reason}）" + ("，改由 AI 接手" if take_over else ""),
+            "status": "diverged"
+        })
+    finish_task_record(session, record, status)
+    
+    if take_over:
+        fallback_record = await run_ai_task_background(
+            session, trajectory["task"], max_iterations=max_iterations,
+            continues=(trajectory, diverged_at)
+        )
+        record["fallback_task_id"] = fallback_record["task_id"]
+        return record
+    
+    state["ai_running"] = False
+    state["mode"] = "idle"
+    print(f"📈 重播結束: {state['iteration_count']} 步")
+    await manager.broadcast({
+        "type": "ai_status",
+        "status": "stopped",
+        "task_id": record["task_id"],
+        "model_calls": state["model_calls"]
+    })
+    return record
+
+
+async def start_replay_task(session: Session, trajectory: dict, fallback: bool = True,
+                            max_iterations: int = MAX_AI_ITERATIONS) -> asyncio.Task:
+    """Mark the session as running an AI task and replay a trajectory in the background."""
+    state = session.state
+    state["mode"] = "ai"
+    state["task"] = trajectory["task"]
+    state["ai_running"] = True
+    state["iteration_count"] = 0
+    
+    await session.manager.broadcast({
+        "type": "ai_status",
+        "status": "starting",
+        "task": trajectory["task"],
+        "replay_of": trajectory["task_id"]
+    })
+    
+    runner = asyncio.create_task(run_replay_background(session, trajectory, fallback, max_iterations))
+    runner.add_done_callback(session.task_finished)
+    return runner
+
+
+async def start_browser_use_task(session: Session, task: str) -> asyncio.Task:
+    """Mark the session as running a browser-use task and launch it in the background."""
+    state = session.state
+    state["mode"] = "browser-use"
+    state["task"] = task
+    state["browser_use_running"] = True
+    state["iteration_count"] = 0
+    
+    await session.manager.broadcast({
+        "type": "browser_use_status",
+        "status": "starting",
+        "task": task
+    })
+    
+    runner = asyncio.create_task(run_browser_use_task_background(session, task))
+    runner.add_done_callback(session.task_finished)
+    return runner
+
+
+class TaskScheduler:
+    """Priority queue in front of both agent types.
+
+    Tasks are picked by priority (higher first); among equal priorities the
+    tenant that was served least recently goes first, then submission order.
+    One worker per session pulls the next task it can run whenever its
+    session is free: the default session runs both kinds, the worker
+    sessions run computer-use tasks only (browser-use is bound to the
+    default session).
+    """
+
+    KINDS = ("computer-use", "browser-use")
+    FINISHED = ("completed", "stopped", "max_iterations", "error", "cancelled")
+
+    def __init__(self, workers: int, max_queue: int):
+        self.worker_count = workers
+        self.max_queue = max_queue
+        self.queue: list = []
+        self.tasks: "OrderedDict[str, dict]" = OrderedDict()
+        self.available = asyncio.Event()
+        self.workers: Dict[str, asyncio.Task] = {}
+        self.running: Dict[str, dict] = {}  # session_id -> task
+        self.tenant_served: Dict[str, int] = {}
+        self.seq = 0
+        self.dispatched = 0
+        self.counts = {status: 0 for status in ("submitted",) + self.FINISHED}
+        self.wait_times: Deque[float] = deque(maxlen=1000)
+
+    def start(self):
+        # worker session 與預設 session 都計入 MAX_SESSIONS
+        limit = max(0, sessions.max_sessions - 1)
+        if self.worker_count > limit:
+            print(f"⚠️ SCHEDULER_WORKERS={self.worker_count} exceeds MAX_SESSIONS - 1, using {limit} worker sessions")
+            self.worker_count = limit
+        self.workers[DEFAULT_SESSION_ID] = asyncio.create_task(self.worker(DEFAULT_SESSION_ID, self.KINDS))
+        for n in range(1, self.worker_count + 1):
+            session_id = f"worker-{n}"
+            self.workers[session_id] = asyncio.create_task(self.worker(session_id, ("computer-use",)))
+
+    async def stop(self):
+        for worker in self.workers.values():
+            worker.cancel()
+        await asyncio.gather(*self.workers.values(), return_exceptions=True)
+        self.workers.clear()
+
+    def submit(self, task: str, kind: str = "computer-use", priority: int = 0, tenant: str = "default",
+               max_iterations: int = MAX_AI_ITERATIONS, resume_response_id: Optional[str] = None) -> dict:
+        """Queue a task. Raises ValueError for an unknown kind or a full queue."""
+        if kind not in self.KINDS:
+            raise ValueError(f"Unknown task kind: {kind}")
+        if len(self.queue) >= self.max_queue:
+            raise ValueError(f"Task queue is full ({self.max_queue})")
+        self.seq += 1
+        item = {
+            "task_id": uuid.uuid4().hex[:12],
+            "kind": kind,
+            "task": task,
+            "priority": priority,
+            "tenant": tenant,
+            "max_iterations": max_iterations,
+            "resume_response_id": resume_response_id,
+            "status": "queued",
+            "seq": self.seq,
+            "submitted_at": time.time(),
+            "started_at": None,
+            "ended_at": None,
+            "session_id": None,
+            "result": None,
+        }
+        self.tasks[item["task_id"]] = item
+        self.queue.append(item)
+        self.counts["submitted"] += 1
+        self._prune()
+        self.available.set()
+        return item
+
+    def _prune(self):
+        # 只淘汰已結束的任務，排隊中與執行中的任務必須保留
+        excess = len(self.tasks) - max(TASK_RECORD_LIMIT, self.max_queue + len(self.workers))
+        for task_id in [t for t, item in self.tasks.items() if item["status"] in self.FINISHED][:max(0, excess)]:
+            del self.tasks[task_id]
+
+    def _pick(self, kinds: tuple) -> Optional[dict]:
+        candidates = [item for item in self.queue if item["kind"] in kinds]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda item: (
+            -item["priority"],
+            self.tenant_served.get(item["tenant"], 0),
+            item["seq"]
+        ))
+
+    async def take(self, kinds: tuple) -> dict:
+        """Wait for the next task this worker can run and remove it from the queue."""
+        while True:
+            item = self._pick(kinds)
+            if item:
+                self.queue.remove(item)
+                return item
+            self.available.clear()
+            await self.available.wait()
+
+    def requeue(self, item: dict):
+        """Put a task taken by a worker back in the queue (keeps its position)."""
+        item["status"] = "queued"
+        self.queue.append(item)
+        self.available.set()
+
+    def position(self, item: dict) -> Optional[int]:
+        if item["status"] != "queued":
+            return None
+        ordered = sorted(self.queue, key=lambda i: (-i["priority"], self.tenant_served.get(i["tenant"], 0), i["seq"]))
+        return ordered.index(item) + 1
+
+    def cancel(self, task_id: str) -> Optional[dict]:
+        item = self.tasks.get(task_id)
+        if not item or item["status"] in self.FINISHED:
+            return item
+        if item["status"] == "queued":
+            self.queue.remove(item)
+            self._finish(item, "cancelled")
+        else:
+            # 執行中的任務在下一輪迭代停止
+            item["cancel_requested"] = True
+            session = sessions.get(item["session_id"])
+            if session:
+                session.state["ai_running"] = False
+                session.state["browser_use_running"] = False
+                session.state["mode"] = "idle"
+        return item
+
+    def _finish(self, item: dict, status: str):
+        item["status"] = status
+        item["ended_at"] = time.time()
+        self.counts[status] += 1
+
+    async def worker(self, session_id: str, kinds: tuple):
+        while True:
+            try:
+                session = sessions.get(session_id)
+                if session is None:
+                    session = await sessions.create(session_id)
+                # 等 session 空出來才領任務（可能有人直接用 /ai/start 佔用）
+                await session.wait_free()
+                item = await self.take(kinds)
+                if session.busy or sessions.get(session_id) is not session:
+                    self.requeue(item)
+                    continue
+                await self.run(session, item)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                print(f"⚠️ Scheduler worker {session_id} error: {e}")
+                await asyncio.sleep(5)
+
+    async def run(self, session: Session, item: dict):
+        # 公平性計數只在真的開始執行時更新，被放回佇列的任務不算
+        self.dispatched += 1
+        self.tenant_served[item["tenant"]] = self.dispatched
+        item["status"] = "running"
+        item["started_at"] = time.time()
+        item["session_id"] = session.id
+        self.wait_times.append(item["started_at"] - item["submitted_at"])
+        self.running[session.id] = item
+        print(f"📋 [{session.id}] 開始排程任務 {item['task_id']} ({item['kind']}, priority {item['priority']}, tenant {item['tenant']})")
+        try:
+            if item["kind"] == "browser-use":
+                outcome = await (await start_browser_use_task(session, item["task"]))
+                status, item["result"] = outcome["status"], outcome["result"]
+            else:
+                runner = await start_ai_task(session, item["task"], item["resume_response_id"],
+                                             item["max_iterations"], task_id=item["task_id"])
+                record = await runner
+                status = record["status"]
+                item["result"] = {
+                    "messages": record["messages"],
+                    "iterations": record["iteration_count"],
+                    "response_id": session.state["current_response_id"],
+                    "model_calls": record["model_calls"],
+                }
+        except Exception as e:
+            status, item["result"] = "error", str(e)
+        finally:
+            self.running.pop(session.id, None)
+        self._finish(item, "cancelled" if item.get("cancel_requested") else status)
+
+    def snapshot(self, item: dict) -> dict:
+        now = time.time()
+        started = item["started_at"] or now
+        result = {key: value for key, value in item.items() if key not in ("seq", "result", "cancel_requested")}
+        result["position"] = self.position(item)
+        result["wait_s"] = round(started - item["submitted_at"], 3)
+        if item["started_at"]:
+            result["run_s"] = round((item["ended_at"] or now) - item["started_at"], 3)
+        return result
+
+    def metrics(self) -> dict:
+        now = time.time()
+        by_priority: Dict[int, int] = {}
+        by_tenant: Dict[str, int] = {}
+        for item in self.queue:
+            by_priority[item["priority"]] = by_priority.get(item["priority"], 0) + 1
+            by_tenant[item["tenant"]] = by_tenant.get(item["tenant"], 0) + 1
+        waits = list(self.wait_times)
+        return {
+            "queue_depth": len(self.queue),
+            "queue_limit": self.max_queue,
+            "queued_by_priority": by_priority,
+            "queued_by_tenant": by_tenant,
+            "oldest_wait_s": round(max((now - item["submitted_at"] for item in self.queue), default=0.0), 3),
+            "running": len(self.running),
+            "workers": [
+                {
+                    "session_id": session_id,
+                    "task_id": self.running[session_id]["task_id"] if session_id in self.running else None
+                }
+                for session_id in self.workers
+            ],
+            "wait_time_s": {
+                "count": len(waits),
+                "mean": round(sum(waits) / len(waits), 3) if waits else None,
+                "p50": round(percentile(waits, 50), 3) if waits else None,
+                "p95": round(percentile(waits, 95), 3) if waits else None,
+                "max": round(max(waits), 3) if waits else None,
+            },
+            "totals": dict(self.counts),
+        }
+
+
+scheduler = TaskScheduler(SCHEDULER_WORKERS, SCHEDULER_MAX_QUEUE)
+
+
+@metrics.collector
+def collect_session_metrics():
+    """Refresh viewer and browser gauges from the live sessions."""
+    for gauge in (VIEWERS, VIEWER_QUEUE_DEPTH, VIEWER_FRAME_LAG, BROWSER_PAGES):
+        gauge.clear()
+    SESSIONS_OPEN.set(len(sessions.sessions))
+    POOL_READY.set(len(sessions.pool.ready))
+    BROWSER_CONTEXTS.set(len(browser.contexts) if browser else 0)
+    for session in sessions.sessions.values():
+        BROWSER_PAGES.set(len(session.context.pages), session=session.id)
+        # 以 session 彙總，避免每個連線各自產生一組 series
+        viewers: Dict[str, int] = {}
+        channels = list(session.manager.channels.values())
+        for channel in channels:
+            viewers[channel.protocol] = viewers.get(channel.protocol, 0) + 1
+        for protocol, count in viewers.items():
+            VIEWERS.set(count, session=session.id, protocol=protocol)
+        if channels:
+            VIEWER_QUEUE_DEPTH.set(sum(len(c.frames) for c in channels), session=session.id, queue="frames")
+            VIEWER_QUEUE_DEPTH.set(sum(len(c.control) for c in channels), session=session.id, queue="control")
+            VIEWER_FRAME_LAG.set(max(c.frame_lag for c in channels), session=session.id)
+
+
+# 可直接插入文字的 input type；其他欄位（日期、顏色…）與 contenteditable 編輯器需要按鍵事件
+INSERTABLE_INPUT_TYPES = {"", "text", "search", "email", "url", "tel", "password"}
+
+FOCUSED_FIELD_SCRIPT = """
+() => {
+    let el = document.activeElement;
+    while (el && el.shadowRoot && el.shadowRoot.activeElement) el = el.shadowRoot.activeElement;
+    if (!el || el === document.body) return null;
+    return {
+        tag: el.tagName.toLowerCase(),
+        type: (el.getAttribute('type') || '').toLowerCase(),
+        editable: el.isContentEditable,
+        readonly: !!(el.readOnly || el.disabled),
+        maxlength: el.maxLength > 0 ? el.maxLength : null,
+        // 自動完成 / combobox 通常依賴 keydown 事件
+        autocomplete: el.getAttribute('role') === 'combobox' || el.hasAttribute('list')
+            || ['list', 'both'].includes(el.getAttribute('aria-autocomplete'))
+    };
+}
+"""
+
+
+async def choose_text_entry(page, text: str, strategy: str = TYPE_STRATEGY) -> str:
+    """Text entry path for a type action: "insert" (one Input.insertText) or "keys" (per character)."""
+    if strategy in ("insert", "keys"):
+        return strategy
+    if len(text) <= 1:
+        return "keys"
+    try:
+        field = await page.evaluate(FOCUSED_FIELD_SCRIPT)
+    except Exception:
+        return "keys"
+    if not field or field["readonly"] or field["autocomplete"]:
+        return "keys"
+    if field["maxlength"] is not None and len(text) > field["maxlength"]:
+        # 讓瀏覽器照逐字輸入的方式截斷
+        return "keys"
+    if field["tag"] == "textarea":
+        return "insert"
+    if field["tag"] == "input" and field["type"] in INSERTABLE_INPUT_TYPES and "\n" not in text:
+        # 單行輸入框中的換行代表按下 Enter，需要按鍵事件
+        return "insert"
+    return "keys"
+
+
+async def enter_text(page, text: str) -> dict:
+    """Type AI text into the focused element; returns the path used and how long it took."""
+    started = time.perf_counter()
+    path = await choose_text_entry(page, text)
+    if path == "insert":
+        await page.keyboard.insert_text(text)
+    else:
+        await page.keyboard.type(text, delay=TYPE_DELAY_MS)
+    elapsed = time.perf_counter() - started
+    TEXT_ENTRY_SECONDS.observe(elapsed, path=path)
+    return {"text_entry": path, "chars": len(text), "entry_ms": round(elapsed * 1000, 1)}
+
+
+async def handle_ai_action(session: Session, action):
     """Handle different action types from the AI model."""
+    page = session.page
     action_type = action.type
+    detail = {}
     
     if action_type == "drag":
         print("Drag action not supported yet")
@@ -628,7 +3717,7 @@ async def handle_ai_action(action):
         
     elif action_type == "click":
         button = getattr(action, "button", "left")
-        x, y = validate_coordinates(action.x, action.y)
+        x, y = validate_coordinates(action.x, action.y, from_model=True)
         
         print(f"  AI Action: click at ({x}, {y}) with button '{button}'")
         
@@ -640,31 +3729,17 @@ async def handle_ai_action(action):
             await page.mouse.wheel(0, -100)
         else:
             button_type = {"left": "left", "right": "right", "middle": "middle"}.get(button, "left")
-            
-            # 記錄點擊前的 URL
-            url_before = page.url
+            # 導航與頁面穩定由 wait_for_page_settle 處理
             await page.mouse.click(x, y, button=button_type)
-            
-            # 給一點時間讓導航開始
-            await asyncio.sleep(0.2)
-            
-            # 如果 URL 改變了，等待新頁面載入
-            try:
-                if page.url != url_before:
-                    await page.wait_for_load_state("domcontentloaded", timeout=5000)
-                    print(f"🔗 導航完成: {url_before} -> {page.url}")
-            except TimeoutError:
-                pass
         
     elif action_type == "double_click":
-        x, y = validate_coordinates(action.x, action.y)
+        x, y = validate_coordinates(action.x, action.y, from_model=True)
         print(f"  AI Action: double click at ({x}, {y})")
         await page.mouse.dblclick(x, y)
         
     elif action_type == "scroll":
-        scroll_x = getattr(action, "scroll_x", 0)
-        scroll_y = getattr(action, "scroll_y", 0)
-        x, y = validate_coordinates(action.x, action.y)
+        scroll_x, scroll_y = scale_model_offset(getattr(action, "scroll_x", 0), getattr(action, "scroll_y", 0))
+        x, y = validate_coordinates(action.x, action.y, from_model=True)
         
         print(f"  AI Action: scroll at ({x}, {y}) with offsets ({scroll_x}, {scroll_y})")
         await page.mouse.move(x, y)
@@ -688,7 +3763,8 @@ async def handle_ai_action(action):
     elif action_type == "type":
         text = getattr(action, "text", "")
         print(f"  AI Action: type text: {text[:50]}...")
-        await page.keyboard.type(text, delay=20)
+        detail = await enter_text(page, text)
+        print(f"  AI Action: typed {detail['chars']} chars via {detail['text_entry']} in {detail['entry_ms']}ms")
         
     elif action_type == "wait":
         ms = getattr(action, "ms", 1000)
@@ -702,20 +3778,420 @@ async def handle_ai_action(action):
         print(f"  Unrecognized action: {action_type}")
     
     # Record action in history
-    state["history"].append({
-        "type": action_type,
-        "timestamp": time.time(),
-        "mode": "ai"
-    })
+    session.history.append(action_type, "ai", task_id=session.state["task_id"], **detail)
+
+
+HUMAN_INPUT_TYPES = {"click", "keypress", "scroll", "text"}
+
+# Map special keys
+HUMAN_KEY_MAP = {
+    'Enter': 'Enter', 'Backspace': 'Backspace', 'Tab': 'Tab',
+    'Escape': 'Escape', 'ArrowUp': 'ArrowUp', 'ArrowDown': 'ArrowDown',
+    'ArrowLeft': 'ArrowLeft', 'ArrowRight': 'ArrowRight',
+    'Delete': 'Delete', ' ': ' '
+}
+
+
+def scroll_deltas(message: dict) -> Optional[tuple]:
+    """(deltaX, deltaY) of a scroll message as finite floats, or None if either is invalid."""
+    try:
+        delta_x = float(message.get("deltaX", 0))
+        delta_y = float(message.get("deltaY", 0))
+    except (TypeError, ValueError):
+        return None
+    if not (math.isfinite(delta_x) and math.isfinite(delta_y)):
+        return None
+    return delta_x, delta_y
+
+
+def is_printable_keypress(message: dict) -> bool:
+    key = message.get("key", "")
+    return (len(key) == 1 and key.isprintable()
+            and not message.get("ctrl", False) and not message.get("alt", False))
+
+
+class InputCoalescer:
+    """Merges bursts of human input from one WebSocket client.
+
+    Consecutive printable keypresses become one "text" command and
+    consecutive scroll deltas are summed, for at most INPUT_COALESCE_MS
+    after the first event. Any other message flushes what is pending
+    first, so ordering relative to clicks and modifier keys is kept.
+    """
+
+    def __init__(self, session_id: str, window_ms: int = INPUT_COALESCE_MS):
+        self.session_id = session_id
+        self.window = window_ms / 1000
+        self.pending: Optional[dict] = None
+        self.deadline = 0.0
+        self.received = 0
+        self.executed = 0
+        self.merged = 0
+        self.rejected = 0
+
+    def add(self, message: dict) -> list:
+        """Take one message; returns the commands that are ready to run, in order."""
+        self.received += 1
+        if message.get("type") == "scroll":
+            deltas = scroll_deltas(message)
+            if deltas is None:
+                self.rejected += 1
+                print(f"⚠️ Invalid scroll deltas: {message.get('deltaX')!r}, {message.get('deltaY')!r}")
+                return []
+            message = {**message, "deltaX": deltas[0], "deltaY": deltas[1]}
+        kind = None
+        if self.window:
+            if message.get("type") == "keypress" and is_printable_keypress(message):
+                kind = "text"
+            elif message.get("type") == "scroll":
+                kind = "scroll"
+        
+        ready = self.flush() if self.pending and self.pending["type"] != kind else []
+        if kind is None:
+            ready.append(message)
+            self._executed()
+        elif self.pending:
+            if kind == "text":
+                self.pending["text"] += message["key"]
+            else:
+                self.pending["deltaX"] += message.get("deltaX", 0)
+                self.pending["deltaY"] += message.get("deltaY", 0)
+            self.pending["events"] += 1
+            self.merged += 1
+            INPUT_EVENTS.inc(session=self.session_id, result="merged")
+        else:
+            if kind == "text":
+                self.pending = {"type": "text", "text": message["key"], "events": 1}
+            else:
+                self.pending = {"type": "scroll", "deltaX": message.get("deltaX", 0),
+                                "deltaY": message.get("deltaY", 0), "events": 1}
+            self.deadline = time.monotonic() + self.window
+        return ready
+
+    def flush(self) -> list:
+        """The pending merged command, if any."""
+        if not self.pending:
+            return []
+        command, self.pending = self.pending, None
+        self._executed()
+        return [command]
+
+    def timeout(self) -> Optional[float]:
+        """Seconds until the pending command must run (None if nothing is pending)."""
+        if not self.pending:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def _executed(self):
+        self.executed += 1
+        INPUT_EVENTS.inc(session=self.session_id, result="executed")
+
+    def stats(self) -> dict:
+        return {
+            "window_ms": round(self.window * 1000),
+            "received": self.received,
+            "executed": self.executed,
+            "merged": self.merged,
+            "rejected": self.rejected
+        }
+
+
+async def handle_human_input(session: Session, message: dict):
+    """Run one human input command (click, keypress, scroll or merged text) on the session page."""
+    state, page = session.state, session.page
+    message_type = message.get("type")
+    state["mode"] = "human"
+    state["last_human"] = time.time()
+    
+    if message_type == "click":
+        x, y = validate_coordinates(message.get("x", 0), message.get("y", 0))
+        
+        # 記錄點擊前的 URL
+        url_before = page.url
+        print(f"👆 Click at ({x}, {y}) on page: {url_before}")
+        
+        await page.mouse.click(x, y)
+        
+        # 等待可能的導航與頁面穩定
+        settle = await wait_for_page_settle(page, timeout=10.0)
+        if page.url != url_before:
+            print(f"✅ 導航完成: {url_before} -> {page.url} ({settle['waited_ms']}ms)")
+        elif not settle["settled"]:
+            print(f"⚠️ 頁面等待超時: {settle['waited_ms']}ms")
+        
+    elif message_type == "keypress":
+        key = message.get("key", "")
+        mapped_key = HUMAN_KEY_MAP.get(key, key)
+        
+        # Build modifiers list
+        modifiers = []
+        if message.get("ctrl", False):
+            modifiers.append('Control')
+        if message.get("shift", False):
+            modifiers.append('Shift')
+        if message.get("alt", False):
+            modifiers.append('Alt')
+        
+        # Type or press key
+        if is_printable_keypress(message):
+            await page.keyboard.type(key)
+        else:
+            # Press with modifiers
+            for mod in modifiers:
+                await page.keyboard.down(mod)
+            await page.keyboard.press(mapped_key)
+            for mod in reversed(modifiers):
+                await page.keyboard.up(mod)
+        
+    elif message_type == "text":
+        # 合併後的連續按鍵：一般輸入框一次插入，其他情況（快捷鍵、依賴按鍵事件的元件）仍逐字送出按鍵
+        text = message.get("text", "")
+        if text and await choose_text_entry(page, text, strategy="auto") == "insert":
+            await page.keyboard.insert_text(text)
+        elif text:
+            await page.keyboard.type(text)
+        
+    elif message_type == "scroll":
+        deltas = scroll_deltas(message)
+        if deltas is None:
+            raise ValueError("Invalid scroll deltas")
+        await page.evaluate("([x, y]) => window.scrollBy(x, y)", list(deltas))
+
+
+async def handle_client_command(session: Session, message: dict):
+    """Run one queued WebSocket command: user input, navigation or a task start."""
+    message_type = message.get("type")
+    
+    if message_type in HUMAN_INPUT_TYPES:
+        await handle_human_input(session, message)
+    
+    # Handle AI commands
+    elif message_type == "ai_start":
+        task = message.get("task", "")
+        if task and not session.busy:
+            # Start AI task in background
+            await start_ai_task(session, task, message.get("resume_response_id"))
+    
+    # Handle Browser-use commands
+    elif message_type == "browser_use_start":
+        task = message.get("task", "")
+        if task and session.id == DEFAULT_SESSION_ID and not session.busy:
+            # Start task in background
+            await start_browser_use_task(session, task)
+    
+    # Handle navigation commands
+    elif message_type == "navigate":
+        url = message.get("url", "")
+        if url:
+            await session.page.goto(url, wait_until="domcontentloaded", timeout=10000)
+            print(f"🌐 Navigated to: {url}")
+    
+    elif message_type == "back":
+        await session.page.go_back(wait_until="domcontentloaded", timeout=5000)
+        print("◀ Go back")
+    
+    elif message_type == "forward":
+        await session.page.go_forward(wait_until="domcontentloaded", timeout=5000)
+        print("▶ Go forward")
+
+
+# 可能等待導航 / 頁面穩定數秒的指令，完成時回報給客戶端
+REPORTED_COMMANDS = {"click", "navigate", "back", "forward"}
+# 經由 CommandDispatcher 排隊執行的指令
+QUEUED_COMMANDS = HUMAN_INPUT_TYPES | {"ai_start", "browser_use_start", "navigate", "back", "forward"}
+
+
+class CommandDispatcher:
+    """Runs one WebSocket client's commands in order on a background task.
+
+    The receive loop only parses and queues messages, so pings, get_state
+    and stop requests are handled while a click waits for the page to
+    settle or a navigation loads. Human input is coalesced here. Commands
+    that can take long (and any command sent with an "id") report back
+    with command_done / command_error when they finish.
+    """
+
+    def __init__(self, session: Session, websocket: WebSocket):
+        self.session = session
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=WS_COMMAND_QUEUE)
+        self.coalescer = InputCoalescer(session.id)
+        self.current: Optional[str] = None
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.worker = asyncio.create_task(self.run())
+
+    def submit(self, message: dict) -> bool:
+        """Queue a command; False if the queue is full."""
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+
+    def discard(self, command_types: set) -> int:
+        """Drop queued commands of the given types (e.g. task starts after a stop); returns how many."""
+        kept, removed = [], 0
+        while not self.queue.empty():
+            message = self.queue.get_nowait()
+            if message is not None and message.get("type") in command_types:
+                removed += 1
+            else:
+                kept.append(message)
+        for message in kept:
+            self.queue.put_nowait(message)
+        return removed
+
+    async def run(self):
+        while True:
+            try:
+                message = await asyncio.wait_for(self.queue.get(), self.coalescer.timeout())
+            except asyncio.TimeoutError:
+                # 合併視窗結束，執行累積的按鍵 / 捲動
+                commands = self.coalescer.flush()
+            else:
+                if message is None:
+                    for command in self.coalescer.flush():
+                        await self.execute(command)
+                    return
+                if message.get("type") in HUMAN_INPUT_TYPES:
+                    commands = self.coalescer.add(message)
+                else:
+                    commands = self.coalescer.flush() + [message]
+            for command in commands:
+                await self.execute(command)
+
+    async def execute(self, command: dict):
+        command_type = command.get("type")
+        manager = self.session.manager
+        self.current = command_type
+        started = time.perf_counter()
+        try:
+            await handle_client_command(self.session, command)
+        except Exception as e:
+            self.failed += 1
+            print(f"❌ WebSocket command error ({command_type}): {e}")
+            await manager.send(self.websocket, {
+                "type": "command_error",
+                "command": command_type,
+                "id": command.get("id"),
+                "message": str(e)
+            })
+        else:
+            self.completed += 1
+            if command_type in REPORTED_COMMANDS or command.get("id") is not None:
+                await manager.send(self.websocket, {
+                    "type": "command_done",
+                    "command": command_type,
+                    "id": command.get("id"),
+                    "ms": round((time.perf_counter() - started) * 1000, 1),
+                    "url": self.session.page.url if self.session.page else None
+                })
+        finally:
+            self.current = None
+
+    async def close(self, timeout: float = 5.0):
+        """Finish input that was already received (for up to `timeout` seconds), then stop."""
+        try:
+            self.queue.put_nowait(None)
+        except asyncio.QueueFull:
+            self.worker.cancel()
+        done, _ = await asyncio.wait({self.worker}, timeout=timeout)
+        if not done:
+            print("⚠️ WebSocket 指令佇列未在時限內完成，已取消")
+            self.worker.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queue.qsize(),
+            "running": self.current,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "input": self.coalescer.stats()
+        }
+
+
+# ============================================================================
+# API Endpoints
+# ============================================================================
+
+class SessionCreateRequest(BaseModel):
+    session_id: Optional[str] = None
+    url: Optional[str] = INITIAL_URL
+
+
+def session_not_found(session_id: str) -> dict:
+    return {
+        "status": "error",
+        "message": f"Session {session_id} not found"
+    }
+
+
+@app.get("/sessions")
+async def list_sessions():
+    """List open browser sessions."""
+    return {
+        "sessions": [session.info() for session in sessions.sessions.values()],
+        "total": len(sessions.sessions),
+        "max_sessions": sessions.max_sessions,
+        "pool": sessions.pool.stats()
+    }
+
+
+@app.post("/sessions")
+async def create_session(request: SessionCreateRequest):
+    """Open a new isolated browser session (own context, page, tasks and viewers)."""
+    try:
+        session = await sessions.create(request.session_id, request.url or INITIAL_URL)
+    except Exception as e:
+        return {
+            "status": "error",
+            "message": str(e)
+        }
+    return {
+        "status": "created",
+        **session.info(),
+        "ws_url": f"/sessions/{session.id}/ws"
+    }
 
 
-# ============================================================================
-# API Endpoints
-# ============================================================================
+@app.get("/sessions/{session_id}")
+async def get_session(session_id: str):
+    """Get a session's summary."""
+    session = sessions.get(session_id)
+    if not session:
+        return session_not_found(session_id)
+    return session.info()
+
+
+@app.delete("/sessions/{session_id}")
+async def delete_session(session_id: str):
+    """Stop a session's tasks, disconnect its viewers and close its context."""
+    if session_id == DEFAULT_SESSION_ID:
+        return {
+            "status": "error",
+            "message": "The default session cannot be closed"
+        }
+    if not await sessions.close(session_id):
+        return session_not_found(session_id)
+    return {
+        "status": "closed",
+        "session_id": session_id
+    }
+
 
 @app.get("/api/status")
-async def api_status():
+@app.get("/sessions/{session_id}/status")
+async def api_status(session_id: str = DEFAULT_SESSION_ID):
     """API status and info."""
+    session = sessions.get(session_id)
+    if not session:
+        return session_not_found(session_id)
+    state, manager = session.state, session.manager
+    
     return {
         "status": "running",
         "version": "1.0.0",
@@ -723,34 +4199,83 @@ async def api_status():
         "ai_running": state["ai_running"],
         "browser_use_running": state["browser_use_running"],
         "current_task": state["task"],
+        "stream_mode": manager.stream_mode,
+        "worker": WORKER_INDEX,
         "cdp_url": cdp_url
     }
 
 
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics for streaming, viewers, the agent loop and the browser."""
+    PROCESS_MEMORY.set(round(await asyncio.to_thread(process_tree_rss_mb) * 1024 * 1024))
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/api/viewers")
+@app.get("/sessions/{session_id}/viewers")
+async def api_viewers(session_id: str = DEFAULT_SESSION_ID):
+    """Per-viewer send queue depth, dropped frames and lag."""
+    session = sessions.get(session_id)
+    if not session:
+        return session_not_found(session_id)
+    manager = session.manager
+    
+    return {
+        "connections": len(manager.active_connections),
+        "frame_seq": manager.frame_seq,
+        "frames_skipped": manager.frames_skipped,
+        "delta_encoding": manager.delta_encoder is not None,
+        "frame_store": session.frame_store.stats(),
+        "clients": manager.client_stats()
+    }
+
+
 @app.get("/screenshot")
-async def screenshot():
+@app.get("/sessions/{session_id}/screenshot")
+async def screenshot(session_id: str = DEFAULT_SESSION_ID):
     """Get current browser screenshot."""
-    screenshot_b64 = await take_screenshot_safe()
+    session = sessions.get(session_id)
+    if not session:
+        return session_not_found(session_id)
+    state = session.state
+    
+    frame = await session.frame_store.get(after=time.monotonic() - STREAM_POLL_INTERVAL)
     return {
-        "image": screenshot_b64,
+        "image": frame["image"],
+        "format": frame["format"],
+        "version": frame["version"],
         "width": DISPLAY_WIDTH,
         "height": DISPLAY_HEIGHT,
-        "url": page.url if page else None,
+        "url": session.page.url if session.page else None,
         "mode": state["mode"]
     }
 
 
 @app.websocket("/ws/screenshot")
-async def websocket_screenshot(websocket: WebSocket):
+@app.websocket("/sessions/{session_id}/ws")
+async def websocket_screenshot(websocket: WebSocket, session_id: str = DEFAULT_SESSION_ID):
     """
     WebSocket endpoint for streaming screenshots and handling user interactions.
-    Continuously sends screenshots to connected clients at ~30 FPS.
-    Also handles incoming user actions (click, keypress, scroll, AI commands).
+    Continuously sends screenshots to connected clients.
+    Clients connecting with ?protocol=binary receive frames as binary messages
+    (FRAME_HEADER + raw image bytes); other clients get base64 JSON frames.
+    Also handles incoming user actions (click, keypress, scroll, AI commands);
+    these run in order on the connection's CommandDispatcher while control
+    messages (ping, get_state, stop) are answered right away.
     """
+    session = sessions.get(session_id)
+    if not session:
+        await websocket.close(code=4404)
+        return
+    state, manager = session.state, session.manager
+    
     client_id = id(websocket)
-    print(f"🔌 WebSocket 客戶端連接: {client_id}")
+    protocol = websocket.query_params.get("protocol", "json")
+    print(f"🔌 WebSocket 客戶端連接: {client_id} (protocol: {protocol})")
     
-    await manager.connect(websocket)
+    await manager.connect(websocket, protocol)
+    dispatcher = CommandDispatcher(session, websocket)
     try:
         # Keep connection alive and handle incoming messages
         while True:
@@ -762,109 +4287,28 @@ async def websocket_screenshot(websocket: WebSocket):
                 
                 # Handle control messages
                 if message_type == "ping":
-                    await websocket.send_json({"type": "pong"})
+                    # 客戶端回報上一次量到的 RTT，供串流控制器調整幀率與畫質
+                    rtt_ms = message.get("rtt")
+                    channel = manager.channels.get(websocket)
+                    if channel and isinstance(rtt_ms, (int, float)):
+                        channel.controller.record_rtt(rtt_ms / 1000)
+                    await manager.send(websocket, {"type": "pong", "t": message.get("t")})
                     
                 elif message_type == "get_state":
-                    await websocket.send_json({
+                    await manager.send(websocket, {
                         "type": "state",
                         "mode": state["mode"],
                         "ai_running": state["ai_running"],
-                        "connections": len(manager.active_connections)
+                        "connections": len(manager.active_connections),
+                        "stream_idle": manager.idle,
+                        "stream": manager.channels[websocket].stats() if websocket in manager.channels else None,
+                        "commands": dispatcher.stats()
                     })
                 
-                # Handle user interactions
-                elif message_type == "click":
-                    state["mode"] = "human"
-                    state["last_human"] = time.time()
-                    x, y = validate_coordinates(message.get("x", 0), message.get("y", 0))
-                    
-                    # 記錄點擊前的 URL
-                    url_before = page.url
-                    print(f"👆 Click at ({x}, {y}) on page: {url_before}")
-                    
-                    await page.mouse.click(x, y)
-                    
-                    # 等待可能的導航（給頁面時間開始導航）
-                    await asyncio.sleep(0.5)
-                    
-                    # 檢查是否有導航發生
-                    if page.url != url_before:
-                        print(f"🔄 導航開始: {url_before} -> {page.url}")
-                        try:
-                            # 等待新頁面載入完成
-                            await page.wait_for_load_state("load", timeout=10000)
-                            print(f"✅ 導航完成: {page.url}")
-                        except Exception as e:
-                            print(f"⚠️ 導航等待超時: {e}")
-                    else:
-                        # 沒有導航，可能是同頁操作
-                        print("ℹ️ 同頁點擊，無導航")
-                    
-                elif message_type == "keypress":
-                    state["mode"] = "human"
-                    state["last_human"] = time.time()
-                    key = message.get("key", "")
-                    ctrl = message.get("ctrl", False)
-                    shift = message.get("shift", False)
-                    alt = message.get("alt", False)
-                    
-                    # Map special keys
-                    key_map = {
-                        'Enter': 'Enter', 'Backspace': 'Backspace', 'Tab': 'Tab',
-                        'Escape': 'Escape', 'ArrowUp': 'ArrowUp', 'ArrowDown': 'ArrowDown',
-                        'ArrowLeft': 'ArrowLeft', 'ArrowRight': 'ArrowRight',
-                        'Delete': 'Delete', ' ': ' '
-                    }
-                    
-                    mapped_key = key_map.get(key, key)
-                    
-                    # Build modifiers list
-                    modifiers = []
-                    if ctrl:
-                        modifiers.append('Control')
-                    if shift:
-                        modifiers.append('Shift')
-                    if alt:
-                        modifiers.append('Alt')
-                    
-                    # Type or press key
-                    if len(key) == 1 and key.isprintable() and not ctrl and not alt:
-                        await page.keyboard.type(key)
-                    else:
-                        # Press with modifiers
-                        for mod in modifiers:
-                            await page.keyboard.down(mod)
-                        await page.keyboard.press(mapped_key)
-                        for mod in reversed(modifiers):
-                            await page.keyboard.up(mod)
-                    
-                elif message_type == "scroll":
-                    state["mode"] = "human"
-                    state["last_human"] = time.time()
-                    delta_y = message.get("deltaY", 0)
-                    await page.evaluate(f"window.scrollBy(0, {delta_y});")
-                
-                # Handle AI commands
-                elif message_type == "ai_start":
-                    task = message.get("task", "")
-                    if task and not state["ai_running"] and not state["browser_use_running"]:
-                        # Start AI task
-                        state["mode"] = "ai"
-                        state["task"] = task
-                        state["ai_running"] = True
-                        state["iteration_count"] = 0
-                        
-                        # Broadcast AI status
-                        await manager.broadcast({
-                            "type": "ai_status",
-                            "status": "starting",
-                            "task": task
-                        })
-                        
-                        # Start AI task in background
-                        asyncio.create_task(run_ai_task_background(task))
-                        
+                # Stop commands skip the queue so they take effect immediately,
+                # and cancel task starts that are still waiting in it
                 elif message_type == "ai_stop":
+                    dispatcher.discard({"ai_start"})
                     if state["ai_running"]:
                         state["ai_running"] = False
                         state["mode"] = "idle"
@@ -872,28 +4316,9 @@ async def websocket_screenshot(websocket: WebSocket):
                             "type": "ai_status",
                             "status": "stopped"
                         })
-                
-                # Handle Browser-use commands
-                elif message_type == "browser_use_start":
-                    task = message.get("task", "")
-                    if task and not state["browser_use_running"] and not state["ai_running"]:
-                        # Start browser-use task
-                        state["mode"] = "browser-use"
-                        state["task"] = task
-                        state["browser_use_running"] = True
-                        state["iteration_count"] = 0
-                        
-                        # Broadcast status
-                        await manager.broadcast({
-                            "type": "browser_use_status",
-                            "status": "starting",
-                            "task": task
-                        })
-                        
-                        # Start task in background
-                        asyncio.create_task(run_browser_use_task_background(task))
                         
                 elif message_type == "browser_use_stop":
+                    dispatcher.discard({"browser_use_start"})
                     if state["browser_use_running"]:
                         state["browser_use_running"] = False
                         state["mode"] = "idle"
@@ -906,29 +4331,23 @@ async def websocket_screenshot(websocket: WebSocket):
                             "status": "stopped"
                         })
                 
-                # Handle navigation commands
-                elif message_type == "navigate":
-                    url = message.get("url", "")
-                    if url:
-                        try:
-                            await page.goto(url, wait_until="domcontentloaded", timeout=10000)
-                            print(f"🌐 Navigated to: {url}")
-                        except Exception as e:
-                            print(f"❌ Navigation error: {e}")
-                
-                elif message_type == "back":
-                    try:
-                        await page.go_back(wait_until="domcontentloaded", timeout=5000)
-                        print("◀ Go back")
-                    except Exception as e:
-                        print(f"❌ Back navigation error: {e}")
+                elif message_type not in QUEUED_COMMANDS:
+                    print(f"⚠️ Unknown WebSocket message type: {message_type}")
+                    await manager.send(websocket, {
+                        "type": "command_error",
+                        "command": message_type,
+                        "id": message.get("id"),
+                        "message": "Unknown command"
+                    })
                 
-                elif message_type == "forward":
-                    try:
-                        await page.go_forward(wait_until="domcontentloaded", timeout=5000)
-                        print("▶ Go forward")
-                    except Exception as e:
-                        print(f"❌ Forward navigation error: {e}")
+                # User interactions, navigation and task starts run in order
+                elif not dispatcher.submit(message):
+                    await manager.send(websocket, {
+                        "type": "command_error",
+                        "command": message_type,
+                        "id": message.get("id"),
+                        "message": "Command queue is full"
+                    })
                     
             except WebSocketDisconnect:
                 break
@@ -940,32 +4359,48 @@ async def websocket_screenshot(websocket: WebSocket):
                 
     finally:
         manager.disconnect(websocket)
+        # 斷線前已送出的輸入仍要執行
+        await dispatcher.close()
         print(f"🔌 WebSocket 客戶端斷線: {client_id}，剩餘 {len(manager.active_connections)} 個連接")
 
 
 @app.get("/state")
-async def get_state():
+@app.get("/sessions/{session_id}/state")
+async def get_state(session_id: str = DEFAULT_SESSION_ID):
     """Get current system state."""
+    session = sessions.get(session_id)
+    if not session:
+        return session_not_found(session_id)
+    state = session.state
+    
     return {
+        "session_id": session.id,
         "mode": state["mode"],
         "ai_running": state["ai_running"],
         "browser_use_running": state["browser_use_running"],
         "task": state["task"],
         "iteration_count": state["iteration_count"],
-        "history_length": len(state["history"]),
-        "current_url": page.url if page else None,
+        "task_id": state["task_id"],
+        "model_calls": state["model_calls"],
+        "current_response_id": state["current_response_id"],
+        "history_length": session.history.length,
+        "current_url": session.page.url if session.page else None,
         "cdp_url": cdp_url
     }
 
 
 @app.post("/navigate")
-async def navigate_to_url(request: NavigateRequest):
+@app.post("/sessions/{session_id}/navigate")
+async def navigate_to_url(request: NavigateRequest, session_id: str = DEFAULT_SESSION_ID):
     """
     Navigate to a specific URL.
     """
-    global page, state
+    session = sessions.get(session_id)
+    if not session:
+        return session_not_found(session_id)
+    state, manager = session.state, session.manager
     
-    if not page:
+    if not session.page:
         return {
             "status": "error",
             "message": "Browser not initialized"
@@ -978,27 +4413,22 @@ async def navigate_to_url(request: NavigateRequest):
             url = 'https://' + url
         
         # Navigate to the URL
-        await page.goto(url, wait_until="domcontentloaded", timeout=30000)
+        await session.page.goto(url, wait_until="domcontentloaded", timeout=30000)
         
         # Add to history
-        state["history"].append({
-            "timestamp": time.time(),
-            "action": "navigate",
-            "url": url,
-            "source": "manual"
-        })
+        session.history.append("navigate", state["mode"], url=url, source="manual")
         
         # Broadcast navigation to WebSocket clients
         await manager.broadcast({
             "type": "navigation",
-            "url": page.url,
+            "url": session.page.url,
             "status": "success"
         })
         
         return {
             "status": "success",
-            "current_url": page.url,
-            "message": f"Successfully navigated to {page.url}"
+            "current_url": session.page.url,
+            "message": f"Successfully navigated to {session.page.url}"
         }
         
     except Exception as e:
@@ -1017,33 +4447,26 @@ async def navigate_to_url(request: NavigateRequest):
 
 
 @app.post("/ai/start")
-async def ai_start(request: AITaskRequest):
+@app.post("/sessions/{session_id}/ai/start")
+async def ai_start(request: AITaskRequest, session_id: str = DEFAULT_SESSION_ID):
     """
     Start an AI task with Azure Computer Use model.
     Task runs in background and broadcasts progress via WebSocket.
     Returns immediately after starting the task.
     """
-    if state["ai_running"] or state["browser_use_running"]:
+    session = sessions.get(session_id)
+    if not session:
+        return session_not_found(session_id)
+    
+    if session.busy:
         return {
             "status": "error",
-            "message": "Another task is already running. Stop it first."
+            "message": "Another task is already running in this session. Stop it first."
         }
     
     # Start AI task in background
-    state["mode"] = "ai"
-    state["task"] = request.task
-    state["ai_running"] = True
-    state["iteration_count"] = 0
-    
-    # Broadcast AI status to WebSocket clients
-    await manager.broadcast({
-        "type": "ai_status",
-        "status": "starting",
-        "task": request.task
-    })
-    
-    # Start AI task in background
-    asyncio.create_task(run_ai_task_background(request.task))
+    await start_ai_task(session, request.task, request.resume_response_id,
+                        request.max_iterations or MAX_AI_ITERATIONS)
     
     return {
         "status": "started",
@@ -1054,12 +4477,24 @@ async def ai_start(request: AITaskRequest):
 
 
 @app.post("/browser-use/start")
-async def browser_use_start(request: BrowserUseTaskRequest):
+@app.post("/sessions/{session_id}/browser-use/start")
+async def browser_use_start(request: BrowserUseTaskRequest, session_id: str = DEFAULT_SESSION_ID):
     """Start a browser-use task."""
-    if state["browser_use_running"] or state["ai_running"]:
+    session = sessions.get(session_id)
+    if not session:
+        return session_not_found(session_id)
+    
+    if session.busy:
+        return {
+            "status": "error",
+            "message": "Another task is already running in this session. Stop it first."
+        }
+    
+    if session.id != DEFAULT_SESSION_ID:
+        # browser-use 透過 CDP 連到整個瀏覽器，只綁定預設 session
         return {
             "status": "error",
-            "message": "Another task is already running. Stop it first."
+            "message": "Browser-use is only available in the default session"
         }
     
     if not browser_use_session:
@@ -1068,21 +4503,8 @@ async def browser_use_start(request: BrowserUseTaskRequest):
             "message": "Browser-use session not available"
         }
     
-    # Start browser-use task
-    state["mode"] = "browser-use"
-    state["task"] = request.task
-    state["browser_use_running"] = True
-    state["iteration_count"] = 0
-    
-    # Broadcast status
-    await manager.broadcast({
-        "type": "browser_use_status",
-        "status": "starting",
-        "task": request.task
-    })
-    
     # Start task in background
-    asyncio.create_task(run_browser_use_task_background(request.task))
+    await start_browser_use_task(session, request.task)
     
     return {
         "status": "started",
@@ -1093,8 +4515,14 @@ async def browser_use_start(request: BrowserUseTaskRequest):
 
 
 @app.post("/browser-use/stop")
-async def browser_use_stop():
+@app.post("/sessions/{session_id}/browser-use/stop")
+async def browser_use_stop(session_id: str = DEFAULT_SESSION_ID):
     """Stop the currently running browser-use task."""
+    session = sessions.get(session_id)
+    if not session:
+        return session_not_found(session_id)
+    state = session.state
+    
     was_running = state["browser_use_running"]
     
     state["browser_use_running"] = False
@@ -1108,9 +4536,16 @@ async def browser_use_stop():
 
 
 @app.post("/ai/stop")
-async def ai_stop():
+@app.post("/sessions/{session_id}/ai/stop")
+async def ai_stop(session_id: str = DEFAULT_SESSION_ID):
     """Stop the currently running AI task."""
+    session = sessions.get(session_id)
+    if not session:
+        return session_not_found(session_id)
+    state = session.state
+    
     was_running = state["ai_running"]
+    last_response_id = state["current_response_id"]
     
     state["ai_running"] = False
     state["mode"] = "idle"
@@ -1120,24 +4555,45 @@ async def ai_stop():
         "status": "stopped",
         "was_running": was_running,
         "iterations_completed": state["iteration_count"],
+        "model_calls": state["model_calls"],
+        "resume_response_id": last_response_id,
         "task": state["task"]
     }
 
 
 @app.post("/ai/execute")
-async def ai_execute_streaming(request: AITaskRequest):
+@app.post("/sessions/{session_id}/ai/execute")
+async def ai_execute_streaming(request: AITaskRequest, session_id: str = DEFAULT_SESSION_ID):
     """
     Execute an AI task and stream the progress via Server-Sent Events (SSE).
     Returns real-time updates of AI actions, messages, and status.
     """
-    if state["ai_running"] or state["browser_use_running"]:
+    session = sessions.get(session_id)
+    if not session:
+        return StreamingResponse(
+            iter([f"data: {json.dumps({'error': f'Session {session_id} not found'})}\n\n"]),
+            media_type="text/event-stream"
+        )
+    state = session.state
+    
+    if session.busy:
         return StreamingResponse(
-            iter(["data: {\"error\": \"Another task is already running\"}\n\n"]),
+            iter(["data: {\"error\": \"Another task is already running in this session\"}\n\n"]),
             media_type="text/event-stream"
         )
     
     async def event_generator():
-        global page
+        record = None
+        recorder = None
+        cache_key = None
+        turn = None
+        status = "stopped"
+        # 串流中的 ai_delta 事件，同時轉送給 WebSocket 觀看者
+        deltas = asyncio.Queue()
+        
+        async def forward_delta(event):
+            deltas.put_nowait(event)
+            await session.manager.broadcast(event)
         
         try:
             # Initialize task
@@ -1146,39 +4602,51 @@ async def ai_execute_streaming(request: AITaskRequest):
             state["ai_running"] = True
             state["iteration_count"] = 0
             state["current_response_id"] = None
+            state["model_calls"] = {"create": 0, "retrieve": 0}
+            record = start_task_record(session, request.task)
+            if TRAJECTORY_DIR and not request.resume_response_id:
+                recorder = TrajectoryRecorder(session, record)
             
-            yield f"data: {{\"type\": \"status\", \"message\": \"Starting AI task\", \"task\": \"{request.task}\"}}\n\n"
-            
-            # Take initial screenshot
-            screenshot_b64 = await take_screenshot_safe()
-            yield "data: {\"type\": \"status\", \"message\": \"Taking initial screenshot\"}\n\n"
+            yield f"data: {{\"type\": \"status\", \"message\": \"Starting AI task\", \"task\": \"{request.task}\", \"task_id\": \"{record['task_id']}\"}}\n\n"
             
-            # Initial request to AI model
-            response = openai_client.responses.create(
-                model=MODEL_DEPLOYMENT,
-                tools=[{
-                    "type": "computer_use_preview",
-                    "display_width": DISPLAY_WIDTH,
-                    "display_height": DISPLAY_HEIGHT,
-                    "environment": "browser"
-                }],
-                instructions="You are an AI agent with the ability to control a browser. You can control the keyboard and mouse. You take a screenshot after each action to check if your action was successful. Once you have completed the requested task you should stop running and pass back control to your human operator.",
-                input=[{
-                    "role": "user",
-                    "content": [{
-                        "type": "input_text",
-                        "text": request.task
-                    }, {
-                        "type": "input_image",
-                        "image_url": f"data:image/png;base64,{screenshot_b64}"
-                    }]
-                }],
-                reasoning={"generate_summary": "concise"},
-                truncation="auto"
-            )
+            timer = IterationTimer(0)
+            if request.resume_response_id:
+                # Resume from an existing response
+                with timer.phase("model"):
+                    turn = ModelTurn.completed(await retrieve_model_response(session, request.resume_response_id))
+            else:
+                # Take initial screenshot
+                image_url = await capture_model_observation(session, timer)
+                if recorder:
+                    await recorder.start()
+                yield "data: {\"type\": \"status\", \"message\": \"Taking initial screenshot\"}\n\n"
+                image_url, cache_key, cached = await apply_cached_actions(session, request.task, image_url, timer, recorder)
+                content = [{"type": "input_text", "text": request.task}, {"type": "input_image", "image_url": image_url}]
+                if cached:
+                    content.insert(1, {"type": "input_text", "text": cached_actions_note(cached)})
+                    yield f"data: {json.dumps({'type': 'cached', 'actions': cached})}\n\n"
+                
+                # Initial request to AI model
+                with timer.phase("model"):
+                    turn = await start_model_turn(
+                        session,
+                        forward_delta,
+                        model=MODEL_DEPLOYMENT,
+                        tools=[computer_use_tool()],
+                        instructions="You are an AI agent with the ability to control a browser. You can control the keyboard and mouse. You take a screenshot after each action to check if your action was successful. Once you have completed the requested task you should stop running and pass back control to your human operator.",
+                        input=[{
+                            "role": "user",
+                            "content": content
+                        }],
+                        reasoning={"generate_summary": "concise"},
+                        truncation="auto"
+                    )
+                    async for event in relay_model_events(deltas, turn.first_call):
+                        yield f"data: {json.dumps(event)}\n\n"
             
-            state["current_response_id"] = response.id
-            yield f"data: {{\"type\": \"status\", \"message\": \"AI response received\", \"response_id\": \"{response.id}\"}}\n\n"
+            state["current_response_id"] = turn.response_id
+            yield f"data: {{\"type\": \"status\", \"message\": \"AI response received\", \"response_id\": \"{turn.response_id}\"}}\n\n"
+            yield f"data: {json.dumps(record_iteration_timing(record, timer))}\n\n"
             
             # Execute AI task loop
             max_iterations = request.max_iterations or MAX_AI_ITERATIONS
@@ -1190,40 +4658,28 @@ async def ai_execute_streaming(request: AITaskRequest):
                 state["iteration_count"] = iteration + 1
                 yield f"data: {{\"type\": \"iteration\", \"count\": {iteration + 1}, \"max\": {max_iterations}}}\n\n"
                 
-                # Get current response
-                response = openai_client.responses.retrieve(response_id=state["current_response_id"])
-                
-                # Check if there's output
-                if not hasattr(response, 'output') or not response.output:
-                    yield "data: {\"type\": \"complete\", \"message\": \"AI task completed - no more output\"}\n\n"
-                    break
-                
-                # Extract text messages
-                text_messages = []
-                for item in response.output:
-                    if hasattr(item, 'type') and item.type == "text":
-                        text_messages.append(item.text)
-                
-                # Stream AI messages
-                if text_messages:
-                    message_text = "\\n".join(text_messages).replace('"', '\\"').replace('\n', '\\n')
-                    yield f"data: {{\"type\": \"message\", \"content\": \"{message_text}\", \"iteration\": {iteration + 1}}}\n\n"
-                
-                # Extract computer calls
-                computer_calls = [item for item in response.output 
-                                 if hasattr(item, 'type') and item.type == "computer_call"]
-                
-                if not computer_calls:
+                computer_call = await turn.computer_call()
+                if computer_call is None:
+                    async for event in relay_model_events(deltas, turn.final):
+                        yield f"data: {json.dumps(event)}\n\n"
+                    response = await turn.response()
+                    text_messages = response_messages(response)
+                    if text_messages:
+                        record["messages"].extend(text_messages)
+                        yield f"data: {json.dumps({'type': 'message', 'content': chr(10).join(text_messages), 'iteration': iteration + 1})}\n\n"
+                    status = "completed"
                     yield "data: {\"type\": \"complete\", \"message\": \"AI task completed - no more actions\"}\n\n"
                     break
                 
-                computer_call = computer_calls[0]
                 if not hasattr(computer_call, 'call_id') or not hasattr(computer_call, 'action'):
+                    status = "completed"
                     yield "data: {\"type\": \"complete\", \"message\": \"AI task completed - invalid action\"}\n\n"
                     break
                 
-                call_id = computer_call.call_id
                 action = computer_call.action
+                timer = IterationTimer(iteration + 1)
+                if cache_key and not getattr(computer_call, "pending_safety_checks", None):
+                    action_cache.store(cache_key, action_to_dict(action))
                 
                 # Stream action info
                 action_data = {
@@ -1251,85 +4707,77 @@ async def ai_execute_streaming(request: AITaskRequest):
                 
                 yield f"data: {json.dumps(action_data)}\n\n"
                 
-                # Execute the action
-                await page.bring_to_front()
-                await handle_ai_action(action)
-                
-                # Handle new tabs/pages and wait for navigation
-                if action.type in ["click"]:
-                    await asyncio.sleep(0.8)
-                    
-                    all_pages = page.context.pages
-                    if len(all_pages) > 1:
-                        newest_page = all_pages[-1]
-                        if newest_page != page and newest_page.url not in ["about:blank", ""]:
-                            page = newest_page
-                            globals()['page'] = newest_page
-                            yield f"data: {{\"type\": \"navigation\", \"message\": \"Switched to new tab\", \"url\": \"{newest_page.url}\"}}\n\n"
-                    
-                    try:
-                        await page.wait_for_load_state("networkidle", timeout=3000)
-                    except Exception:
-                        try:
-                            await page.wait_for_load_state("domcontentloaded", timeout=2000)
-                        except Exception:
-                            pass
-                elif action.type != "wait":
-                    await asyncio.sleep(0.3)
-                
-                yield "data: {\"type\": \"status\", \"message\": \"Action completed, taking screenshot\"}\n\n"
+                # Execute the action, wait for the page and take a screenshot
+                url_before = session.page.url
+                input_content, new_tab_url = await execute_computer_call(session, computer_call, timer)
+                if recorder:
+                    await recorder.add_step(action, timer, url_before)
+                if new_tab_url:
+                    yield f"data: {json.dumps({'type': 'navigation', 'message': 'Switched to new tab', 'url': new_tab_url})}\n\n"
                 
-                # Take screenshot after action
-                screenshot_b64 = await take_screenshot_safe()
+                yield "data: {\"type\": \"status\", \"message\": \"Action completed, screenshot taken\"}\n\n"
                 
-                # Check for safety checks
-                acknowledged_checks = []
-                if hasattr(computer_call, 'pending_safety_checks') and computer_call.pending_safety_checks:
-                    acknowledged_checks = computer_call.pending_safety_checks
-                    yield f"data: {{\"type\": \"warning\", \"message\": \"Safety checks acknowledged\", \"count\": {len(acknowledged_checks)}}}\n\n"
+                if "acknowledged_safety_checks" in input_content[0]:
+                    yield f"data: {{\"type\": \"warning\", \"message\": \"Safety checks acknowledged\", \"count\": {len(input_content[0]['acknowledged_safety_checks'])}}}\n\n"
                 
-                # Prepare input for next request
-                input_content = [{
-                    "type": "computer_call_output",
-                    "call_id": call_id,
-                    "output": {
-                        "type": "input_image",
-                        "image_url": f"data:image/png;base64,{screenshot_b64}"
-                    }
-                }]
+                # Continue with cached actions while the screen matches an earlier run
+                output = input_content[0]["output"]
+                output["image_url"], cache_key, cached = await apply_cached_actions(
+                    session, request.task, output["image_url"], timer, recorder)
+                if cached:
+                    input_content.append({"role": "user", "content": [{"type": "input_text", "text": cached_actions_note(cached)}]})
+                    yield f"data: {json.dumps({'type': 'cached', 'actions': cached})}\n\n"
                 
-                if acknowledged_checks:
-                    input_content[0]["acknowledged_safety_checks"] = [
-                        {"id": c.id, "code": c.code, "message": c.message}
-                        for c in acknowledged_checks
-                    ]
+                # The rest of the response was generated while the action ran
+                with timer.phase("model"):
+                    async for event in relay_model_events(deltas, turn.final):
+                        yield f"data: {json.dumps(event)}\n\n"
+                    response = await turn.response()
+                text_messages = response_messages(response)
+                if text_messages:
+                    record["messages"].extend(text_messages)
+                    yield f"data: {json.dumps({'type': 'message', 'content': chr(10).join(text_messages), 'iteration': iteration + 1})}\n\n"
                 
                 # Send screenshot back for next step
                 yield "data: {\"type\": \"status\", \"message\": \"Sending feedback to AI\"}\n\n"
                 
-                next_response = openai_client.responses.create(
-                    model=MODEL_DEPLOYMENT,
-                    previous_response_id=response.id,
-                    tools=[{
-                        "type": "computer_use_preview",
-                        "display_width": DISPLAY_WIDTH,
-                        "display_height": DISPLAY_HEIGHT,
-                        "environment": "browser"
-                    }],
-                    input=input_content,
-                    truncation="auto"
-                )
+                with timer.phase("model"):
+                    turn = await start_model_turn(
+                        session,
+                        forward_delta,
+                        model=MODEL_DEPLOYMENT,
+                        previous_response_id=response.id,
+                        tools=[computer_use_tool()],
+                        input=input_content,
+                        truncation="auto"
+                    )
+                    async for event in relay_model_events(deltas, turn.first_call):
+                        yield f"data: {json.dumps(event)}\n\n"
                 
-                state["current_response_id"] = next_response.id
+                state["current_response_id"] = turn.response_id
+                yield f"data: {json.dumps(record_iteration_timing(record, timer))}\n\n"
+            else:
+                # 迭代次數用完（不是使用者停止）
+                if state["ai_running"]:
+                    status = "max_iterations"
+                    yield f"data: {json.dumps({'type': 'status', 'message': f'Reached max iterations ({max_iterations})'})}\n\n"
                 
-            yield f"data: {{\"type\": \"complete\", \"message\": \"AI task finished\", \"iterations\": {state['iteration_count']}}}\n\n"
+            yield f"data: {json.dumps({'type': 'complete', 'message': 'AI task finished', 'status': status, 'iterations': state['iteration_count'], 'task_id': record['task_id'], 'response_id': state['current_response_id'], 'model_calls': state['model_calls']})}\n\n"
             
         except Exception as e:
+            status = "error"
             error_msg = str(e).replace('"', '\\"').replace('\n', '\\n')
             yield f"data: {{\"type\": \"error\", \"message\": \"{error_msg}\"}}\n\n"
         finally:
+            if turn:
+                turn.cancel()
             state["ai_running"] = False
             state["mode"] = "idle"
+            session.task_finished()
+            if record:
+                finish_task_record(session, record, status)
+            if recorder and recorder.steps:
+                await recorder.save(status)
             yield "data: {\"type\": \"status\", \"message\": \"Task ended\"}\n\n"
     
     return StreamingResponse(
@@ -1343,26 +4791,538 @@ async def ai_execute_streaming(request: AITaskRequest):
     )
 
 
+@app.post("/ai/replay")
+@app.post("/sessions/{session_id}/ai/replay")
+async def ai_replay(request: ReplayRequest, session_id: str = DEFAULT_SESSION_ID):
+    """
+    Replay a recorded trajectory without calling the model.
+    Falls back to the live model if the screen diverges from the recording.
+    """
+    session = sessions.get(session_id)
+    if not session:
+        return session_not_found(session_id)
+    
+    if session.busy:
+        return {
+            "status": "error",
+            "message": "Another task is already running in this session. Stop it first."
+        }
+    
+    trajectory = await asyncio.to_thread(load_trajectory, request.trajectory_id)
+    if not trajectory:
+        return {"status": "error", "message": f"Trajectory {request.trajectory_id} not found"}
+    if trajectory.get("status") != "completed":
+        return {"status": "error", "message": f"Trajectory {request.trajectory_id} did not complete ({trajectory.get('status')})"}
+    
+    await start_replay_task(session, trajectory, request.fallback,
+                            request.max_iterations or MAX_AI_ITERATIONS)
+    
+    return {
+        "status": "started",
+        "trajectory_id": request.trajectory_id,
+        "task": trajectory["task"],
+        "steps": len(trajectory["steps"]),
+        "message": "Replay started in background. Progress will be broadcast via WebSocket."
+    }
+
+
+@app.get("/trajectories")
+async def get_trajectories(limit: int = 20):
+    """List saved trajectories, newest first."""
+    return {"trajectories": await asyncio.to_thread(list_trajectories, limit)}
+
+
+@app.get("/trajectories/{trajectory_id}")
+async def get_trajectory(trajectory_id: str, include_frames: bool = False):
+    """Get a saved trajectory with its steps (thumbnails only when requested)."""
+    trajectory = await asyncio.to_thread(load_trajectory, trajectory_id)
+    if not trajectory:
+        return {"status": "error", "message": f"Trajectory {trajectory_id} not found"}
+    if not include_frames:
+        for step in trajectory["steps"]:
+            step.pop("frame", None)
+    return trajectory
+
+
+@app.get("/ai/cache")
+async def get_action_cache():
+    """Action cache hit/miss statistics."""
+    return action_cache.stats()
+
+
+@app.post("/ai/cache/clear")
+async def clear_action_cache(task: Optional[str] = None, url: Optional[str] = None):
+    """Invalidate cached actions, optionally only those of one task and/or page."""
+    removed = action_cache.invalidate(task=task, url=url)
+    return {"status": "success", "removed": removed, "entries": len(action_cache.entries)}
+
+
+@app.get("/ai/tasks")
+@app.get("/sessions/{session_id}/ai/tasks")
+async def list_ai_tasks(limit: int = 20, session_id: Optional[str] = None):
+    """List recent AI task records, newest first (optionally for one session)."""
+    matching = [r for r in task_records.values() if session_id is None or r["session_id"] == session_id]
+    records = matching[-limit:] if limit > 0 else []
+    return {
+        "tasks": [
+            {
+                "task_id": r["task_id"],
+                "session_id": r["session_id"],
+                "kind": r["kind"],
+                "task": r["task"],
+                "status": r["status"],
+                "started_at": r["started_at"],
+                "ended_at": r["ended_at"],
+                "iterations": task_iteration_count(r),
+                "timed_iterations": len(r["iterations"]),
+                "model_calls": r["model_calls"]
+            }
+            for r in reversed(records)
+        ],
+        "total": len(matching)
+    }
+
+
+@app.get("/ai/tasks/{task_id}")
+async def get_ai_task(task_id: str, include_iterations: bool = False):
+    """Get a task record with its per-phase latency summary (p50/p95)."""
+    record = task_records.get(task_id)
+    if not record:
+        return {
+            "status": "error",
+            "message": f"Task {task_id} not found"
+        }
+    
+    result = {key: value for key, value in record.items() if key != "iterations"}
+    result["iteration_count"] = task_iteration_count(record)
+    result["timed_iterations"] = len(record["iterations"])
+    result["timing_summary"] = summarize_timings(record["iterations"])
+    if include_iterations:
+        result["iterations"] = record["iterations"]
+    return result
+
+
+@app.post("/tasks")
+async def submit_task(request: TaskSubmitRequest):
+    """Queue a computer-use or browser-use task; it runs when a session frees up."""
+    try:
+        item = scheduler.submit(
+            request.task,
+            kind=request.kind or "computer-use",
+            priority=request.priority or 0,
+            tenant=request.tenant or "default",
+            max_iterations=request.max_iterations or MAX_AI_ITERATIONS,
+            resume_response_id=request.resume_response_id
+        )
+    except ValueError as e:
+        return {
+            "status": "error",
+            "message": str(e)
+        }
+    return scheduler.snapshot(item)
+
+
+@app.get("/tasks/metrics")
+async def task_metrics():
+    """Queue depth, wait times and worker utilisation (for autoscaling)."""
+    return scheduler.metrics()
+
+
+@app.get("/tasks/{task_id}")
+async def get_task(task_id: str):
+    """Status of a queued / running / finished task."""
+    item = scheduler.tasks.get(task_id)
+    if not item:
+        return {
+            "status": "error",
+            "message": f"Task {task_id} not found"
+        }
+    return scheduler.snapshot(item)
+
+
+@app.get("/tasks/{task_id}/result")
+async def get_task_result(task_id: str):
+    """Result of a finished task (messages for computer-use, the agent's result for browser-use)."""
+    item = scheduler.tasks.get(task_id)
+    if not item:
+        return {
+            "status": "error",
+            "message": f"Task {task_id} not found"
+        }
+    return {
+        "task_id": task_id,
+        "status": item["status"],
+        "ready": item["status"] in scheduler.FINISHED,
+        "result": item["result"]
+    }
+
+
+@app.post("/tasks/{task_id}/cancel")
+async def cancel_task(task_id: str):
+    """Remove a queued task, or stop a running one at its next iteration."""
+    item = scheduler.cancel(task_id)
+    if not item:
+        return {
+            "status": "error",
+            "message": f"Task {task_id} not found"
+        }
+    return scheduler.snapshot(item)
+
+
 @app.get("/history")
-async def get_history(limit: int = 50):
-    """Get action history."""
+@app.get("/sessions/{session_id}/history")
+async def get_history(limit: int = 50, before: Optional[int] = None, task_id: Optional[str] = None,
+                      action: Optional[str] = None, since: Optional[float] = None, until: Optional[float] = None,
+                      session_id: str = DEFAULT_SESSION_ID):
+    """Get action history, newest page first; pass next_cursor as `before` for older records.
+
+    Filters: task_id, action (type), since / until (unix timestamps).
+    """
+    session = sessions.get(session_id)
+    if not session:
+        return session_not_found(session_id)
+    
+    filters = {"task_id": task_id, "action": action, "since": since, "until": until}
+    records, next_cursor = await session.history.query(max(1, min(limit, 1000)), before=before, **filters)
     return {
-        "history": state["history"][-limit:],
-        "total": len(state["history"])
+        "history": records,
+        "next_cursor": next_cursor,
+        "total": await session.history.count(**filters)
     }
 
 
 @app.post("/history/clear")
-async def clear_history():
+@app.post("/sessions/{session_id}/history/clear")
+async def clear_history(session_id: str = DEFAULT_SESSION_ID):
     """Clear action history."""
-    count = len(state["history"])
-    state["history"] = []
+    session = sessions.get(session_id)
+    if not session:
+        return session_not_found(session_id)
+    
+    count = await session.history.clear()
     return {
         "status": "cleared",
         "items_removed": count
     }
 
 
+# ============================================================================
+# Process sharding (WORKER_PROCESSES > 1)
+# ============================================================================
+
+HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "upgrade", "host", "content-length"}
+
+
+class ShardRouter:
+    """Front router for a pool of backend worker processes.
+
+    Each worker runs this module with its own Playwright / Chromium. Sessions
+    are assigned to the least loaded worker when created and every request,
+    SSE stream and WebSocket for a session goes to that worker for its
+    whole lifetime. Unscoped (legacy) endpoints go to worker 0, whose
+    default session plays the role of the single-process default session.
+    """
+
+    def __init__(self, worker_urls: list):
+        self.workers = worker_urls
+        self.session_workers: Dict[str, int] = {DEFAULT_SESSION_ID: 0}
+        self.task_workers: Dict[str, int] = {}
+        self.client: Optional[httpx.AsyncClient] = None
+
+    async def start(self):
+        self.client = httpx.AsyncClient(timeout=httpx.Timeout(None, connect=5.0))
+
+    async def stop(self):
+        if self.client:
+            await self.client.aclose()
+
+    def load(self) -> list:
+        """Sessions currently assigned to each worker."""
+        counts = [0] * len(self.workers)
+        for index in self.session_workers.values():
+            counts[index] += 1
+        return counts
+
+    async def get_json(self, index: int, path: str) -> Optional[dict]:
+        try:
+            response = await self.client.get(self.workers[index] + path)
+            return response.json()
+        except Exception:
+            return None
+
+    async def metrics(self) -> str:
+        """Every worker's /metrics merged into one exposition, labelled with `worker`."""
+        families: "OrderedDict[str, list]" = OrderedDict()  # name -> [HELP/TYPE lines, samples]
+        up = []
+        for index, url in enumerate(self.workers):
+            try:
+                response = await self.client.get(url + "/metrics")
+                response.raise_for_status()
+            except Exception:
+                up.append(f'computer_use_worker_up{{worker="{index}"}} 0')
+                continue
+            up.append(f'computer_use_worker_up{{worker="{index}"}} 1')
+            name = None
+            for line in response.text.splitlines():
+                if line.startswith("# "):
+                    name = line.split(" ", 3)[2]
+                    header = families.setdefault(name, [[], []])[0]
+                    if line not in header:
+                        header.append(line)
+                elif line and name:
+                    cut = min(i for i in (line.find("{"), line.find(" ")) if i >= 0)
+                    if line[cut] == "{":
+                        line = f'{line[:cut]}{{worker="{index}",{line[cut + 1:]}'
+                    else:
+                        line = f'{line[:cut]}{{worker="{index}"}}{line[cut:]}'
+                    families[name][1].append(line)
+        lines = ["# HELP computer_use_worker_up Whether the worker answered the last scrape.",
+                 "# TYPE computer_use_worker_up gauge", *up]
+        for header, samples in families.values():
+            lines.extend(header + samples)
+        return "\n".join(lines) + "\n"
+
+    async def locate(self, path_template: str, key: str, cache: Dict[str, int]) -> Optional[int]:
+        """Find the worker that knows a session / task id (e.g. after a router restart)."""
+        if key in cache:
+            return cache[key]
+        for index in range(len(self.workers)):
+            result = await self.get_json(index, path_template.format(key))
+            if result and result.get("status") != "error":
+                cache[key] = index
+                return index
+        return None
+
+    async def worker_for(self, path: str) -> int:
+        parts = path.strip("/").split("/")
+        if len(parts) >= 2 and parts[0] == "sessions":
+            index = await self.locate("/sessions/{}", parts[1], self.session_workers)
+        elif len(parts) >= 2 and parts[0] == "tasks":
+            index = await self.locate("/tasks/{}", parts[1], self.task_workers)
+        elif len(parts) >= 3 and parts[:2] == ["ai", "tasks"]:
+            index = await self.locate("/ai/tasks/{}", parts[2], self.task_workers)
+        else:
+            index = 0
+        return index or 0
+
+    async def forward(self, index: int, request: Request, body: Optional[bytes] = None):
+        """Proxy an HTTP request to a worker, streaming the response (SSE included)."""
+        url = self.workers[index] + request.url.path
+        if request.url.query:
+            url += "?" + request.url.query
+        headers = {k: v for k, v in request.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+        if body is None:
+            body = await request.body()
+        try:
+            upstream = await self.client.send(
+                self.client.build_request(request.method, url, headers=headers, content=body),
+                stream=True
+            )
+        except Exception as e:
+            return JSONResponse({"status": "error", "message": f"Worker {index} unavailable: {e}"}, status_code=502)
+
+        async def relay():
+            try:
+                async for chunk in upstream.aiter_raw():
+                    yield chunk
+            finally:
+                await upstream.aclose()
+
+        response_headers = {k: v for k, v in upstream.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+        return StreamingResponse(relay(), status_code=upstream.status_code, headers=response_headers)
+
+    async def create_session(self, request: Request):
+        """Create a session on the least loaded worker, falling back to the others when full."""
+        body = await request.body()
+        try:
+            requested_id = json.loads(body or b"{}").get("session_id")
+        except ValueError:
+            requested_id = None
+        if requested_id and requested_id in self.session_workers:
+            return {"status": "error", "message": f"Session {requested_id} already exists"}
+
+        load = self.load()
+        result = {"status": "error", "message": "No worker available"}
+        for index in sorted(range(len(self.workers)), key=lambda i: load[i]):
+            try:
+                response = await self.client.post(self.workers[index] + "/sessions", content=body,
+                                                  headers={"content-type": "application/json"})
+                result = response.json()
+            except Exception as e:
+                result = {"status": "error", "message": f"Worker {index} unavailable: {e}"}
+                continue
+            if result.get("status") == "created":
+                self.session_workers[result["session_id"]] = index
+                result["worker"] = index
+                return result
+        return result
+
+    async def list_sessions(self):
+        listed = []
+        for index in range(len(self.workers)):
+            result = await self.get_json(index, "/sessions") or {}
+            for info in result.get("sessions", []):
+                # 其他 worker 的預設 session 只給排程器使用
+                if info["session_id"] == DEFAULT_SESSION_ID and index != 0:
+                    continue
+                self.session_workers.setdefault(info["session_id"], index)
+                listed.append({**info, "worker": index})
+        return {"sessions": listed, "total": len(listed), "workers": len(self.workers)}
+
+    async def submit_task(self, request: Request):
+        """Queue a task on the worker with the shortest queue."""
+        body = await request.body()
+        depths = []
+        for index in range(len(self.workers)):
+            metrics = await self.get_json(index, "/tasks/metrics")
+            if metrics:
+                depths.append((metrics["queue_depth"] + metrics["running"], index))
+        if not depths:
+            return JSONResponse({"status": "error", "message": "No worker available"}, status_code=502)
+        index = min(depths)[1]
+        response = await self.client.post(self.workers[index] + "/tasks", content=body,
+                                          headers={"content-type": "application/json"})
+        result = response.json()
+        if "task_id" in result:
+            self.task_workers[result["task_id"]] = index
+            result["worker"] = index
+        return result
+
+    async def task_metrics(self):
+        """Sum the per-worker scheduler metrics."""
+        workers = [await self.get_json(index, "/tasks/metrics") for index in range(len(self.workers))]
+        alive = [m for m in workers if m]
+        return {
+            "queue_depth": sum(m["queue_depth"] for m in alive),
+            "running": sum(m["running"] for m in alive),
+            "oldest_wait_s": max((m["oldest_wait_s"] for m in alive), default=0.0),
+            "wait_time_p95_s": max((m["wait_time_s"]["p95"] or 0.0 for m in alive), default=0.0),
+            "workers": workers,
+        }
+
+    async def proxy_websocket(self, websocket: WebSocket, index: int):
+        """Pin a WebSocket to one worker and relay text / binary messages both ways."""
+        import websockets
+
+        path = websocket.url.path
+        if websocket.url.query:
+            path += "?" + websocket.url.query
+        url = self.workers[index].replace("http://", "ws://", 1) + path
+        try:
+            upstream = await websockets.connect(url, max_size=None)
+        except Exception as e:
+            print(f"⚠️ Router: worker {index} WebSocket unavailable: {e}")
+            await websocket.close(code=1013)
+            return
+        await websocket.accept()
+
+        async def client_to_worker():
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                if message.get("bytes") is not None:
+                    await upstream.send(message["bytes"])
+                elif message.get("text") is not None:
+                    await upstream.send(message["text"])
+
+        async def worker_to_client():
+            async for message in upstream:
+                if isinstance(message, bytes):
+                    await websocket.send_bytes(message)
+                else:
+                    await websocket.send_text(message)
+
+        tasks = [asyncio.create_task(client_to_worker()), asyncio.create_task(worker_to_client())]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await upstream.close()
+            try:
+                await websocket.close()
+            except Exception:
+                pass
+
+
+def create_router_app(worker_urls: list) -> FastAPI:
+    """FastAPI app that shards sessions across worker processes."""
+    router = ShardRouter(worker_urls)
+
+    @asynccontextmanager
+    async def router_lifespan(app: FastAPI):
+        await router.start()
+        yield
+        await router.stop()
+
+    router_app = FastAPI(title="Azure AI Computer Use Router", version="1.0.0", lifespan=router_lifespan)
+    router_app.state.router = router
+
+    @router_app.get("/router/status")
+    async def router_status():
+        return {
+            "workers": [
+                {"index": index, "url": url, "sessions": load, "healthy": await router.get_json(index, "/api/status") is not None}
+                for index, (url, load) in enumerate(zip(router.workers, router.load()))
+            ]
+        }
+
+    @router_app.post("/sessions")
+    async def route_create_session(request: Request):
+        return await router.create_session(request)
+
+    @router_app.get("/sessions")
+    async def route_list_sessions():
+        return await router.list_sessions()
+
+    @router_app.delete("/sessions/{session_id}")
+    async def route_delete_session(session_id: str, request: Request):
+        index = await router.worker_for(request.url.path)
+        response = await router.forward(index, request)
+        if session_id != DEFAULT_SESSION_ID:
+            router.session_workers.pop(session_id, None)
+        return response
+
+    @router_app.post("/tasks")
+    async def route_submit_task(request: Request):
+        return await router.submit_task(request)
+
+    @router_app.get("/tasks/metrics")
+    async def route_task_metrics():
+        return await router.task_metrics()
+
+    @router_app.get("/metrics")
+    async def route_metrics():
+        return PlainTextResponse(await router.metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+    @router_app.websocket("/{path:path}")
+    async def route_websocket(websocket: WebSocket, path: str):
+        await router.proxy_websocket(websocket, await router.worker_for(websocket.url.path))
+
+    @router_app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "PATCH", "DELETE"])
+    async def route_http(request: Request, path: str):
+        return await router.forward(await router.worker_for(request.url.path), request)
+
+    return router_app
+
+
+def spawn_workers(count: int) -> list:
+    """Start `count` backend processes on WORKER_BASE_PORT + i, each with its own Chromium."""
+    processes = []
+    for index in range(count):
+        env = dict(os.environ, WORKER_INDEX=str(index), WORKER_PROCESSES="1")
+        if WORKER_DISPLAYS:
+            env["DISPLAY"] = WORKER_DISPLAYS[index % len(WORKER_DISPLAYS)]
+        processes.append(subprocess.Popen([
+            sys.executable, "-m", "uvicorn", "computer_use_backend:app",
+            "--host", "127.0.0.1",
+            "--port", str(WORKER_BASE_PORT + index),
+            "--log-level", "warning"
+        ], env=env))
+    return processes
+
+
 if __name__ == "__main__":
     import uvicorn
     
@@ -1375,14 +5335,32 @@ if __name__ == "__main__":
     print("  Docs: http://localhost:8000/docs")
     print("  ReDoc: http://localhost:8000/redoc")
     print()
+    if WORKER_PROCESSES > 1:
+        print(f"  Workers: {WORKER_PROCESSES} (ports {WORKER_BASE_PORT}-{WORKER_BASE_PORT + WORKER_PROCESSES - 1})")
     print("Press Ctrl+C to stop")
     print("="*60)
     print()
     
-    uvicorn.run(
-        "computer_use_backend:app",
-        host="0.0.0.0",
-        port=8000,
-        reload=True,
-        log_level="info"
-    )
\ No newline at end of file
+    if WORKER_PROCESSES > 1:
+        # 每個 worker 各自有 Playwright / Chromium 與 event loop，router 只負責轉送
+        workers = spawn_workers(WORKER_PROCESSES)
+        try:
+            uvicorn.run(
+                create_router_app([f"http://127.0.0.1:{WORKER_BASE_PORT + i}" for i in range(WORKER_PROCESSES)]),
+                host="0.0.0.0",
+                port=8000,
+                log_level="info"
+            )
+        finally:
+            for worker in workers:
+                worker.terminate()
+            for worker in workers:
+                worker.wait()
+    else:
+        uvicorn.run(
+            "computer_use_backend:app",
+            host="0.0.0.0",
+            port=8000,
+            reload=os.getenv("UVICORN_RELOAD", "0") == "1",
+            log_level="info"
+        )
\ No newline at end of file